@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import click
-import crcmod
 import datetime
 import errno
 import hid
@@ -12,7 +11,6 @@ import sys
 import time
 import json
 import logging
-import subprocess
 from time import sleep
 
 
@@ -21,17 +19,28 @@ from enum import IntEnum
 
 sys.path.append(os.path.dirname(__file__))
 
-from d21bootloader16 import dog_enumerate, get_dev_build_timestamp
+import dogcrc
+import dogenum
+import dogtool
+import dogtransport
 
+from dogcrc import first_difference, is_blank
+
+#
+# As in d21bootloader16.py, the dogcatalog and dogwait helpers are
+# only imported by the code that uses them
+#
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
 
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
+def setup_logging():
+    LOG.setLevel(logging.INFO)
 
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-ch.setFormatter(formatter)
-LOG.addHandler(ch)
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    ch.setFormatter(formatter)
+    LOG.addHandler(ch)
 
 #
 # Should be updated every time EV2_D20_DBG.bin or EV2_DBG.bin change
@@ -52,10 +61,7 @@ ID_GET_UNIQUE_ID            = 0xB6
 HID_ATTRIB_PRODUCT_ID          = 1
 HID_ATTRIB_FIRMWARE_BUILD_TIME = 4
 HID_ATTRIB_BOARD_REVISION      = 9
-
-HW_ID_D20_HYBRID = 29
-HW_ID_D21_HYBRID = 30
-HW_ID_D21_HOMOG  = 31
+HID_ATTRIB_SECONDARY_FIRMWARE_BUILD_TIME = 12
 
 DEBUG_SET_FORCE_CRC_CHECK   = 0x800F
 DEBUG_BOOTLOADER_REASON     = 0x8010
@@ -86,21 +92,29 @@ FLASH_PARTITION_SIZE        = 256 # Size of a unit of data stored in
                                   # "data" flash. Based on D2x erase
                                   # row size.
 
-USB_ENUMERATION_DELAY_S     = 5.0
-
-CRCFUN   = lambda d: crcmod.mkCrcFun(0x104C11DB7)(d, 0)
 CRCALIGN = 4
 CRCLEN   = struct.calcsize("<I")
 
 MAX_HW_ID = 0x100000000 - 1
 
 def compute_crc(data, size):
-    l = len(data)
-    data = bytes(data) + bytes(0xFF for _ in range(0, size - len(data)))
-    return CRCFUN(data)
+    return dogcrc.compute_crc(data, size)
 
 
 class DogBootloaderVerifyError(Exception):
+    #
+    # Flash differs from the image from `offset` on, which lies in
+    # the erase row starting at `row`
+    #
+    def __init__(self, offset, row):
+        super().__init__(f"First mismatch at 0x{offset:08x}, row 0x{row:08x}")
+        self.offset = offset
+        self.row    = row
+
+class DogBootloaderBootError(Exception):
+    #
+    # The app didn't come up as programmed, see reboot_verified()
+    #
     pass
 
 class DogBootloaderTimeout(Exception):
@@ -213,6 +227,7 @@ class DogBootloaderAttributes:
             attr = {
                 HID_ATTRIB_FIRMWARE_BUILD_TIME : "build_timestamp",
                 HID_ATTRIB_BOARD_REVISION: "hardware_id",
+                HID_ATTRIB_SECONDARY_FIRMWARE_BUILD_TIME: "secondary_build_timestamp",
             }.get(t)
 
             if attr:
@@ -233,8 +248,8 @@ class DogBootloader:
     }
 
     @staticmethod
-    def find_app_interface():
-        ifaces = hid.enumerate(VALVE_USB_VID, JUPITER_USB_PID)
+    def find_app_interface(serial=None):
+        ifaces = dogenum.enumerate(VALVE_USB_VID, JUPITER_USB_PID, serial)
 
         if ifaces and len(ifaces) >= 3:
             if sys.platform == 'win32':
@@ -250,65 +265,88 @@ class DogBootloader:
         return None
 
     @staticmethod
-    def find_mcu_interface(mcu):
-        ifaces = hid.enumerate(VALVE_USB_VID, JUPITER_BOOTLOADER_USB_PID)
-        if len(ifaces) > 1:
+    def find_mcu_interface(mcu, serial=None, exact=False):
+        #
+        # A lone bootloader interface is taken to be `mcu`'s unless
+        # `exact`. The interfaces of a unit with two MCUs enumerate one
+        # at a time, so the first one listed can be the other MCU's.
+        #
+        ifaces = dogenum.enumerate(VALVE_USB_VID, JUPITER_BOOTLOADER_USB_PID, serial)
+        if exact or len(ifaces) > 1:
             ifaces = [i for i in ifaces if i['interface_number'] == mcu]
         if ifaces:
             return ifaces[0]
         else:
             return None
 
-    def __init__(self, mcu=DogBootloaderMCU.PRIMARY, reset=True):
-        self.mcu = mcu
+    @staticmethod
+    def wait_for_secondary(serial=None):
+        #
+        # Once the primary of a D2x_D21 unit is in the bootloader, for
+        # the secondary's interface, which can enumerate after it
+        #
+        import dogwait
+
+        try:
+            _, dev = dogwait.wait_for_device(
+                lambda: DogBootloader.find_mcu_interface(DogBootloaderMCU.SECONDARY,
+                                                         serial, exact=True),
+                timeout=dogwait.USB_ENUMERATION_TIMEOUT_S)
+        except dogwait.DogWaitTimeout:
+            raise DogBootloaderTimeout("Timed out waiting for the secondary's bootloader")
+
+        dev.close()
+
+    def __init__(self, mcu=DogBootloaderMCU.PRIMARY, reset=True, serial=None):
+        self.mcu    = mcu
+        #
+        # USB serial number of the controller to use, if there may be
+        # more than one. It's the same in the app and the bootloader.
+        #
+        self.serial = serial
+        #
+        # Attributes and partitions read through this handle, and how
+        # many round trips answering from them saved, see invalidate()
+        #
+        self.cache = {}
+        self.saved = 0
         #
         # App firmware would have three HID interfaces,
         # so we need to select the right one. Ours is the one with
         # vendor usage page, so select it.
         #
-        iface = DogBootloader.find_app_interface()
+        iface = DogBootloader.find_app_interface(serial)
         if iface:
             self.device_type = DeviceType(iface['release_number'])
             if reset:
                 LOG.info('Looks like we are running an app. Resetting into bootloader')
-                with hid.Device(path=iface['path']) as self.hiddev:
+                with dogtransport.open_device(path=iface['path']) as self.hiddev:
                     sleep(0.1)
                     self.app = self.attributes
                     self._reboot_into_isp()
             else:
-                self.hiddev = hid.Device(path=iface['path'])
+                self.hiddev = dogtransport.open_device(path=iface['path'])
                 return
 
-            timeout = USB_ENUMERATION_DELAY_S    # seconds
-            delay   = 0.1
-            dev     = None
-            for i in range(int(timeout / delay)):
-                if hid.enumerate(VALVE_USB_VID,
-                                 JUPITER_BOOTLOADER_USB_PID):
-                    break
+            import dogwait
 
-                time.sleep(delay)
-            else:
+            try:
+                exact = self.device_type == DeviceType.D2x_D21
+                _, self.hiddev = dogwait.wait_for_device(
+                    lambda: DogBootloader.find_mcu_interface(mcu, serial, exact),
+                    timeout=dogwait.USB_ENUMERATION_TIMEOUT_S)
+            except dogwait.DogWaitTimeout:
                 raise DogBootloaderTimeout("Timed out waiting for bootloader to enumerate")
 
-            #
-            # HACK: Not sure why a sleep here is necessary, but it
-            # seems that hid.enumerate() can retrun a positive
-            # result before it can be opened with hidapi.hid_open
-            # ¯\_(ツ)_/¯
-            #
-            time.sleep(USB_ENUMERATION_DELAY_S)
-
-            iface = DogBootloader.find_mcu_interface(mcu)
-            self.hiddev = hid.Device(path=iface['path'])
-
         else:
-            iface = DogBootloader.find_mcu_interface(mcu)
+            iface = DogBootloader.find_mcu_interface(mcu, serial)
+            if iface and iface['release_number'] == DeviceType.D2x_D21:
+                iface = DogBootloader.find_mcu_interface(mcu, serial, exact=True)
             if (not iface):
                 raise(DogBootloaderNoDeviceFound);
 
             self.device_type = DeviceType(iface['release_number'])
-            self.hiddev = hid.Device(path=iface['path'])
+            self.hiddev = dogtransport.open_device(path=iface['path'])
 
             if reset:
                 self.reset()
@@ -349,9 +387,29 @@ class DogBootloader:
         return f"DogBootloader[{side}]"
 
     def close(self):
+        if self.saved:
+            LOG.debug(f"{self}: cache saved {self.saved} round trips")
         self.hiddev.close()
 
+    def invalidate(self, offset=None, size=None):
+        #
+        # Forgets cached reads. Given a flash range, only what writing
+        # or erasing it could change: the attributes, which reflect
+        # the info partition, and the partitions it overlaps. Every
+        # erase and write goes through erase_row() and write_32b(),
+        # which call this, and resets drop everything.
+        #
+        if offset is None:
+            self.cache.clear()
+            return
+
+        self.cache.pop('attributes', None)
+        for key in [k for k in self.cache if isinstance(k, int) and
+                    k < offset + size and offset < k + FLASH_PARTITION_SIZE]:
+            del self.cache[key]
+
     def _reboot_into_isp(self):
+        self.invalidate()
         self.send([ID_REBOOT_INTO_ISP,
                    0x04,
                    0x00,
@@ -361,6 +419,11 @@ class DogBootloader:
 
     @property
     def attributes(self):
+        attributes = self.cache.get('attributes')
+        if attributes is not None:
+            self.saved += 1
+            return attributes
+
         self.send([ID_GET_ATTRIBUTES_VALUES])
         payload = self.recv()
         command = payload[0]
@@ -369,31 +432,62 @@ class DogBootloader:
 
         assert command == ID_GET_ATTRIBUTES_VALUES
 
-        return DogBootloaderAttributes(report)
+        attributes = DogBootloaderAttributes(report)
+        self.cache['attributes'] = attributes
+        return attributes
+
+    def snapshot(self):
+        #
+        # Everything describe() shows, in the same shape as
+        # d21bootloader16's snapshot(). The attributes and the info
+        # partition are read once and cached, see invalidate().
+        #
+        iface = DogBootloader.find_mcu_interface(self.mcu, self.serial) or \
+                DogBootloader.find_app_interface(self.serial)
+        info  = self.info
+
+        return {
+            'path'               : iface['path'].decode(),
+            'vid'                : iface['vendor_id'],
+            'pid'                : iface['product_id'],
+            'device_type'        : int(self.device_type),
+            'bl_build_timestamp' : self.bl_firmware_build_time,
+            'mcus'               : [{
+                'side'              : 'primary' if self.mcu == DogBootloaderMCU.PRIMARY else 'secondary',
+                'board_serial'      : info.board_serial,
+                'unit_serial'       : info.unit_serial,
+                'hardware_id'       : self.hardware_id,
+                'unique_id'         : self.unique_id,
+                'user_row'          : list(self.user_row) if self.device_type != DeviceType.RA4 else None,
+                'bootloader_reason' : self.bootloader_reason,
+                'state'             : None, # not reported by this bootloader
+            }],
+        }
 
     def describe(self):
+        snapshot = self.snapshot()
+        mcu      = snapshot['mcus'][0]
+
         LOG.info(f"Found a {str(self.device_type)} bootloader")
         LOG.info("----------------------------")
-        info = hid.enumerate(VALVE_USB_VID,
-                             JUPITER_BOOTLOADER_USB_PID)[0]
 
-        LOG.info(f"Path: {info['path'].decode()}")
-        LOG.info(f"VID: 0x{info['vendor_id']:x}")
-        LOG.info(f"PID: 0x{info['product_id']:x}")
+        LOG.info(f"Path: {snapshot['path']}")
+        LOG.info(f"VID: 0x{snapshot['vid']:x}")
+        LOG.info(f"PID: 0x{snapshot['pid']:x}")
 
-        build_time_utc = datetime.utcfromtimestamp(self.bl_firmware_build_time)
-        LOG.info(f"Bootloader FW Build Time: 0x{self.bl_firmware_build_time:x} ({build_time_utc} UTC)")
+        build_time_utc = datetime.utcfromtimestamp(snapshot['bl_build_timestamp'])
+        LOG.info(f"Bootloader FW Build Time: 0x{snapshot['bl_build_timestamp']:x} ({build_time_utc} UTC)")
 
         LOG.info(f"** {self} Unit **")
-        LOG.info(f'Stored board serial: {self.board_serial}')
-        LOG.info(f'Stored hardware ID: {self.hardware_id}')
+        LOG.info(f"Stored board serial: {mcu['board_serial']}")
+        LOG.info(f"Stored hardware ID: {mcu['hardware_id']}")
         LOG.info("MCU unique ID: {:08X} {:08X} {:08X} {:08X}"
-                 .format(*self.unique_id))
-        if self.device_type != DeviceType.RA4:
+                 .format(*mcu['unique_id']))
+        if mcu['user_row'] is not None:
             LOG.info("MCU user row: {:02X} {:02X} {:02X} {:02X} {:02X} {:02X} {:02X} {:02X}"
-                     .format(*self.user_row))
+                     .format(*mcu['user_row']))
 
-        LOG.info(f"MCU bootloader mode reason: {self.bootloader_reason}")
+        LOG.info(f"MCU bootloader mode reason: {mcu['bootloader_reason']}")
         LOG.info("----------------------------")
 
     @property
@@ -455,14 +549,10 @@ class DogBootloader:
         self._reboot_into_isp()
 
     def send(self, msg):
-        msg   = bytes(msg)
-        zeros = bytes(0x00 for i in range(len(msg), HID_EP_SIZE))
-
-        self.hiddev.send_feature_report(bytes([0x00]) + msg + zeros)
+        self.hiddev.send_report(msg)
 
     def recv(self):
-        msg = self.hiddev.get_feature_report(0x00, HID_EP_SIZE + 1)
-        return msg[1:]
+        return self.hiddev.get_report()
 
     def get_row_size(self, offset):
         if self.device_type in (DeviceType.D2x_D21, DeviceType.D21_D21):
@@ -480,6 +570,7 @@ class DogBootloader:
 
     def write_32b(self, offset, data):
         LOG.debug(f"writing data @ 0x{offset:08x}")
+        self.invalidate(offset, 32)
         fmt = "<BBI"
 
         self.send(struct.pack(fmt,
@@ -500,6 +591,7 @@ class DogBootloader:
 
     def erase_row(self, offset):
         LOG.debug(f"erasing row @ 0x{offset:08x}")
+        self.invalidate(offset, self.get_row_size(offset))
         fmt = "<BBI"
         self.send(struct.pack(fmt,
                               ID_FIRMWARE_ERASE_ROW,
@@ -511,21 +603,104 @@ class DogBootloader:
                        self.get_row_size(offset)):
             self.erase_row(o)
 
-    def erase(self):
+    def rows(self):
         offset = self.APP_FW_START
         while offset < self.APP_FW_END:
+            size = self.get_row_size(offset)
+            yield offset, size
+            offset += size
+
+    def row_of(self, offset):
+        for row, size in self.rows():
+            if row <= offset < row + size:
+                return row
+
+        return offset
+
+    def erase(self, rows=None):
+        if rows is None:
+            rows = [offset for offset, _ in self.rows()]
+
+        for offset in rows:
             self.erase_row(offset)
-            offset += self.get_row_size(offset)
+
+    def erase_plan(self, blob, installed=None):
+        #
+        # Returns the rows that have to be erased before `blob` (the
+        # padded image and CRC, laid out from APP_FW_START) can be
+        # written. A row is skipped only if it's known to be blank
+        # already, i.e. neither `blob` nor the `installed` image put
+        # anything in it. Without knowing what's installed, there's no
+        # cheaper way to confirm a row is blank than erasing it, so
+        # every row gets erased.
+        #
+        crc_row = self.APP_FW_END - self.get_row_size(self.APP_FW_INFO)
+        rows    = []
+        for offset, size in self.rows():
+            start = offset - self.APP_FW_START
+            end   = start + size
+
+            if installed is None or offset >= crc_row or \
+               not is_blank(blob[start:end]) or not is_blank(installed[start:end]):
+                rows.append(offset)
+
+        return rows
+
+    def delta_plan(self, blob, installed):
+        #
+        # Returns the rows whose contents differ between the
+        # `installed` image and `blob`, plus the CRC row, which always
+        # changes
+        #
+        crc_row   = self.APP_FW_END - self.get_row_size(self.APP_FW_INFO)
+        installed = installed + b'\xff' * (len(blob) - len(installed))
+        rows      = []
+        for offset, size in self.rows():
+            start = offset - self.APP_FW_START
+            end   = start + size
+
+            if offset >= crc_row or blob[start:end] != installed[start:end]:
+                rows.append(offset)
+
+        return rows
+
+    def installed_image(self, name):
+        #
+        # The app reports its build timestamp before we reset it into
+        # the bootloader. If the catalog has the image of the same
+        # family as `name` built at that time, we know exactly what's
+        # in flash.
+        #
+        app = getattr(self, 'app', None)
+        if app is None:
+            return None
+
+        if self.mcu == DogBootloaderMCU.PRIMARY:
+            timestamp = app.build_timestamp
+        else:
+            timestamp = app.secondary_build_timestamp
+
+        import dogcatalog
+
+        entry = dogcatalog.installed(name, timestamp)
+        if entry is None or entry.size > self.APP_FW_LENGTH:
+            return None
+
+        LOG.info(f"{self} is running {entry.name}")
+        return entry.read()
 
     def __read(self, offset, readfn, size, chunk):
-        row = bytes()
-        for _ in range(0, size, chunk):
-            row    += readfn(offset)
-            offset += chunk
         #
-        # Needs to be bytearray so it would be modifiable
+        # Needs to be bytearray so it would be modifiable. Filled in
+        # place so reading a large region stays linear.
         #
-        return bytearray(row)
+        row  = bytearray(size)
+        view = memoryview(row)
+        for pos in range(0, size, chunk):
+            view[pos : pos + chunk] = readfn(offset)
+            offset += chunk
+
+        return row
 
     def read_row(self, offset):
         return self.__read(offset,
@@ -534,18 +709,25 @@ class DogBootloader:
                            32)
 
     def read_partition(self, offset):
-        return self.__read(offset,
+        cached = self.cache.get(offset)
+        if cached is not None:
+            self.saved += FLASH_PARTITION_SIZE // 32
+            return bytearray(cached)
+
+        data = self.__read(offset,
                            self.read_row,
                            FLASH_PARTITION_SIZE,
                            self.get_row_size(offset))
+        self.cache[offset] = bytes(data)
+        return data
 
     def __write(self, offset, data, writefn, size, chunk):
         assert len(data) == size
 
-        for _ in range(0, size, chunk):
-            writefn(offset, data[:chunk])
+        data = memoryview(data)
+        for pos in range(0, size, chunk):
+            writefn(offset, data[pos : pos + chunk])
             offset += chunk
-            data    = data[chunk:]
 
 
     def write_row(self, offset, data):
@@ -571,11 +753,14 @@ class DogBootloader:
     def download_firmware(self, size):
         LOG.info(f"Download firmware from {self}, size: {size}")
 
-        data = bytes()
-        for offset in range(self.APP_FW_START, self.APP_FW_START + size, 32):
-            data += self.read_32b(offset)
+        data = bytearray(-(-size // 32) * 32)
+        view = memoryview(data)
+        for pos in range(0, size, 32):
+            view[pos : pos + 32] = self.read_32b(self.APP_FW_START + pos)
 
-        return data[:size]
+        view.release()
+        del data[size:]
+        return data
 
     def update_crc(self, crc):
         crc = bytes(crc)
@@ -592,32 +777,81 @@ class DogBootloader:
             crc[0] = ~crc[0] & 0xFF
         self.update_crc(crc)
 
-    def upload_firmware(self, name, populate_crc=True, do_readback=False):
+    def upload_firmware(self, name, populate_crc=True, do_readback=False, sparse=True,
+                        installed=None, delta=False, erase_plan=False):
         with open(name, "rb") as f:
-            blob = f.read()
+            image = f.read()
 
-        assert len(blob) <= self.APP_FW_LENGTH, \
-            f"Firmware size ({len(blob)}) must be smaller than {self.APP_FW_LENGTH} bytes"
-
-        blob += bytes(0xFF for _ in range(0, self.APP_FW_LENGTH - len(blob)))
-        crc = compute_crc(blob, self.APP_FW_LENGTH) if populate_crc else 0xFFFF_FFFF
-        blob += struct.pack("<I", crc)
+        assert len(image) <= self.APP_FW_LENGTH, \
+            f"Firmware size ({len(image)}) must be smaller than {self.APP_FW_LENGTH} bytes"
+        #
+        # The CRC word stays erased until the CRC has been computed,
+        # which happens as the chunks in front of it are streamed out
         #
-        # Erase everything, then write data
+        blob  = bytearray(image)
+        blob += b'\xff' * (self.APP_FW_LENGTH + CRCLEN - len(image))
         #
-        self.erase()
+        # Erase the whole app, or with `erase_plan` everything the old
+        # or the new image occupies, or in delta mode just the rows that
+        # changed, then write data to the erased rows. Rows that weren't
+        # erased are either blank in the new image or already hold the
+        # right data, as long as `installed` is really what's in flash:
+        # skipped rows aren't read back.
+        #
+        if delta and installed is not None:
+            rows = self.delta_plan(blob, installed)
+            LOG.info(f"Delta update, {len(rows)} of {len(list(self.rows()))} rows changed")
+        else:
+            rows = self.erase_plan(blob, installed if erase_plan else None)
+
+        self.erase(rows)
 
         LOG.info(f"Uploading {name} to {self}, size: {len(blob)}")
-        for offset in range(0, len(blob), 32):
-            self.write_32b(self.APP_FW_START + offset, blob[offset : offset + 32])
+        blank = bytes(0xFF for _ in range(0, 32))
+        view  = memoryview(blob)
+        crc   = dogcrc.DogCrc()
+        for row in rows:
+            start = row - self.APP_FW_START
+            for offset in range(start, start + self.get_row_size(row), 32):
+                #
+                # Rows go out in ascending order and the CRC row is
+                # always among them, so by the time the chunk holding
+                # the CRC word is reached the CRC covers the whole app
+                #
+                end = offset + 32
+                crc.update_to(image, min(end, self.APP_FW_LENGTH))
+                if end > self.APP_FW_LENGTH and populate_crc:
+                    struct.pack_into("<I", blob, self.APP_FW_LENGTH, crc.value)
+
+                chunk = view[offset : offset + 32]
+                #
+                # The row was just erased, so there is no need to send
+                # chunks that would write erased-state bytes. That
+                # covers the 0xFF padding, which is most of the image on
+                # D20
+                #
+                if sparse and chunk == blank:
+                    continue
+
+                self.write_32b(self.APP_FW_START + offset, chunk)
 
         if(do_readback):
-            LOG.info("Reading written data back for verification")
+            self.verify_firmware(blob)
 
-            firmware = self.download_firmware(size=len(blob))
+    def verify_firmware(self, blob):
+        #
+        # Reads the app back a chunk at a time and compares each with
+        # `blob` as it arrives, so a bad first row fails right away
+        #
+        LOG.info(f"Verifying {len(blob)} bytes on {self}")
 
-            if blob != firmware:
-                raise DogBootloaderVerifyError()
+        view = memoryview(blob)
+        for pos in range(0, len(blob), 32):
+            expected = view[pos : pos + 32]
+            chunk    = self.read_32b(self.APP_FW_START + pos)[:len(expected)]
+            if chunk != expected:
+                offset = self.APP_FW_START + pos + first_difference(chunk, expected)
+                raise DogBootloaderVerifyError(offset, self.row_of(offset))
 
     @property
     def info(self):
@@ -678,29 +912,75 @@ class DogBootloader:
                               bytes(DogBootloaderMTEBlob(str(val))))
 
     def reboot(self, wait_for_app=False):
+        self.invalidate()
         self.send([
             ID_FIRMWARE_UPDATE_REBOOT,
         ])
 
         if wait_for_app:
-            timeout = USB_ENUMERATION_DELAY_S    # seconds
-            delay   = 0.1
-            path     = None
-            for i in range(int(timeout / delay)):
-                if DogBootloader.find_app_interface():
-                    break;
-
-                time.sleep(delay)
-            else:
-                raise DogBootloaderTimeout()
             #
-            # HACK: Not sure why a sleep here is necessary, but it
-            # seems that hid.enumerate() can retrun a positive
-            # result before it can be opened with hidapi.hid_open
-            # ¯\_(ツ)_/¯
+            # The app is only ready once it can be opened, which can
+            # be a while after it enumerates
             #
-            time.sleep(USB_ENUMERATION_DELAY_S)
+            import dogwait
+
+            try:
+                _, dev = dogwait.wait_for_device(lambda: DogBootloader.find_app_interface(self.serial),
+                                                 timeout=dogwait.USB_ENUMERATION_TIMEOUT_S)
+            except dogwait.DogWaitTimeout:
+                raise DogBootloaderTimeout()
+
+            dev.close()
+
+    def reboot_verified(self, firmware, secondary_firmware=None):
+        #
+        # Reboots into the app with the bootloader checking the app CRC
+        # first, instead of reading the images back: one reboot cycle
+        # rather than a READ_32B round trip per 32 bytes. The app has
+        # to report the builds just programmed. If the controller
+        # comes back in the bootloader instead, the reason each MCU
+        # stayed there is read.
+        #
+        # The CRC check is forced on this MCU only, the secondary's
+        # handle forces its own.
+        #
+        import dogwait
+
+        self.set_force_crc_check()
+        self.reboot()
 
+        bootloader = dogwait.once_gone(
+            lambda: DogBootloader.find_mcu_interface(DogBootloaderMCU.PRIMARY, self.serial))
+        try:
+            iface, dev = dogwait.wait_for_device(
+                lambda: DogBootloader.find_app_interface(self.serial) or bootloader(),
+                timeout=dogwait.USB_ENUMERATION_TIMEOUT_S)
+        except dogwait.DogWaitTimeout:
+            raise DogBootloaderTimeout()
+
+        dev.close()
+
+        if iface['product_id'] == JUPITER_BOOTLOADER_USB_PID:
+            raise DogBootloaderBootError(self.boot_failure())
+
+        error = dogenum.check_app_builds(firmware, secondary_firmware, self.serial,
+                                         VALVE_USB_VID, JUPITER_USB_PID)
+        if error:
+            raise DogBootloaderBootError(error)
+
+    def boot_failure(self):
+        mcus = [DogBootloaderMCU.PRIMARY]
+        if self.device_type == DeviceType.D2x_D21:
+            mcus.append(DogBootloaderMCU.SECONDARY)
+
+        reasons = []
+        for mcu in mcus:
+            if mcu == DogBootloaderMCU.SECONDARY:
+                DogBootloader.wait_for_secondary(self.serial)
+            with DogBootloader(mcu, reset=False, serial=self.serial) as bootloader:
+                reasons.append(f"{mcu.name.lower()}: {bootloader.bootloader_reason}")
+
+        return f"Back in the bootloader, {', '.join(reasons)}"
 
     def set_force_crc_check(self, on=True):
         self.send(struct.pack("<BBHL",
@@ -711,15 +991,26 @@ class DogBootloader:
 
 
 
+#
+# Serial number of the controller picked with --serial or --path, see
+# dogenum.serial_for()
+#
+SERIAL = None
+
 @click.group()
-def cli():
-    pass
+@click.option('--serial', help='USB serial number of the controller to use')
+@click.option('--path', help='HID path of any interface of the controller to use')
+def cli(serial, path):
+    global SERIAL
+    SERIAL = dogenum.serial_for(serial, path)
 
-def dog(primary):
+def dog(primary, reset=True, serial=None):
     mcu = DogBootloaderMCU.PRIMARY if primary else DogBootloaderMCU.SECONDARY
-    d = DogBootloader(mcu=mcu)
+    d = DogBootloader(mcu=mcu, reset=reset,
+                      serial=SERIAL if serial is None else serial)
 
     if mcu == DogBootloaderMCU.SECONDARY and d.device_type != DeviceType.D2x_D21:
+        d.close()
         raise DogBootloaderNotSupported()
 
     return d
@@ -753,50 +1044,42 @@ def getinfo(primary):
     print('SUCCESS')
 
 @cli.command()
-def getdevicesjson():
-  rawdevs = [ *dog_enumerate(JUPITER_USB_PID), *dog_enumerate(JUPITER_BOOTLOADER_USB_PID) ]
-  devs = [ { **item,
-             'build_timestamp': get_dev_build_timestamp(item)[0],
-             'secondary_build_timestamp': get_dev_build_timestamp(item)[1],
-             'is_bootloader': item['product_id'] == JUPITER_BOOTLOADER_USB_PID,
-             'path': item['path'].decode('utf-8') }
-           for item in rawdevs ]
+@click.option('--json', 'as_json', is_flag=True, help='Print as JSON')
+def getall(as_json):
+    with dog(True) as bootloader:
+        snapshot = bootloader.snapshot()
+        device_type = bootloader.device_type
+
+    #
+    # The secondary of a D2x_D21 unit is only reachable once the
+    # primary is in the bootloader, which it is by now
+    #
+    if device_type == DeviceType.D2x_D21:
+        DogBootloader.wait_for_secondary(SERIAL)
+        with dog(False, reset=False) as bootloader:
+            snapshot['mcus'] += bootloader.snapshot()['mcus']
+
+    if as_json:
+        print(json.dumps(snapshot))
+        return
 
-  print(json.dumps(devs))
+    for key, value in snapshot.items():
+        if key != 'mcus':
+            print(f"{key}: {value}")
+    for mcu in snapshot['mcus']:
+        for key, value in mcu.items():
+            if key != 'side':
+                print(f"{mcu['side']} {key}: {value}")
+    print('SUCCESS')
+
+@cli.command()
+def getdevicesjson():
+    dogenum.getdevicesjson(JUPITER_USB_PID, JUPITER_BOOTLOADER_USB_PID)
 
 @cli.command()
 @click.option('--primary/--secondary', default=True)
 def getappbuildtimestamp(primary):
-    vid = VALVE_USB_VID
-    pid = JUPITER_USB_PID
-
-    if sys.platform == 'win32':
-        devs =  [d for d in hid.enumerate(vid, pid)
-            if d['usage_page'] >= 0xFF00]
-    else:
-        devs = hid.enumerate(vid, pid)
-
-    if len(devs) > 1:
-        devs = [d for d in devs if
-                d['interface_number'] == JUPITER_CONTROL_INTERFACE]
-
-    # Disallow report when multiple controllers are connected
-    if len(devs) > 1:
-        print('Multiple controllers detected.')
-        print('ERROR')
-        return
-
-    if len(devs) == 0:
-        print('No Controller found at VID: {} PID: {}'.format(hex(vid), hex(pid)))
-        print('ERROR')
-        return
-
-    if primary:
-        print(get_dev_build_timestamp(devs[0])[0])
-    else:
-        print(get_dev_build_timestamp(devs[0])[1])
-
-    print('SUCCESS')
+    dogenum.getappbuildtimestamp(VALVE_USB_VID, JUPITER_USB_PID, primary, SERIAL)
 
 @cli.command()
 @click.option('--primary/--secondary', default=True)
@@ -864,13 +1147,190 @@ def setunitserial(serial):
 @click.argument('firmware', type=click.Path(exists=True,
                                             dir_okay=False))
 @click.option('--primary/--secondary', default=True)
-def program(firmware, primary):
-    with dog(primary) as bootloader:
-        bootloader.upload_firmware(firmware)
-        if primary:
-            bootloader.reboot(wait_for_app=True)
+@click.option('--sparse/--no-sparse', default=True,
+              help='Skip writing chunks that are blank after erase')
+@click.option('--erase-plan/--full-erase', default=False,
+              help='Only erase rows used by the installed or the new image. Skipped rows '
+                   'are assumed blank, not read back')
+@click.option('--delta/--no-delta', default=False,
+              help='Only rewrite rows that differ from the installed image, if known')
+@click.option('--verify/--no-verify', default=False,
+              help='Read programmed image back and verify it')
+@click.option('--verify-crc', is_flag=True,
+              help='Reboot with the app CRC checked and confirm the app runs the new build. '
+                   'With --secondary the CRC is checked at the next reboot')
+def program(firmware, primary, sparse, erase_plan, delta, verify, verify_crc):
+    program_device(firmware, primary, sparse, erase_plan, delta, verify, verify_crc)
     print('SUCCESS')
 
+def program_device(firmware, primary, sparse=True, erase_plan=False, delta=False,
+                   verify=False, verify_crc=False, serial=None):
+    with dog(primary, serial=serial) as bootloader:
+        program_bootloader(bootloader, firmware, primary, sparse, erase_plan, delta,
+                           verify, verify_crc)
+
+def program_bootloader(bootloader, firmware, primary, sparse=True, erase_plan=False,
+                       delta=False, verify=False, verify_crc=False):
+    #
+    # `program` on an open bootloader, which dogd.py keeps open between
+    # requests. Takes every option `program` does.
+    #
+    installed = bootloader.installed_image(firmware) if erase_plan or delta else None
+    bootloader.upload_firmware(firmware, do_readback=verify, sparse=sparse,
+                               installed=installed, delta=delta, erase_plan=erase_plan)
+    if primary and verify_crc:
+        bootloader.reboot_verified(firmware)
+    elif primary:
+        bootloader.reboot(wait_for_app=True)
+    elif verify_crc:
+        #
+        # The secondary boots when the primary is next rebooted
+        #
+        bootloader.set_force_crc_check()
+
+@cli.command(name='program-dual')
+@click.argument('firmware', type=click.Path(exists=True,
+                                            dir_okay=False))
+@click.option('--secondary-firmware', type=click.Path(exists=True, dir_okay=False),
+              help='Image for the secondary MCU, by default the latest image next to '
+                   'FIRMWARE of the family its HW ID calls for')
+@click.option('--delta/--no-delta', default=False,
+              help='Only rewrite rows that differ from the installed image, if known')
+@click.option('--verify-crc', is_flag=True,
+              help='Reboot with the app CRCs checked and confirm the app runs the new builds')
+def program_dual(firmware, secondary_firmware, delta, verify_crc):
+    import dogcatalog
+
+    try:
+        program_dual_device(firmware, secondary_firmware, delta, verify_crc)
+    except dogcatalog.DogCatalogError as e:
+        print(e)
+        print('ERROR')
+        sys.exit(1)
+
+    print('SUCCESS')
+
+def secondary_image(firmware, hw_id):
+    #
+    # The latest image next to `firmware` for the secondary MCU of a
+    # D2x_D21 unit with primary HW ID `hw_id`: D20 on the hybrid, D21
+    # otherwise
+    #
+    import dogcatalog
+
+    family = dogcatalog.family_for(DeviceType.D2x_D21, hw_id, secondary=True)
+    entry  = dogcatalog.load(os.path.dirname(os.path.abspath(firmware))).latest(family)
+    if entry is None:
+        raise dogcatalog.DogCatalogError(f"No {family} image next to {firmware}")
+
+    return entry.path
+
+def check_family(firmware, device_type, hw_id, primary):
+    import dogcatalog
+
+    family = dogcatalog.family_for(device_type, hw_id, secondary=not primary)
+    named  = dogcatalog.parse_name(os.path.basename(firmware))
+    if named and named[0] != family:
+        raise dogcatalog.DogCatalogError(
+            f"{firmware} is a {named[0]} image, the {'primary' if primary else 'secondary'} "
+            f"MCU runs {family}")
+
+def program_dual_device(firmware, secondary_firmware=None, delta=False, verify_crc=False,
+                        serial=None):
+    #
+    # Programs both MCUs of a D2x_D21 unit in one bootloader session:
+    # one reset into the bootloader, both uploads at once, each
+    # through its MCU's own interface, then one reboot and one wait
+    # for the app. Separate `program --secondary` and `program
+    # --primary` runs reset and wait twice, and upload one after the
+    # other.
+    #
+    import concurrent.futures
+
+    with dog(True, serial=serial) as primary:
+        try:
+            if primary.device_type != DeviceType.D2x_D21:
+                raise DogBootloaderNotSupported()
+
+            hw_id = primary.hardware_id
+            if secondary_firmware is None:
+                secondary_firmware = secondary_image(firmware, hw_id)
+            check_family(firmware, primary.device_type, hw_id, primary=True)
+            check_family(secondary_firmware, primary.device_type, hw_id, primary=False)
+        except Exception:
+            #
+            # Nothing was written yet, back to the app
+            #
+            primary.reboot(wait_for_app=True)
+            raise
+
+        #
+        # The primary found the app and reset both MCUs, and what the
+        # app reported covers both of them. The secondary's interface
+        # can enumerate after the primary's.
+        #
+        DogBootloader.wait_for_secondary(primary.serial)
+        with dog(False, reset=False, serial=primary.serial) as secondary:
+            secondary.app = getattr(primary, 'app', None)
+
+            jobs = [(primary, firmware), (secondary, secondary_firmware)]
+            jobs = [(d, image, d.installed_image(image) if delta else None)
+                    for d, image in jobs]
+            with concurrent.futures.ThreadPoolExecutor(len(jobs)) as pool:
+                futures = [pool.submit(d.upload_firmware, image, installed=installed,
+                                       delta=delta)
+                           for d, image, installed in jobs]
+            for f in futures:
+                f.result()
+
+            if verify_crc:
+                secondary.set_force_crc_check()
+
+        if verify_crc:
+            primary.reboot_verified(firmware, secondary_firmware)
+        else:
+            primary.reboot(wait_for_app=True)
+
+@cli.command(name='program-all')
+@click.argument('firmware', type=click.Path(exists=True,
+                                            dir_okay=False))
+@click.option('--primary/--secondary', default=True)
+@click.option('--delta/--no-delta', default=False,
+              help='Only rewrite rows that differ from the installed image, if known')
+@click.option('--verify-crc', is_flag=True,
+              help='Reboot with the app CRC checked and confirm the app runs the new build')
+def program_all(firmware, primary, delta, verify_crc):
+    #
+    # Programs every controller this tool drives at once, each on its
+    # own thread
+    #
+    import dogcatalog
+
+    #
+    # Only the controllers whose MCU runs the image's family, if the
+    # image has a catalog name
+    #
+    family  = dogcatalog.parse_name(os.path.basename(firmware))
+    serials = []
+    for serial, device_type in dogenum.get_controllers().items():
+        if dogtool.DEVICE_TYPES.get(device_type) != __name__:
+            continue
+        if SERIAL is not None and serial != SERIAL:
+            continue
+        if not primary and device_type != DeviceType.D2x_D21:
+            continue
+        if primary and family and dogcatalog.family_for(device_type) != family[0]:
+            continue
+        serials.append(serial)
+
+    results = dogenum.run_per_controller(
+        lambda serial: program_device(firmware, primary, delta=delta, verify_crc=verify_crc,
+                                      serial=serial),
+        serials)
+
+    if not dogenum.print_results(results):
+        sys.exit(1)
+
 @cli.command()
 @click.option('--primary/--secondary', default=True)
 def getblob(primary):
@@ -896,34 +1356,53 @@ def reset(primary):
                                                 # MCU
     print('SUCCESS')
 
-if __name__ == '__main__':
+#
+# What main() prints, and exits with, for the errors it handles.
+# dogd.py reports errors of the requests it serves from here too.
+#
+FAILURES = (
+    (hid.HIDException,           ['{message}'], 1),
+    (DogBootloaderNotSupported,  ['NOT SUPPORTED'], 2),
+    (DogBootloaderTimeout,       ['TIMEOUT'], 3),
+    (DogBootloaderNoDeviceFound, ['NO DEVICE FOUND'], 4),
+    (DogBootloaderVerifyError,   ['Programmed data mismatch', '{message}', 'ERROR'], 5),
+    (DogBootloaderBootError,     ['Programmed app failed to boot', '{message}', 'ERROR'], 6),
+)
+
+def failure(e):
+    #
+    # The lines printed for error `e` and the exit code, or None if
+    # main() doesn't handle it
+    #
+    for cls, lines, code in FAILURES:
+        if isinstance(e, cls):
+            return [line.format(message=e) for line in lines], code
+
+    return None
+
+def main(probe=True):
+    setup_logging()
+
     try:
-        with DogBootloader(mcu=DogBootloaderMCU.PRIMARY,
-                           reset=False) as d:
-            device_type = d.device_type
+        if probe:
+            with DogBootloader(mcu=DogBootloaderMCU.PRIMARY,
+                               reset=False, serial=dogtool.selected()) as d:
+                device_type = d.device_type
 
-        if device_type == DeviceType.D21_D21:
-            import d21bootloader16
-            # print(f'Redirecting to d21bootloader16.py due to HW ID of {hardware_id}')
-            python = "python" if sys.platform == 'win32' else "python3"
-            ret = subprocess.call([python, d21bootloader16.__file__] + sys.argv[1:])
-            sys.exit(ret)
+            tool = dogtool.DEVICE_TYPES[device_type]
+            if tool != __name__:
+                dogtool.run(tool)
 
         cli()
-    except hid.HIDException as e:
-        print(e)
-        sys.exit(1)
-    except DogBootloaderNotSupported:
-        print('NOT SUPPORTED')
-        sys.exit(2)
-    except DogBootloaderTimeout:
-        print('TIMEOUT')
-        sys.exit(3)
-    except DogBootloaderNoDeviceFound:
-        print('NO DEVICE FOUND')
-        sys.exit(4)
-    except DogBootloaderVerifyError:
-        print('Programmed data mismatch')
-        print('ERROR')
-        sys.exit(5)
+    except Exception as e:
+        handled = failure(e)
+        if handled is None:
+            raise
 
+        lines, code = handled
+        for line in lines:
+            print(line)
+        sys.exit(code)
+
+if __name__ == '__main__':
+    dogtool.main('d20bootloader')
@@ -1,28 +1,44 @@
 #!/usr/bin/env python3
 import click
-import crcmod
 import datetime
 import errno
 import hid
 import math
 import os
-import progressbar
 import struct
 import sys
 import time
 import json
 import logging
-import subprocess
 
+import dogcrc
+import dogenum
+import doghwid
+import dogtool
+import dogtransport
+
+from dogcrc import first_difference
+
+from dogenum import JUPITER_BOOTLOADER_USB_VID, JUPITER_BOOTLOADER_USB_PID, \
+                    JUPITER_USB_PID, JUPITER_USB_INTERFACE, \
+                    dog_enumerate, get_dev_build_timestamp
+
+#
+# click is needed to parse any command line. progressbar, and the
+# dogcatalog and dogwait helpers are only imported by the code that
+# uses them, so that commands not needing them start faster.
+#
 LOG = logging.getLogger(__name__)
-LOG.setLevel(logging.INFO)
 
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
+def setup_logging():
+    LOG.setLevel(logging.INFO)
+
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
 
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-ch.setFormatter(formatter)
-LOG.addHandler(ch)
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    ch.setFormatter(formatter)
+    LOG.addHandler(ch)
 
 ID_GET_ATTRIBUTES_VALUES    = 0x83
 ID_REBOOT_INTO_ISP          = 0x90
@@ -77,10 +93,6 @@ MAX_SERIAL_LENGTH           = 30
 DEVICE_INFO_MAGIC	    = 0xBEEFFACE
 DEVICE_HEADER_VERSION       = 1
 
-HW_ID_D20_HYBRID = 29
-HW_ID_D21_HYBRID = 30
-HW_ID_D21_HOMOG  = 31
-
 
 #
 # To allow working with old 8KB bootloader, some constanst below can be
@@ -110,20 +122,38 @@ APP_FW_END                  = FLASH_SIZE - 4 * 1024
 APP_FW_INFO                 = APP_FW_END - 4
 APP_FW_LENGTH               = APP_FW_INFO- APP_FW_START
 
-JUPITER_BOOTLOADER_USB_VID  = 0x28de
-JUPITER_BOOTLOADER_USB_PID  = int(os.getenv('JUPITER_BOOTLOADER_USB_PID', '0x1004'), 16)
-JUPITER_USB_PID             = int(os.getenv('JUPITER_USB_PID', '0x1205'), 16)
-JUPITER_USB_INTERFACE       = 2
 
-USB_ENUMERATION_DELAY_S     = 5.0
+#
+# While the MCU erases, ACKs are polled at a pace set by how long the
+# erase should take: the wait is split in halves until it's due, then
+# backed off while it's overdue. Polls are never closer than
+# ACK_POLL_MIN_S or further apart than ACK_POLL_MAX_S, and an erase
+# that's still busy after ACK_TIMEOUT_S, or ACK_TIMEOUT_FACTOR times
+# its expected duration if that's longer, times out.
+#
+FLASH_ROW_ERASE_S           = 0.004
+ACK_POLL_MIN_S              = 0.001
+ACK_POLL_MAX_S              = 0.05
+ACK_TIMEOUT_S               = 20.0
+ACK_TIMEOUT_FACTOR          = 4
 
-CRCFUN   = crcmod.mkCrcFun(0x104C11DB7)
 CRCALIGN = 4
 
 def compute_crc(data, total_size=APP_FW_LENGTH):
-    l = len(data)
-    data = bytes(data) + bytes(0xFF for _ in range(0, total_size - len(data)))
-    return CRCFUN(data, 0)
+    return dogcrc.compute_crc(data, total_size)
+
+def row_of(offset):
+    return offset - offset % FLASH_ERASE_SIZE
+
+def expected_erase_time(blob_id):
+    #
+    # How long erasing `blob_id` should take: the whole app for
+    # firmware, one row for the rest
+    #
+    if blob_id in (BLOB_ID_FIRMWARE, BLOB_ID_FIRMWARE_OTHER):
+        return math.ceil(APP_FW_LENGTH / FLASH_ERASE_SIZE) * FLASH_ROW_ERASE_S
+
+    return FLASH_ROW_ERASE_S
 
 class DogBootloaderBadReply(Exception):
     pass
@@ -134,9 +164,23 @@ class DogBootloaderUpdateError(Exception):
 class DogBootloaderTimeout(Exception):
     pass
 
-class DogBootloaderVerifyError(Exception):
+class DogBootloaderBootError(Exception):
+    #
+    # The app didn't come up as programmed, see wait_for_boot()
+    #
     pass
 
+class DogBootloaderVerifyError(Exception):
+    #
+    # Flash differs from the image from `offset` on, which lies in
+    # the erase row starting at `row`
+    #
+    def __init__(self, offset, row):
+        super(DogBootloaderVerifyError, self).__init__(
+            'First mismatch at 0x{:08x}, row 0x{:08x}'.format(offset, row))
+        self.offset = offset
+        self.row    = row
+
 class MsgBadReply(Exception):
     pass
 
@@ -240,6 +284,7 @@ class DogBootloaderProgressBar:
         self.verbose = verbose
 
         if self.verbose:
+            import progressbar
             self.bar = progressbar.ProgressBar(widgets=widgets, max_value=max_value)
 
     def start(self):
@@ -256,11 +301,13 @@ class DogBootloaderProgressBar:
 
 class DogBootloaderEraseSpinner(DogBootloaderProgressBar):
     def __init__(self, verbose):
+        import progressbar
         widgets=['Erasing: ', progressbar.AnimatedMarker()]
         super(DogBootloaderEraseSpinner, self).__init__(verbose, widgets)
 
 class DogBootloaderProgressBar(DogBootloaderProgressBar):
     def __init__(self, name, verbose, max_value):
+        import progressbar
         widgets=[name,
                  progressbar.Bar(left='[', right=']'),
                  ' ',
@@ -270,50 +317,31 @@ class DogBootloaderProgressBar(DogBootloaderProgressBar):
         ]
         super(DogBootloaderProgressBar, self).__init__(verbose, widgets, max_value)
 
-if sys.platform == 'win32':
-    def dog_enumerate(pid=JUPITER_USB_PID):
-        return [d for d in hid.enumerate(JUPITER_BOOTLOADER_USB_VID, pid)
-                if d['usage_page'] >= 0xFF00]
-else:
-    def dog_enumerate(pid=JUPITER_USB_PID):
-        devs = hid.enumerate(JUPITER_BOOTLOADER_USB_VID, pid)
-
-        iface_number = JUPITER_USB_INTERFACE if pid == JUPITER_USB_PID else 0
+def dog_wait(pid, message, serial=None, verbose=True, find=None):
+    import dogwait
+    import progressbar
 
-        if len(devs) > 1:
-            devs = [d for d in devs if
-                    d['interface_number'] == iface_number]
-
-        return devs
-
-def dog_wait(pid, message):
-    spinner = progressbar.ProgressBar(widgets=[message, progressbar.AnimatedMarker()])
-    spinner.start()
-
-    timeout = USB_ENUMERATION_DELAY_S    # seconds
-    delay   = 0.1
-    dev     = None
-    for i in range(int(timeout / delay)):
-        dev = dog_enumerate(pid=pid)
-        spinner.update(i)
-        if dev:
-            break;
-
-        time.sleep(delay)
+    if verbose:
+        spinner = progressbar.ProgressBar(widgets=[message, progressbar.AnimatedMarker()])
+        spinner.start()
     #
-    # HACK: Not sure why a sleep here is necessary, but it
-    # seems that hid.enumerate() can retrun a positive
-    # result before it can be opened with hidapi.hid_open
-    # ¯\_(ツ)_/¯
+    # A device is only ready once it can be opened, which can be a
+    # while after it enumerates
     #
-    timeout = USB_ENUMERATION_DELAY_S    # seconds
-    delay   = 0.1
-    for i in range(int(timeout / delay)):
-        spinner.update(i)
-        time.sleep(delay)
+    try:
+        if find is None:
+            find = lambda: next(iter(dog_enumerate(pid, serial)), None)
+        iface, dev = dogwait.wait_for_device(find,
+                                             timeout=dogwait.USB_ENUMERATION_TIMEOUT_S,
+                                             tick=spinner.update if verbose else None)
+        dev.close()
+        devs = [iface]
+    except dogwait.DogWaitTimeout:
+        devs = []
 
-    spinner.finish()
-    return dev
+    if verbose:
+        spinner.finish()
+    return devs
 
 
 class DogBootloader:
@@ -346,40 +374,60 @@ class DogBootloader:
         0xFF : "disconnected",
     }
 
-    def __init__(self, verbose=False, minimal_init=False, reset=True):
+    def __init__(self, verbose=False, minimal_init=False, reset=True, serial=None):
+        #
+        # USB serial number of the controller to use, the one picked
+        # on the command line by default. It's the same in the app and
+        # the bootloader.
+        #
+        self.serial = SERIAL if serial is None else serial
+        serial      = self.serial
+
         if minimal_init:
-            self.hiddev = hid.Device(JUPITER_BOOTLOADER_USB_VID,
-                                     JUPITER_BOOTLOADER_USB_PID)
+            self.hiddev = dogtransport.open_device(JUPITER_BOOTLOADER_USB_VID,
+                                                  JUPITER_BOOTLOADER_USB_PID, serial)
         else:
             #
             # App firmware would have three HID interfaces,
             # so we need to select the right one. Ours is the one with
             # vendor usage page, so select it.
             #
-            dev = dog_enumerate()
+            dev = dog_enumerate(serial=serial)
             if dev:
                 if reset:
                     LOG.info('Looks like we are running an app. Resetting into bootloader')
-                    with hid.Device(path=dev[0]['path']) as self.hiddev:
+                    with dogtransport.open_device(path=dev[0]['path']) as self.hiddev:
+                        attribs = self.attributes()
+                        self.app_build_timestamp = \
+                            attribs.get(HID_ATTRIB_FIRMWARE_BUILD_TIME)
+                        self.app_secondary_build_timestamp = \
+                            attribs.get(HID_ATTRIB_SECONDARY_FIRMWARE_BUILD_TIME)
                         self._reboot_into_isp()
                 else:
-                    self.hiddev = hid.Device(path=dev[0]['path'])
+                    self.hiddev = dogtransport.open_device(path=dev[0]['path'])
                     return
 
                 dog_wait(pid=JUPITER_BOOTLOADER_USB_PID,
-                         message='Switching to ISP mode: ')
+                         message='Switching to ISP mode: ',
+                         serial=serial, verbose=verbose)
 
-                self.hiddev = hid.Device(JUPITER_BOOTLOADER_USB_VID,
-                                         JUPITER_BOOTLOADER_USB_PID)
+                self.hiddev = dogtransport.open_device(JUPITER_BOOTLOADER_USB_VID,
+                                                      JUPITER_BOOTLOADER_USB_PID, serial)
 
             else:
-                self.hiddev = hid.Device(JUPITER_BOOTLOADER_USB_VID,
-                                         JUPITER_BOOTLOADER_USB_PID)
+                self.hiddev = dogtransport.open_device(JUPITER_BOOTLOADER_USB_VID,
+                                                      JUPITER_BOOTLOADER_USB_PID, serial)
                 if reset:
                     self.reset()
                     time.sleep(1)
 
         self.verbose = verbose
+        #
+        # ACK polls and seconds spent waiting for ACKs through this
+        # handle, to tune the pacing above with
+        #
+        self.ack_polls  = 0
+        self.ack_wait   = 0.0
 
     def __enter__(self):
         return self
@@ -409,47 +457,85 @@ class DogBootloader:
         #
         self._reboot_into_isp()
 
+    def snapshot(self):
+        #
+        # Everything info() shows, reading the attributes, and the HID
+        # block and device info blob of each side, once
+        #
+        dev     = dogenum.enumerate(JUPITER_BOOTLOADER_USB_VID,
+                                    JUPITER_BOOTLOADER_USB_PID, self.serial)[0]
+        attribs = self.attributes()
+
+        blocks = [self.parse_hid(self._read_debug_data(code))
+                  for code in (DEBUG_READ_HID_THIS, DEBUG_READ_HID_OTHER)]
+
+        blobs = [self.download_blob(BLOB_ID_DEVICE_INFO_THIS)]
+        try:
+            blobs.append(self.download_blob(BLOB_ID_DEVICE_INFO_OTHER))
+        except hid.HIDException:
+            blobs.append(None)
+
+        hw_ids = self._hardware_id(attribs, lambda: blobs[0], lambda: blobs[1])
+
+        mcus = []
+        for side, (_, state, _, uid, reason, user_row), blob, hw_id in \
+                zip(['primary', 'secondary'], blocks, blobs, hw_ids):
+            if blob is None:
+                serial, unit_serial = 'None', 'None'
+            else:
+                _, _, _, _, serial, unit_serial = self.parse_device_info_blob(blob)
+
+            mcus.append({
+                'side'              : side,
+                'board_serial'      : serial,
+                'unit_serial'       : unit_serial,
+                'hardware_id'       : hw_id,
+                'unique_id'         : uid,
+                'user_row'          : list(user_row),
+                'bootloader_reason' : self.BOOTLOADER_REASON.get(reason, "unknown"),
+                'state'             : self.STATE.get(state, "unknown"),
+            })
+
+        return {
+            'path'               : dev['path'].decode(),
+            'vid'                : dev['vendor_id'],
+            'pid'                : dev['product_id'],
+            'device_type'        : dev['release_number'],
+            'bl_build_timestamp' : attribs.get(HID_ATTRIB_FIRMWARE_BUILD_TIME),
+            'mcus'               : mcus,
+        }
+
     def info(self):
+        snapshot = self.snapshot()
+
         LOG.info('Found a D21 bootloader device')
         LOG.info('----------------------------')
-        info = hid.enumerate(JUPITER_BOOTLOADER_USB_VID,
-                             JUPITER_BOOTLOADER_USB_PID)[0]
-
-        LOG.info('Path: {}'.format(info['path'].decode()))
-        LOG.info('VID: 0x{:x}'.format(info['vendor_id']))
-        LOG.info('PID: 0x{:x}'.format(info['product_id']))
+        LOG.info('Path: {}'.format(snapshot['path']))
+        LOG.info('VID: 0x{:x}'.format(snapshot['vid']))
+        LOG.info('PID: 0x{:x}'.format(snapshot['pid']))
         LOG.info('Bootloader Build Time: 0x{:x} ({} UTC)' \
-              .format(self.firmware_build_time,
-                      datetime.datetime.utcfromtimestamp(self.firmware_build_time)))
+              .format(snapshot['bl_build_timestamp'],
+                      datetime.datetime.utcfromtimestamp(snapshot['bl_build_timestamp'])))
 
-        for i, position in enumerate(['Primary', 'Secondary']):
+        for position, mcu in zip(['Primary', 'Secondary'], snapshot['mcus']):
             LOG.info('\n ** {} Unit **'.format(position))
-            LOG.info('Stored board serial: {}'.format(self.board_serial[i]))
-            LOG.info('Stored hardware ID: {}'.format(self.hardware_id[i]))
+            LOG.info('Stored board serial: {}'.format(mcu['board_serial']))
+            LOG.info('Stored hardware ID: {}'.format(mcu['hardware_id']))
             LOG.info('MCU unique ID: {:08X} {:08X} {:08X} {:08X}'
-                  .format(# BE ordering
-                          self.unique_id[i][0],
-                          self.unique_id[i][1],
-                          self.unique_id[i][2],
-                          self.unique_id[i][3]))
+                  .format(*mcu['unique_id'])) # BE ordering
             LOG.info('MCU user row: {:02X} {:02X} {:02X} {:02X} {:02X} {:02X} {:02X} {:02X}'
-                  .format(*self.user_row[i]))
+                  .format(*mcu['user_row']))
 
-            LOG.info('MCU bootloader mode reason: {}'.format(self.bootloader_reason[i]))
-            LOG.info('MCU state: {}'.format(self.state[i]))
+            LOG.info('MCU bootloader mode reason: {}'.format(mcu['bootloader_reason']))
+            LOG.info('MCU state: {}'.format(mcu['state']))
 
         LOG.info('----------------------------')
 
     def timestamp(self):
-        info = hid.enumerate(JUPITER_BOOTLOADER_USB_VID,
-                             JUPITER_BOOTLOADER_USB_PID)[0]
         print(self.firmware_build_time)
 
     def send(self, msg):
-        msg   = bytes(msg)
-        zeros = bytes(0x00 for i in range(len(msg), HID_EP_SIZE))
-
-        self.hiddev.send_feature_report(bytes([0x00]) + msg + zeros)
+        self.hiddev.send_report(bytes(msg))
 
     def recv(self):
         msg = self.hiddev.get_feature_report(0x00, HID_EP_SIZE + 1)
@@ -461,70 +547,90 @@ class DogBootloader:
 
         return MsgGetAttributes(reply=msg[1:])
 
-    def wait(self, retries=50000):
-        for _ in range(0, retries):
-            ack = self.recv()
+    def _pace(self, done, expected, tick=None):
+        #
+        # Calls done() until it returns True, at the pace described
+        # next to ACK_POLL_MIN_S. Returns how many times it was called.
+        #
+        start    = time.monotonic()
+        due      = start + expected
+        deadline = start + max(ACK_TIMEOUT_S, expected * ACK_TIMEOUT_FACTOR)
+        delay    = ACK_POLL_MIN_S
+        polls    = 0
+        try:
+            while True:
+                polls += 1
+                if done():
+                    return polls
+
+                now = time.monotonic()
+                if now >= deadline:
+                    raise DogBootloaderTimeout('ACK timeout')
+                if tick:
+                    tick(polls)
+
+                if now < due:
+                    delay = (due - now) / 2
+                else:
+                    delay = delay * 2
 
-            if ack.code == UPDATE_STATUS_OK:
-                return
-            if ack.code == UPDATE_STATUS_ERROR:
-                raise DogBootloaderUpdateError()
-        else:
-            raise DogBootloaderTimeout('ACK timeout')
+                delay = min(max(delay, ACK_POLL_MIN_S), ACK_POLL_MAX_S)
+                time.sleep(min(delay, deadline - now))
+        finally:
+            self.ack_polls  += polls
+            self.ack_wait   += time.monotonic() - start
 
     def _send_feature_report(self, msg):
-        zeros = [0] * (64 - len(msg))
-        self.hiddev.send_feature_report(bytes([0x00] + msg + zeros))
+        self.hiddev.send_report(msg)
 
     def _get_feature_report(self):
         return self.hiddev.get_feature_report(0x00, 65)
 
-    def _poll_ack(self):
-        retries = 20000
-        max_len = 2
-
-        spinner = DogBootloaderEraseSpinner(self.verbose)
-        try:
-            spinner.start()
-
-            for i in range(0, retries):
-                spinner.update(i)
-
-                report = self._get_feature_report()
+    def _poll_ack(self, blob_id=BLOB_ID_FIRMWARE):
+        def done():
+            report = self._get_feature_report()
 
-                if len(report) < 3:
-                    raise DogBootloaderBadReply("Invalid length")
+            if len(report) < 3:
+                raise DogBootloaderBadReply("Invalid length")
 
-                len_  = report[2]
+            len_  = report[2]
 
-                if len_ != 6 or len(report) < len_ + 3: #FIXME magic numbers
-                    raise DogBootloaderBadReply("Invalid length")
+            if len_ != 6 or len(report) < len_ + 3: #FIXME magic numbers
+                raise DogBootloaderBadReply("Invalid length")
 
-                id_   = report[0]
-                type_ = report[1]
+            id_   = report[0]
+            type_ = report[1]
 
-                if id_ != 0x00:
-                    raise DogBootloaderBadReply("Invalid report ID")
+            if id_ != 0x00:
+                raise DogBootloaderBadReply("Invalid report ID")
 
 
-                _, code = struct.unpack('<IH', bytes(report[3:3 + len_]))
+            _, code = struct.unpack('<IH', bytes(report[3:3 + len_]))
 
-                if type_ == ID_FIRMWARE_UPDATE_ACK:
-                    if   code == UPDATE_STATUS_OK:
-                        break
-                    elif code == UPDATE_STATUS_BUSY:
-                        continue
-                    elif code == UPDATE_STATUS_ERROR:
-                        raise DogBootloaderUpdateError()
-                    else:
-                        raise DogBootloaderBadReply("Invalid update status")
+            if type_ == ID_FIRMWARE_UPDATE_ACK:
+                if   code == UPDATE_STATUS_OK:
+                    return True
+                elif code == UPDATE_STATUS_BUSY:
+                    return False
+                elif code == UPDATE_STATUS_ERROR:
+                    raise DogBootloaderUpdateError()
                 else:
-                    raise DogBootloaderBadReply("Invalid header type")
+                    raise DogBootloaderBadReply("Invalid update status")
             else:
-                raise DogBootloaderTimeout('ACK timeout')
+                raise DogBootloaderBadReply("Invalid header type")
+
+        expected = expected_erase_time(blob_id)
+        start    = time.monotonic()
+        spinner  = DogBootloaderEraseSpinner(self.verbose)
+        try:
+            spinner.start()
+            polls = self._pace(done, expected, tick=spinner.update)
         finally:
             spinner.finish()
 
+        LOG.debug('Erase of blob {} took {:.3f}s (expected {:.3f}s), {} polls'.format(
+            blob_id, time.monotonic() - start, expected, polls))
+
     def _send_data(self, data):
         msg = [
             ID_FIRMWARE_UPDATE_DATA,
@@ -584,6 +690,39 @@ class DogBootloader:
 
         return data
 
+    def _read_debug_into(self, code, view, offset, bar, done=0, expected=None):
+        #
+        # Streams `code` data from `offset` straight into `view`, until
+        # it's full or the bootloader ends the stream. Returns the
+        # number of bytes read. With `expected`, laid out like `view`,
+        # each report is compared with it as it arrives.
+        #
+        self._send_feature_report([ID_FIRMWARE_UPDATE_ACK,
+                                   6,
+                                   *struct.pack('<I', offset),
+                                   *struct.pack('<H', code)])
+        off_ = 3 + 6
+        size = len(view)
+        read = 0
+        while read < size:
+            report = self._get_feature_report()
+
+            len_ = report[2] - 6
+            if len_ <= 0:
+                break
+
+            chunk = min(len_, size - read)
+            view[read : read + chunk] = memoryview(report)[off_ : off_ + chunk]
+            if expected is not None and \
+               view[read : read + chunk] != expected[read : read + chunk]:
+                mismatch = offset + read + first_difference(view[read : read + chunk],
+                                                            expected[read : read + chunk])
+                raise DogBootloaderVerifyError(mismatch, row_of(mismatch))
+            read += chunk
+            bar.update(done + read)
+
+        return read
+
     def set_singleton_mode(self):
         msg = MsgUpdateAck(code=DEBUG_SET_SINGLETON_MODE)
         self.send(msg)
@@ -688,8 +827,7 @@ class DogBootloader:
 
         return crc, magic, ver, hw_id, serial, unit_serial
 
-    @property
-    def firmware_build_time(self):
+    def attributes(self):
         msg = MsgGetAttributes()
         self.send(msg)
 
@@ -697,11 +835,11 @@ class DogBootloader:
 
         assert isinstance(report, MsgGetAttributes)
 
-        for tag, value in report.attribs:
-            if tag == HID_ATTRIB_FIRMWARE_BUILD_TIME:
-                return value
+        return dict(report.attribs)
 
-        return None
+    @property
+    def firmware_build_time(self):
+        return self.attributes().get(HID_ATTRIB_FIRMWARE_BUILD_TIME)
 
     def convert_to_bytes_with_pad(self, input, pad_len):
         if not isinstance(input, bytes):
@@ -711,51 +849,81 @@ class DogBootloader:
         input += bytes(pad_len - len(input)) # This pads w/ zeros
         return input
         
+###############################################################################
+## Device Info
+##
+## Every side-addressed accessor reads only the blob of the MCU it is
+## asked about. Reads of the OTHER side are relayed by the primary MCU
+## and take much longer. A blob is only rewritten if its contents
+## change. The tuple properties below are built on these accessors.
+###############################################################################
+    def read_device_info(self, primary=True):
+        blob = self.download_blob(BLOB_ID_DEVICE_INFO_THIS if primary else
+                                  BLOB_ID_DEVICE_INFO_OTHER)
+        return self.parse_device_info_blob(blob)
+
+    def write_device_info(self, primary=True, hw_id=None, serial=None, unit_serial=None):
+        #
+        # Replaces the given fields of one side's device info, keeping
+        # the others. Returns False if the blob was left as it was.
+        #
+        blob_id = BLOB_ID_DEVICE_INFO_THIS if primary else BLOB_ID_DEVICE_INFO_OTHER
+
+        _, magic, ver, old_hw_id, old_serial, old_unit_serial = \
+            self.parse_device_info_blob(self.download_blob(blob_id))
+
+        new = (old_hw_id       if hw_id       is None else hw_id,
+               old_serial      if serial      is None else serial,
+               old_unit_serial if unit_serial is None else unit_serial)
+
+        if magic == DEVICE_INFO_MAGIC and ver == DEVICE_HEADER_VERSION and \
+           new == (old_hw_id, old_serial, old_unit_serial):
+            return False
+
+        hw_id, serial, unit_serial = new
+        blob = struct.pack('<IIII', 0, DEVICE_INFO_MAGIC,
+                           DEVICE_HEADER_VERSION, hw_id) + \
+               self.convert_to_bytes_with_pad(serial, MAX_SERIAL_LENGTH) + \
+               self.convert_to_bytes_with_pad(unit_serial, MAX_SERIAL_LENGTH)
+
+        self.upload_blob(blob_id, blob)
+        return True
+
 ###############################################################################
 ## Board Serial
 ###############################################################################
-    @property
-    def board_serial(self):
-        blob = self.download_blob(BLOB_ID_DEVICE_INFO_THIS)
-        _, _, _, _, serial_this, _ = self.parse_device_info_blob(blob)
+    def read_board_serial(self, primary=True):
+        _, _, _, _, serial, _ = self.read_device_info(primary)
+        return serial
 
-        blob = self.download_blob(BLOB_ID_DEVICE_INFO_OTHER)
-        _, _, _, _, serial_other, _ = self.parse_device_info_blob(blob)
+    def write_board_serial(self, primary, serial):
+        if isinstance(serial, bytes):
+            serial = serial.decode('ascii')
+        return self.write_device_info(primary, serial=serial)
 
-        return serial_this, serial_other
+    @property
+    def board_serial(self):
+        return self.read_board_serial(True), self.read_board_serial(False)
 
     @board_serial.setter
     def board_serial(self, serial):
         if not isinstance(serial, tuple):
             serial = serial, serial
 
-        for sn, blob_id in zip(serial, [BLOB_ID_DEVICE_INFO_THIS, BLOB_ID_DEVICE_INFO_OTHER]):
+        for sn, primary in zip(serial, [True, False]):
             if sn == None:
                 continue
 
-            sn = self.convert_to_bytes_with_pad(sn, MAX_SERIAL_LENGTH)
-
-            blob = self.download_blob(blob_id)
-            _, _, _, hw_id, _, unit_serial = self.parse_device_info_blob(blob)
-
-            blob = struct.pack('<IIII', 0, DEVICE_INFO_MAGIC,
-                               DEVICE_HEADER_VERSION, hw_id) + sn
-
-            if unit_serial != None:
-                unit_serial = self.convert_to_bytes_with_pad(unit_serial, MAX_SERIAL_LENGTH)
-                blob += unit_serial
-            
-            self.upload_blob(blob_id, blob)
+            self.write_board_serial(primary, sn)
 
 ###############################################################################
 ## Unit Serial
 ###############################################################################
     @property
     def unit_serial(self):
-        blob = self.download_blob(BLOB_ID_DEVICE_INFO_THIS)
-        _, _, _, _, _, board_serial = self.parse_device_info_blob(blob)
+        _, _, _, _, _, unit_serial = self.read_device_info(True)
 
-        return board_serial
+        return unit_serial
 
     @unit_serial.setter
     def unit_serial(self, unit_serial):
@@ -763,53 +931,54 @@ class DogBootloader:
         if unit_serial == None:
             return
 
-        unit_serial = self.convert_to_bytes_with_pad(unit_serial, MAX_SERIAL_LENGTH)
+        if isinstance(unit_serial, bytes):
+            unit_serial = unit_serial.decode('ascii')
 
-        blob = self.download_blob(BLOB_ID_DEVICE_INFO_THIS)
-        _, _, _, hw_id, board_serial, _ = self.parse_device_info_blob(blob)
-
-        if not isinstance(board_serial, bytes):
-            board_serial = board_serial.encode('ascii')
-        board_serial += bytes(MAX_SERIAL_LENGTH - len(board_serial))
-        
-        
-        blob = struct.pack('<IIII', 0, DEVICE_INFO_MAGIC,
-                           DEVICE_HEADER_VERSION, hw_id) + board_serial
-        blob += unit_serial
-            
-        self.upload_blob(BLOB_ID_DEVICE_INFO_THIS, blob)
+        self.write_device_info(True, unit_serial=unit_serial)
 
 ###############################################################################
 ## HW ID
 ###############################################################################
-    @property
-    def hardware_id(self):
-        msg = MsgGetAttributes()
-        self.send(msg)
+    def read_hardware_id(self, primary=True):
+        if primary:
+            return self._hardware_id(self.attributes(),
+                                     lambda: self.download_blob(BLOB_ID_DEVICE_INFO_THIS),
+                                     None)[0]
 
-        report = self.recv()
+        return self._hardware_id({}, None,
+                                 lambda: self.download_blob(BLOB_ID_DEVICE_INFO_OTHER))[1]
 
-        assert isinstance(report, MsgGetAttributes)
+    def write_hardware_id(self, primary, hw_id):
+        return self.write_device_info(primary, hw_id=hw_id)
 
-        hw_id_this = None
-        for tag, value in report.attribs:
-            if tag == HID_ATTRIB_BOARD_REVISION:
-                hw_id_this = value
+    @property
+    def hardware_id(self):
+        return self._hardware_id(self.attributes(),
+                                 lambda: self.download_blob(BLOB_ID_DEVICE_INFO_THIS),
+                                 lambda: self.download_blob(BLOB_ID_DEVICE_INFO_OTHER))
+
+    def _hardware_id(self, attribs, blob_this, blob_other):
+        #
+        # `blob_this` and `blob_other` fetch the device info blobs, if
+        # they are needed. Either can be None to skip that side.
+        # `blob_other` may raise or return None when there's no OTHER
+        # side to read from.
+        #
+        hw_id_this  = attribs.get(HID_ATTRIB_BOARD_REVISION)
+        hw_id_other = None
 
         if self.hiddev.product != "Steam Controller" and self.hiddev.product != "Steam Deck Controller":
-            if not hw_id_this:
-                blob = self.download_blob(BLOB_ID_DEVICE_INFO_THIS)
-                _, _, _, hw_id_this, _, _ = self.parse_device_info_blob(blob)
+            if not hw_id_this and blob_this is not None:
+                _, _, _, hw_id_this, _, _ = self.parse_device_info_blob(blob_this())
 
             try:
-                blob = self.download_blob(BLOB_ID_DEVICE_INFO_OTHER)
-                _, _, _, hw_id_other, _, _ = self.parse_device_info_blob(blob)
+                blob = blob_other() if blob_other is not None else None
+                if blob is not None:
+                    _, _, _, hw_id_other, _, _ = self.parse_device_info_blob(blob)
             except hid.HIDException:
                 # Assume we are talking to D20 bootloader and set
                 # hw_id_other to None
                 hw_id_other = None
-        else:
-            hw_id_other = None
 
         return hw_id_this, hw_id_other
 
@@ -818,50 +987,45 @@ class DogBootloader:
         if not isinstance(hw_id, tuple):
             hw_id = hw_id, hw_id
 
-        for _id, blob_id in zip(hw_id, [BLOB_ID_DEVICE_INFO_THIS, BLOB_ID_DEVICE_INFO_OTHER]):
-            blob = self.download_blob(blob_id)
-            _, _, _, _, serial, unit_serial = self.parse_device_info_blob(blob)
-
-            serial = self.convert_to_bytes_with_pad(serial, MAX_SERIAL_LENGTH)
-            blob = struct.pack('<IIII', 0, DEVICE_INFO_MAGIC,
-                               DEVICE_HEADER_VERSION, _id) + serial
-            if unit_serial != None:
-                unit_serial = self.convert_to_bytes_with_pad(unit_serial, MAX_SERIAL_LENGTH)
-                blob += unit_serial
+        for _id, primary in zip(hw_id, [True, False]):
+            if _id == None:
+                continue
 
-            self.upload_blob(blob_id, blob)
+            self.write_hardware_id(primary, _id)
 
 ###############################################################################
 ## MTE Blob
 ###############################################################################
-    @property
-    def mte_blob(self):
-        blob = self.download_blob(BLOB_ID_DEVICE_BLOB_THIS)
-        mte_blob_this = self.parse_mte_blob(blob)
+    def read_mte_blob(self, primary=True):
+        blob = self.download_blob(BLOB_ID_DEVICE_BLOB_THIS if primary else
+                                  BLOB_ID_DEVICE_BLOB_OTHER)
+        return self.parse_mte_blob(blob)
 
-        blob = self.download_blob(BLOB_ID_DEVICE_BLOB_OTHER)
-        mte_blob_other = self.parse_mte_blob(blob)
+    def write_mte_blob(self, primary, mte_blob_str):
+        if self.read_mte_blob(primary) == mte_blob_str:
+            return False
 
-        return mte_blob_this, mte_blob_other
+        self.set_mte_blob(BLOB_ID_DEVICE_BLOB_THIS if primary else
+                          BLOB_ID_DEVICE_BLOB_OTHER, mte_blob_str)
+        return True
+
+    @property
+    def mte_blob(self):
+        return self.read_mte_blob(True), self.read_mte_blob(False)
 
     @mte_blob.setter
     def mte_blob(self, mte_blob_strs):
         if not isinstance(mte_blob_strs, tuple):
             mte_blob_strs = mte_blob_strs, mte_blob_strs
 
-        for mte_blob_str, blob_id in zip(mte_blob_strs, [BLOB_ID_DEVICE_BLOB_THIS, BLOB_ID_DEVICE_BLOB_OTHER]):
+        for mte_blob_str, primary in zip(mte_blob_strs, [True, False]):
             if mte_blob_str != None:
-                blob_bytes = mte_blob_str.encode('ascii')
-                dummy_crc = b'\xFF\xFF\xFF\xFF'
-                 # First byte is 0 if blob data is present.  Add null termination
-                blob_bytes = dummy_crc + b'\x00' + blob_bytes + b'\x00'
-
-                self.upload_blob(blob_id, blob_bytes)
+                self.write_mte_blob(primary, mte_blob_str)
 
     def erase(self, blob_id=BLOB_ID_FIRMWARE):
         msg = MsgUpdateStart(blob_id)
         self.send(msg)
-        self._poll_ack()
+        self._poll_ack(blob_id)
 
     def upload_blob(self, blob_id, data, crc=None):
         assert blob_id != BLOB_ID_FIRMWARE
@@ -888,10 +1052,15 @@ class DogBootloader:
             off  += FIRMWARE_UPDATE_DATA_LEN
             chunk = data[off : off + FIRMWARE_UPDATE_DATA_LEN]
 
-        self._complete_update(compute_crc(data[4:], FLASH_ERASE_SIZE - 4) \
+        self._complete_update(compute_crc(bytes(data[4:]), FLASH_ERASE_SIZE - 4) \
                               if crc is None else crc)
 
-    def download_blob(self, blob_id, size=FLASH_ERASE_SIZE):
+    def download_blob(self, blob_id, size=FLASH_ERASE_SIZE, expected=None):
+        #
+        # With `expected`, the blob is compared with it while it
+        # streams in, and DogBootloaderVerifyError raised at the first
+        # difference
+        #
         if blob_id == BLOB_ID_FIRMWARE or \
            blob_id == BLOB_ID_FIRMWARE_OTHER:
             offset = APP_FW_START
@@ -917,38 +1086,103 @@ class DogBootloader:
             # Blob is right after device info
             offset += FLASH_ERASE_SIZE
 
-        data = b''
-        for off in range(0, size, 32):
-            data += self._read_debug_data(cmd, size=32, offset=offset + off,
-                                          verbose=verbose)
+        #
+        # One request streams the whole region. If the bootloader ends
+        # the stream early, the rest is requested from where it
+        # stopped, until a request returns nothing. Later requests
+        # only read as much as that stream held, so that they don't
+        # wait for the end of the stream each time.
+        #
+        data  = bytearray(size)
+        view  = memoryview(data)
+        bar   = DogBootloaderProgressBar('Verifying:   ', verbose, size)
+        read  = 0
+        limit = size
+        if expected is not None:
+            expected = memoryview(expected)
+        while read < size:
+            want  = min(limit, size - read)
+            count = self._read_debug_into(cmd, view[read : read + want], offset + read,
+                                          bar, read,
+                                          None if expected is None else
+                                          expected[read : read + want])
+            if not count:
+                break
+            if count < want:
+                limit = count
+            read += count
 
-        return data
+        bar.finish()
+        if expected is not None and read < size:
+            raise DogBootloaderVerifyError(offset + read, row_of(offset + read))
+        view.release()
+        del data[read:]
+        return bytes(data)
+
+    def installed_image(self, name):
+        #
+        # The app reports its build timestamps before we reset it into
+        # the bootloader. If the catalog has the image of the same
+        # family as `name` built at that time, we know exactly what's
+        # in flash. Both MCUs are programmed with the same image, so
+        # that's only known if both run the same build.
+        #
+        import dogcatalog
+
+        timestamp = getattr(self, 'app_build_timestamp', None)
+        if timestamp != getattr(self, 'app_secondary_build_timestamp', None):
+            return None
+
+        entry = dogcatalog.installed(name, timestamp)
+        if entry is None:
+            return None
+
+        LOG.info('Device is running {}'.format(entry.name))
+        return entry.read()
 
-    def upload_firmware(self, name, verify=False):
+    def upload_firmware(self, name, verify=False, installed=None):
         with open(name, "rb") as f:
             blob = f.read()
 
-        with open(name, "rb") as f:
-            self.erase()
+        #
+        # This bootloader can only erase the whole app, so the only
+        # delta it can apply is an empty one
+        #
+        if installed == blob:
+            LOG.info('{} is already installed, skipping upload'.format(os.path.basename(name)))
+            if verify:
+                self.verify_firmware(blob)
+            return
 
-            bar = DogBootloaderProgressBar('Programming: ', self.verbose, len(blob))
-            chunk = f.read(FIRMWARE_UPDATE_DATA_LEN)
-            l = 0
+        self.erase()
 
-            while chunk:
-                self._send_data(list(chunk))
-                l += len(chunk)
-                bar.update(l)
-                chunk = f.read(FIRMWARE_UPDATE_DATA_LEN)
+        bar = DogBootloaderProgressBar('Programming: ', self.verbose, len(blob))
+        crc = dogcrc.DogCrc()
+        off = 0
+        #
+        # The CRC is fed each chunk before it goes out, and the 0xFF
+        # padding along with the last one, so it's final by the time
+        # the last data report is sent
+        #
+        while off < len(blob):
+            chunk = blob[off : off + FIRMWARE_UPDATE_DATA_LEN]
+            crc.update(chunk)
+            if off + len(chunk) == len(blob):
+                crc.pad(APP_FW_LENGTH)
 
-            self._complete_update(compute_crc(blob))
+            self._send_data(list(chunk))
+            off += len(chunk)
+            bar.update(off)
 
-            bar.finish()
+        self._complete_update(crc.value)
+
+        bar.finish()
 
         if verify:
-            programmed = self.download_firmware(len(blob))
-            if programmed != blob:
-                raise DogBootloaderVerifyError()
+            self.verify_firmware(blob)
+
+    def verify_firmware(self, blob):
+        self.download_blob(BLOB_ID_FIRMWARE, len(blob), expected=blob)
 
     def download_firmware(self, size=APP_FW_LENGTH):
         data = self.download_blob(BLOB_ID_FIRMWARE, size)
@@ -985,9 +1219,18 @@ class DogBootloader:
 
         self.upload_blob(blob_id, blob_bytes)
 
+#
+# Serial number of the controller picked with --serial or --path, see
+# dogenum.serial_for()
+#
+SERIAL = None
+
 @click.group()
-def cli():
-    pass
+@click.option('--serial', help='USB serial number of the controller to use')
+@click.option('--path', help='HID path of any interface of the controller to use')
+def cli(serial, path):
+    global SERIAL
+    SERIAL = dogenum.serial_for(serial, path)
 
 @cli.command()
 @click.argument('firmware', type=click.Path(exists=True,
@@ -996,20 +1239,121 @@ def cli():
               help='Read programmed image back and verify it')
 @click.option('--singleton-mode/--no-singleton-mode', default=False,
               help='Ignore secondary MCU when using the device')
-def program(firmware, verify, singleton_mode):
-    with DogBootloader(verbose=True) as bootloader:
-        if singleton_mode:
-            bootloader.set_singleton_mode()
-
-        bootloader.upload_firmware(firmware, verify=verify)
-        bootloader.reboot()
-
-    if dog_wait(pid=JUPITER_USB_PID,
-                message='Waiting for app to enumerate: '):
+@click.option('--delta/--no-delta', default=False,
+              help='Skip programming if the installed image is already the same')
+@click.option('--verify-crc', is_flag=True,
+              help='Reboot with the app CRC checked and confirm the app runs the new build')
+def program(firmware, verify, singleton_mode, delta, verify_crc):
+    if program_device(firmware, verify, singleton_mode, delta, verify_crc):
         print('SUCCESS')
     else:
         print('TIMEOUT')
 
+def handed_over(serial):
+    #
+    # The tool dogtool hands controller `serial` over to, or None if
+    # it's driven by this one. Read without resetting the controller,
+    # in the app or in the bootloader.
+    #
+    with DogBootloader(reset=False, serial=serial) as bootloader:
+        return doghwid.tool_for(bootloader.read_hardware_id(True))
+
+def program_device(firmware, verify=False, singleton_mode=False, delta=False,
+                   verify_crc=False, serial=None, verbose=True):
+    #
+    # Returns False if the app didn't come back
+    #
+    if serial is not None:
+        tool = handed_over(serial)
+        if tool:
+            raise DogBootloaderUpdateError(f"{serial} is driven by {tool}")
+
+    with DogBootloader(verbose=verbose, serial=serial) as bootloader:
+        program_bootloader(bootloader, firmware, verify, singleton_mode, delta, verify_crc)
+
+    if verify_crc:
+        return wait_for_boot(firmware, bootloader.serial, verbose)
+
+    return bool(dog_wait(pid=JUPITER_USB_PID,
+                         message='Waiting for app to enumerate: ',
+                         serial=bootloader.serial, verbose=verbose))
+
+def program_bootloader(bootloader, firmware, verify=False, singleton_mode=False, delta=False,
+                       verify_crc=False):
+    #
+    # `program` on an open bootloader, up to the reboot. dogd.py keeps
+    # the bootloader open between requests. Takes every option
+    # `program` does.
+    #
+    if singleton_mode:
+        bootloader.set_singleton_mode()
+
+    installed = bootloader.installed_image(firmware) if delta else None
+    bootloader.upload_firmware(firmware, verify=verify, installed=installed)
+    if verify_crc:
+        bootloader.set_force_crc_check()
+    bootloader.reboot()
+
+def wait_for_boot(firmware, serial=None, verbose=True):
+    #
+    # After a reboot with the app CRC check forced, which takes one
+    # reboot cycle where reading the image back takes a round trip per
+    # 32 bytes: waits for the app, which has to report the build of
+    # `firmware`, or for the bootloader, which tells why the app didn't
+    # start. Returns False if neither came back.
+    #
+    import dogwait
+
+    def find(pid):
+        return next(iter(dog_enumerate(pid, serial)), None)
+
+    bootloader = dogwait.once_gone(lambda: find(JUPITER_BOOTLOADER_USB_PID))
+    devs = dog_wait(pid=None, message='Waiting for app to enumerate: ',
+                    serial=serial, verbose=verbose,
+                    find=lambda: find(JUPITER_USB_PID) or bootloader())
+    if not devs:
+        return False
+
+    if devs[0]['product_id'] == JUPITER_BOOTLOADER_USB_PID:
+        with DogBootloader(verbose=verbose, reset=False, serial=serial) as bootloader:
+            this, other = bootloader.bootloader_reason
+        raise DogBootloaderBootError(
+            'Back in the bootloader, this MCU: {}, other MCU: {}'.format(this, other))
+
+    error = dogenum.check_app_builds(firmware, serial=serial)
+    if error:
+        raise DogBootloaderBootError(error)
+
+    return True
+
+@cli.command(name='program-all')
+@click.argument('firmware', type=click.Path(exists=True,
+                                            dir_okay=False))
+@click.option('--verify/--no-verify', default=False,
+              help='Read programmed image back and verify it')
+@click.option('--delta/--no-delta', default=False,
+              help='Skip programming if the installed image is already the same')
+@click.option('--verify-crc', is_flag=True,
+              help='Reboot with the app CRC checked and confirm the app runs the new build')
+def program_all(firmware, verify, delta, verify_crc):
+    #
+    # Programs every controller this tool drives at once, each on its
+    # own thread
+    #
+    serials = [serial for serial, device_type in dogenum.get_controllers().items()
+               if dogtool.DEVICE_TYPES.get(device_type) == __name__]
+    if SERIAL is not None:
+        serials = [serial for serial in serials if serial == SERIAL]
+    serials = [serial for serial in serials if not handed_over(serial)]
+
+    def program_one(serial):
+        if not program_device(firmware, verify, delta=delta, verify_crc=verify_crc,
+                              serial=serial, verbose=False):
+            raise DogBootloaderTimeout("Timed out waiting for the app")
+
+    if not dogenum.print_results(dogenum.run_per_controller(program_one, serials)):
+        sys.exit(1)
+
 @cli.command()
 @click.option('--singleton-mode/--no-singleton-mode', default=False,
               help='Ignore secondary MCU when using the device')
@@ -1033,116 +1377,64 @@ def info():
         bootloader.info()
     print('SUCCESS')
 
+@cli.command()
+@click.option('--json', 'as_json', is_flag=True, help='Print as JSON')
+def getall(as_json):
+    with DogBootloader(verbose=True) as bootloader:
+        snapshot = bootloader.snapshot()
+
+    if as_json:
+        print(json.dumps(snapshot))
+        return
+
+    for key, value in snapshot.items():
+        if key != 'mcus':
+            print('{}: {}'.format(key, value))
+    for mcu in snapshot['mcus']:
+        for key, value in mcu.items():
+            if key != 'side':
+                print('{} {}: {}'.format(mcu['side'], key, value))
+    print('SUCCESS')
+
 @cli.command(name='getblbuildtimestamp')
 def blbuildtimestamp():
     with DogBootloader(verbose=True) as bootloader:
         bootloader.timestamp()
     print('SUCCESS')
 
-def get_dev_build_timestamp(dev):
-    hiddev = hid.Device(path=dev['path'])
-
-    msg   = MsgGetAttributes()
-    msg   = bytes(msg)
-    zeros = bytes(0x00 for i in range(len(msg), HID_EP_SIZE))
-
-    hiddev.send_feature_report(bytes([0x00]) + msg + zeros)
-
-    report = hiddev.get_feature_report(0x00, HID_EP_SIZE + 1)
-    report = MsgGetAttributes(reply=report[1:])
-    assert isinstance(report, MsgGetAttributes)
-
-    primary_timestamp = 0
-    secondary_timestamp = 0
-    for tag, value in report.attribs:
-        if tag == HID_ATTRIB_FIRMWARE_BUILD_TIME:
-          primary_timestamp = value
-        elif tag == HID_ATTRIB_SECONDARY_FIRMWARE_BUILD_TIME:
-          secondary_timestamp = value
-    return primary_timestamp, secondary_timestamp
-
 @cli.command(name='getdevicesjson')
 def get_devices_json():
-  rawdevs = [ *dog_enumerate(JUPITER_USB_PID), *dog_enumerate(JUPITER_BOOTLOADER_USB_PID) ]
-  devs = [ { **item,
-             'build_timestamp': get_dev_build_timestamp(item)[0],
-             'secondary_build_timestamp': get_dev_build_timestamp(item)[1],
-             'is_bootloader': item['product_id'] == JUPITER_BOOTLOADER_USB_PID,
-             'path': item['path'].decode('utf-8') }
-           for item in rawdevs ]
-
-  print(json.dumps(devs))
+    dogenum.getdevicesjson(JUPITER_USB_PID, JUPITER_BOOTLOADER_USB_PID)
 
 @cli.command(name='getappbuildtimestamp')
 def get_app_build_timestamp():
-    vid = JUPITER_BOOTLOADER_USB_VID
-    pid = JUPITER_USB_PID
-
-    if sys.platform == 'win32':
-        devs =  [d for d in hid.enumerate(vid, pid)
-            if d['usage_page'] >= 0xFF00]
-    else:
-        devs = hid.enumerate(vid, pid)
-
-    if len(devs) > 1:
-        devs = [d for d in devs if
-                d['interface_number'] == JUPITER_USB_INTERFACE]
-
-    # Disallow report when multiple controllers are connected
-    if len(devs) > 1:
-        print('Multiple controllers detected.')
-        print('ERROR')
-        return
-
-    if len(devs) == 0:
-        print('No Controller found at VID: {} PID: {}'.format(hex(vid), hex(pid)))
-        print('ERROR')
-        return
-
-    print(get_dev_build_timestamp(devs[0])[0])
-    print('SUCCESS')
+    dogenum.getappbuildtimestamp(JUPITER_BOOTLOADER_USB_VID, JUPITER_USB_PID, serial=SERIAL)
 
 @cli.command(name='gethwid')
 @click.option('--primary/--secondary', default=True)
 @click.option('--clean', is_flag=True, help="Clean output")
 def get_hwid(primary, clean):
     with DogBootloader(verbose=True) as bootloader:
-        if primary:
-            if clean:
-                print(bootloader.hardware_id[0])
-            else:
-                print ('HW ID: {}'.format(bootloader.hardware_id[0]))
-                print('SUCCESS')
+        hardware_id = bootloader.read_hardware_id(primary)
+        if clean:
+            print(hardware_id)
         else:
-            if clean:
-                print(bootloader.hardware_id[1])
-            else:
-                print ('HW ID: {}'.format(bootloader.hardware_id[1]))
-                print('SUCCESS')
+            print ('HW ID: {}'.format(hardware_id))
+            print('SUCCESS')
 
 @cli.command(name='sethwid')
 @click.option('--primary/--secondary', default=True)
 @click.argument('hardware_id', type=int)
 def set_hardware_id(primary, hardware_id):
     with DogBootloader(verbose=True) as bootloader:
-        hwid_primary, hwid_secondary = bootloader.hardware_id
-
-        if primary:
-            hwid_primary = hardware_id
-        else:
-            hwid_secondary = hardware_id
-
-        bootloader.hardware_id = (hwid_primary, hwid_secondary)
+        bootloader.write_hardware_id(primary, hardware_id)
     print('SUCCESS')
 
 @cli.command(name='getserial')
 @click.option('--primary/--secondary', default=True)
 def get_serial(primary):
     with DogBootloader(verbose=True) as bootloader:
-        if primary:
-            print ('Serial: {}'.format(bootloader.board_serial[0]))
-        else:
-            print ('Serial: {}'.format(bootloader.board_serial[1]))
+        print ('Serial: {}'.format(bootloader.read_board_serial(primary)))
 
     print('SUCCESS')
 
@@ -1151,12 +1443,7 @@ def get_serial(primary):
 @click.argument('serial', type=str)
 def set_serial(primary, serial):
     with DogBootloader(verbose=True) as bootloader:
-        serial_primary, serial_secondary = bootloader.board_serial
-        if primary:
-            serial_primary = serial
-        else:
-            serial_secondary = serial
-        bootloader.board_serial = (serial_primary, serial_secondary)
+        bootloader.write_board_serial(primary, serial)
     print('SUCCESS')
 
 @cli.command(name='getunitserial')
@@ -1176,10 +1463,7 @@ def set_unitserial(unitserial):
 @click.option('--primary/--secondary', default=True)
 def getblob(primary):
     with DogBootloader(verbose=True) as bootloader:
-        if primary:
-            blob_str = bootloader.mte_blob[0]
-        else:
-            blob_str = bootloader.mte_blob[1]
+        blob_str = bootloader.read_mte_blob(primary)
 
     print('BLOB DATA: "{}"'.format(blob_str))
     print('SUCCESS')
@@ -1189,14 +1473,7 @@ def getblob(primary):
 @click.argument('blob_str', type=str)
 def setblob(primary, blob_str):
     with DogBootloader(verbose=True) as bootloader:
-        mte_blob_str_this, mte_blob_str_other = bootloader.mte_blob
-
-        if primary:
-            mte_blob_str_this = blob_str
-        else:
-            mte_blob_str_other = blob_str
-
-        bootloader.mte_blob = (mte_blob_str_this, mte_blob_str_other)
+        bootloader.write_mte_blob(primary, blob_str)
     print('SUCCESS')
 
 @cli.command(name='reset')
@@ -1205,25 +1482,50 @@ def cmd_reset():
         bootloader.reboot()
     print('SUCCESS')
 
-if __name__ == '__main__':
+#
+# What main() prints, and exits with, for the errors it handles.
+# dogd.py reports errors of the requests it serves from here too.
+#
+FAILURES = (
+    (hid.HIDException,         ['{message}', 'ERROR'], 0),
+    (DogBootloaderTimeout,     ['Timeout waiting for Flash erase', 'ERROR'], 0),
+    (DogBootloaderVerifyError, ['Programmed data mismatch', '{message}', 'ERROR'], 0),
+    (DogBootloaderBootError,   ['Programmed app failed to boot', '{message}', 'ERROR'], 0),
+)
+
+def failure(e):
+    #
+    # The lines printed for error `e` and the exit code, or None if
+    # main() doesn't handle it
+    #
+    for cls, lines, code in FAILURES:
+        if isinstance(e, cls):
+            return [line.format(message=e) for line in lines], code
+
+    return None
+
+def main(probe=True):
+    setup_logging()
+
     try:
-        with DogBootloader(reset=False) as d:
-            hardware_id = d.hardware_id[0]
+        if probe:
+            with DogBootloader(reset=False, serial=dogtool.selected()) as d:
+                hardware_id = d.read_hardware_id(True)
 
-        if hardware_id in { HW_ID_D20_HYBRID, HW_ID_D21_HYBRID, HW_ID_D21_HOMOG }:
-            # print(f'Redirecting to d20bootloader.py due to HW ID of {hardware_id}')
-            python = "python" if sys.platform == 'win32' else "python3"
-            ret = subprocess.call([python, os.path.join(os.path.dirname(__file__),
-                                                        "d20bootloader.py")] + sys.argv[1:])
-            sys.exit(ret)
+            tool = doghwid.tool_for(hardware_id)
+            if tool:
+                dogtool.run(tool)
 
         cli()
-    except hid.HIDException as e:
-        print(e)
-        print('ERROR')
-    except DogBootloaderTimeout:
-        print('Timeout waiting for Flash erase')
-        print('ERROR')
-    except DogBootloaderVerifyError:
-        print('Programmed data mismatch')
-        print('ERROR')
+    except Exception as e:
+        handled = failure(e)
+        if handled is None:
+            raise
+
+        lines, code = handled
+        for line in lines:
+            print(line)
+        sys.exit(code)
+
+if __name__ == '__main__':
+    dogtool.main('d21bootloader16')
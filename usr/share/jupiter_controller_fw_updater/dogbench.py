@@ -0,0 +1,909 @@
+#!/usr/bin/env python3
+#
+# Flashing benchmarks. Runs the real code paths of d20bootloader.py
+# and d21bootloader16.py against the emulated controller in dogemu.py
+# and reports, per phase:
+#
+#   device_s   - time the phase would take on hardware, as modelled by
+#                the emulator's virtual clock
+#   host_s     - wall time the host actually spent
+#   reports    - feature reports exchanged (one HID round trip each)
+#   reports/s  - reports per modelled second
+#   bytes/s    - payload bytes moved per modelled second
+#   saved      - round trips d20bootloader answered from its cache
+#   polls      - ACK polls d21bootloader16 sent while the MCU erased
+#
+# Example:
+#
+#   ./dogbench.py flash --device all
+#   ./dogbench.py flash --device ra4 --json
+#
+# `startup` instead times cold starts: from launching a tool in a new
+# interpreter until it sends or reads its first HID report.
+#
+#   ./dogbench.py startup --entry dogtool.py --command getdevicesjson
+#   ./dogbench.py startup --no-cache --bundle jupiter-controller-fw.pyz
+#
+# `daemon` runs the command lines jupiter-controller-update would,
+# each through the tool's entry point, once on their own and once
+# served by dogd.py, and reports each the same way as `flash`.
+#
+#   ./dogbench.py daemon --device d2x
+#
+# `devices` times listing devices as getdevicesjson does, with the
+# emulator's latencies really elapsing so that concurrent queries
+# overlap. A single controller should be listed within
+# DEVICES_TARGET_MS.
+#
+#   ./dogbench.py devices --controllers 4 --threads 1
+#
+# `parallel` times program-all on one controller and on several, on a
+# RealClock running `scale` times faster than hardware, and reports
+# the aggregate throughput against that of a single unit.
+#
+#   ./dogbench.py parallel --device d21 --controllers 4
+#
+# `dual` times updating both MCUs of a D21/D20 hybrid, as separate
+# `program --secondary` and `program --primary` runs and as one
+# program-dual run, also on a RealClock.
+#
+#   ./dogbench.py dual --scale 0.1
+#
+# `verify` times programming a unit without verifying, reading the
+# image back, and rebooting with the app CRC checked by the bootloader
+# (--verify-crc).
+#
+#   ./dogbench.py verify --device d2x
+#
+# `transport` times feature report round trips (an attributes request
+# and its reply) through each backend of dogtransport.py, in a fresh
+# interpreter per backend. With `--path` it talks to that hidraw node
+# of a real controller, otherwise to the emulator, which answers
+# without latency, leaving the host cost. There, hidraw's ioctls are
+# emulated too, so only its framing is measured.
+#
+#   ./dogbench.py transport --path /dev/hidraw3 --runs 2000
+#
+import click
+import contextlib
+import glob
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(__file__))
+
+import dogcatalog
+import dogemu
+
+#
+# The tools import hid when they load, so they are only imported by
+# install(), once the emulator stands in for it. Importing dogbench
+# leaves the real hid module alone.
+#
+EMULATOR        = dogemu.DogEmulator()
+d20bootloader   = None
+d21bootloader16 = None
+dogenum         = None
+
+FIRMWARE_DIR      = os.path.dirname(os.path.abspath(__file__))
+DEVICES_TARGET_MS = 50
+
+#
+# name: (device type, HW ID, MCU, image family)
+#
+SCENARIOS = {
+    'd21' : (dogemu.DeviceType.D21_D21, None, None, 'D21'),
+    'd2x' : (dogemu.DeviceType.D2x_D21, 30, 'PRIMARY', 'D21'),
+    'd20' : (dogemu.DeviceType.D2x_D21, 30, 'SECONDARY', 'D20'),
+    'ra4' : (dogemu.DeviceType.RA4, None, 'PRIMARY', 'RA4'),
+}
+
+
+def install():
+    #
+    # Puts the emulator in place of hid, then imports the tools against it
+    #
+    global d20bootloader, d21bootloader16, dogenum
+
+    dogemu.install(EMULATOR)
+
+    import d20bootloader
+    import d21bootloader16
+    import dogenum
+
+    dogemu.install(EMULATOR, d20bootloader, d21bootloader16)
+
+
+def scenario_of(name):
+    #
+    # SCENARIOS entry with the MCU name resolved to d20bootloader's enum
+    #
+    device_type, hw_id, mcu, family = SCENARIOS[name]
+    if mcu is not None:
+        mcu = d20bootloader.DogBootloaderMCU[mcu]
+    return device_type, hw_id, mcu, family
+
+
+#
+# Runs in a fresh interpreter: emulates a device, runs a tool script as
+# __main__ and reports when it sends or reads its first HID report.
+# The emulator's own imports are paid before `ready` is taken.
+#
+STARTUP_HARNESS = """
+import os, runpy, sys, time
+sys.path.insert(0, {directory!r})
+import dogemu
+emulator = dogemu.DogEmulator()
+emulator.add_controller(dogemu.DeviceType({device_type}))
+dogemu.install(emulator)
+ready = time.monotonic()
+
+def first_report(*args, **kwargs):
+    os.write(2, f'\\nDOGBENCH {{ready}} {{time.monotonic()}}\\n'.encode())
+    os._exit(0)
+
+dogemu.Device.send_feature_report = first_report
+dogemu.Device.get_feature_report  = first_report
+sys.argv = {argv!r}
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+TRANSPORT_HARNESS = """
+import statistics, sys, time
+sys.path.insert(0, {directory!r})
+path = {path!r}
+if path is None:
+    import dogemu
+    emulator = dogemu.DogEmulator(timing=dogemu.DogTiming(transfer_s=0))
+    emulator.add_controller(dogemu.DeviceType.D2x_D21)
+    dogemu.install(emulator, hidraw={backend!r} == 'hidraw')
+    import dogenum
+    path = dogenum.dog_enumerate()[0]['path']
+
+import dogtransport
+dogtransport.BACKEND = {backend!r}
+msg   = bytes([dogtransport.ID_GET_ATTRIBUTES_VALUES, 0])
+times = []
+with dogtransport.open_device(path=path) as dev:
+    for _ in range({runs}):
+        start = time.perf_counter()
+        dev.send_report(msg)
+        dev.get_report()
+        times.append(time.perf_counter() - start)
+
+print('DOGBENCH', dev.backend, statistics.median(times), max(times))
+"""
+
+#
+# Arguments for commands that need some, so that they get as far as
+# talking to the device
+#
+STARTUP_ARGS = {
+    'program'       : lambda: [latest_image('D21')],
+    'program-dual'  : lambda: [latest_image('D21')],
+    'program-all'   : lambda: [latest_image('D21')],
+    'sethwid'       : lambda: ['30'],
+    'setserial'     : lambda: ['FVAA20000000'],
+    'setunitserial' : lambda: ['FVAA20000000'],
+    'setblob'       : lambda: ['bench'],
+}
+
+
+#
+# Command lines jupiter-controller-update runs for each scenario, with
+# the tool it runs them with
+#
+UPDATE_STEPS = {
+    'd21' : ('d21bootloader16', [['getdevicesjson'],
+                                 ['program', ('D21',)],
+                                 ['getdevicesjson']]),
+    'd2x' : ('d20bootloader',   [['getdevicesjson'],
+                                 ['gethwid', '--clean'],
+                                 ['program', '--secondary', ('D20',)],
+                                 ['program', '--primary', ('D21',)],
+                                 ['getdevicesjson']]),
+    'ra4' : ('d20bootloader',   [['getdevicesjson'],
+                                 ['program', ('RA4',)],
+                                 ['getdevicesjson']]),
+}
+
+
+def latest_image(family):
+    return dogcatalog.load(FIRMWARE_DIR).latest(family).path
+
+
+class DogBench:
+    def __init__(self, emulator=EMULATOR, sparse=True, erase_plan=False, delta=False,
+                 installed=None):
+        self.emulator   = emulator
+        self.sparse     = sparse
+        self.erase_plan = erase_plan
+        self.delta      = delta
+        self.installed  = installed
+        self.results    = []
+
+    def reset(self, device_type, hw_id=None, mcu=None):
+        timestamps = None
+        if self.installed is not None:
+            if mcu == d20bootloader.DogBootloaderMCU.SECONDARY:
+                timestamps = (None, self.installed)
+            else:
+                timestamps = (self.installed, None)
+
+        self.emulator.controllers.clear()
+        self.emulator.add_controller(device_type, hw_id=hw_id, timestamps=timestamps)
+
+    def measure(self, scenario, phase, fn, data_bytes=0, bootloader=None):
+        stats = self.emulator.stats
+        clock = self.emulator.clock
+        saved = getattr(bootloader, 'saved', 0)
+        polls = getattr(bootloader, 'ack_polls', 0)
+
+        stats.reset()
+        device_start = clock.monotonic()
+        host_start   = time.perf_counter()
+
+        with contextlib.redirect_stdout(io.StringIO()), \
+             contextlib.redirect_stderr(io.StringIO()):
+            ret = fn()
+
+        host_s   = time.perf_counter() - host_start
+        device_s = clock.monotonic() - device_start
+        reports  = stats.round_trips
+        saved    = getattr(bootloader, 'saved', 0) - saved
+        polls    = getattr(bootloader, 'ack_polls', 0) - polls
+
+        self.results.append({
+            'scenario'     : scenario,
+            'phase'        : phase,
+            'device_s'     : device_s,
+            'host_s'       : host_s,
+            'reports'      : reports,
+            'sends'        : stats.sends,
+            'gets'         : stats.gets,
+            'enumerations' : stats.enumerations,
+            'data_bytes'   : data_bytes,
+            'reports_per_s': reports / device_s if device_s else 0.0,
+            'bytes_per_s'  : data_bytes / device_s if device_s else 0.0,
+            'saved'        : saved,
+            'polls'        : polls,
+        })
+
+        return ret
+
+    def run_d21(self, scenario, image):
+        tool = d21bootloader16
+        size = os.path.getsize(image)
+
+        self.measure(scenario, 'getdevicesjson', tool.get_devices_json.callback)
+
+        bootloader = self.measure(scenario, 'open',
+                                  lambda: tool.DogBootloader(verbose=False))
+        with bootloader:
+            self.measure(scenario, 'info', bootloader.info)
+            installed = bootloader.installed_image(image) if self.delta else None
+            self.measure(scenario, 'upload',
+                         lambda: bootloader.upload_firmware(image, installed=installed),
+                         size, bootloader=bootloader)
+            self.measure(scenario, 'download',
+                         lambda: bootloader.download_firmware(size), size)
+            self.measure(scenario, 'crc', bootloader.do_crc_fixup, bootloader=bootloader)
+
+            def reboot():
+                bootloader.reboot()
+                tool.dog_wait(pid=tool.JUPITER_USB_PID, message='')
+
+            self.measure(scenario, 'reboot', reboot)
+
+    def run_d20(self, scenario, image, mcu):
+        tool = d20bootloader
+        size = os.path.getsize(image)
+
+        self.measure(scenario, 'getdevicesjson', tool.getdevicesjson.callback)
+
+        bootloader = self.measure(scenario, 'open',
+                                  lambda: tool.DogBootloader(mcu=mcu))
+        with bootloader:
+            self.measure(scenario, 'describe', bootloader.describe,
+                         bootloader=bootloader)
+            self.measure(scenario, 'info', lambda: (bootloader.hardware_id,
+                                                    bootloader.board_serial,
+                                                    bootloader.unit_serial),
+                         bootloader=bootloader)
+            installed = None
+            if self.erase_plan or self.delta:
+                installed = bootloader.installed_image(image)
+            self.measure(scenario, 'upload',
+                         lambda: bootloader.upload_firmware(image,
+                                                            sparse=self.sparse,
+                                                            installed=installed,
+                                                            delta=self.delta,
+                                                            erase_plan=self.erase_plan), size,
+                         bootloader=bootloader)
+            self.measure(scenario, 'download',
+                         lambda: bootloader.download_firmware(size), size,
+                         bootloader=bootloader)
+            self.measure(scenario, 'crc', bootloader.do_crc_fixup,
+                         bootloader.APP_FW_LENGTH, bootloader=bootloader)
+
+            if mcu == tool.DogBootloaderMCU.PRIMARY:
+                self.measure(scenario, 'reboot',
+                             lambda: bootloader.reboot(wait_for_app=True),
+                             bootloader=bootloader)
+
+    def run(self, scenario, image=None):
+        device_type, hw_id, mcu, family = scenario_of(scenario)
+        image = image or latest_image(family)
+
+        self.reset(device_type, hw_id, mcu)
+        if mcu is None:
+            self.run_d21(scenario, image)
+        else:
+            self.run_d20(scenario, image, mcu)
+
+    #
+    # Phase: (readback, CRC check) for run_verify()
+    #
+    VERIFY_MODES = {
+        'program'          : (False, False),
+        'program+readback' : (True, False),
+        'program+crc'      : (False, True),
+    }
+
+    def run_verify(self, scenario, phase, image=None):
+        #
+        # All of `program` on a unit in the app, from the reset into the
+        # bootloader to the app being back
+        #
+        device_type, hw_id, mcu, family = scenario_of(scenario)
+        image = image or latest_image(family)
+        readback, crc = self.VERIFY_MODES[phase]
+
+        self.reset(device_type, hw_id, mcu)
+        if mcu is None:
+            self.measure(scenario, phase,
+                         lambda: d21bootloader16.program_device(image, readback,
+                                                                verify_crc=crc,
+                                                                verbose=False),
+                         os.path.getsize(image))
+        else:
+            self.measure(scenario, phase,
+                         lambda: d20bootloader.program_device(image, True, verify=readback,
+                                                              verify_crc=crc),
+                         os.path.getsize(image))
+
+    def run_chunks(self, scenario, op, buckets):
+        #
+        # Host cost of each 32 byte chunk over a whole region, in
+        # `buckets` equal slices from the first row to the last. With
+        # linear buffers every slice should cost about the same.
+        #
+        device_type, hw_id, mcu, _ = scenario_of(scenario)
+        if mcu is None:
+            raise click.BadParameter(f"{scenario} isn't driven by d20bootloader")
+
+        self.reset(device_type, hw_id, mcu)
+        with d20bootloader.DogBootloader(mcu=mcu) as bootloader:
+            stamps = []
+            if op == 'download':
+                read_32b = bootloader.read_32b
+
+                def timed(offset):
+                    stamps.append(time.perf_counter())
+                    return read_32b(offset)
+
+                bootloader.read_32b = timed
+                bootloader.download_firmware(bootloader.APP_FW_LENGTH)
+            else:
+                offset, size = max(bootloader.rows(), key=lambda r: r[1])
+                write_32b = bootloader.write_32b
+
+                def timed(offset, data):
+                    stamps.append(time.perf_counter())
+                    return write_32b(offset, data)
+
+                bootloader.write_32b = timed
+                bootloader.write_row(offset, bytes(size))
+
+            stamps.append(time.perf_counter())
+
+        costs = [b - a for a, b in zip(stamps, stamps[1:])]
+        step  = max(1, len(costs) // buckets)
+        for i in range(0, len(costs), step):
+            part = costs[i : i + step]
+            self.results.append({
+                'scenario' : scenario,
+                'op'       : op,
+                'chunks'   : f"{i}-{i + len(part) - 1}",
+                'us'       : sum(part) / len(part) * 1e6,
+            })
+
+    def run_daemon(self, scenario, daemon):
+        #
+        # With `daemon`, a dogd.py server runs on a scratch socket for
+        # the length of the scenario
+        #
+        import dogd
+        import dogtool
+
+        device_type, hw_id, _, _ = scenario_of(scenario)
+        tool, steps = UPDATE_STEPS[scenario]
+
+        self.reset(device_type, hw_id)
+        with tempfile.TemporaryDirectory() as scratch:
+            socket = os.path.join(scratch, 'dogd.sock') if daemon else ''
+            server = None
+            if daemon:
+                server = dogd.make_server(socket)
+                threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            saved = dogtool.DOGD_SOCKET, dogtool.USE_DOGD, sys.argv
+            dogtool.DOGD_SOCKET = socket
+            dogtool.USE_DOGD    = daemon
+            try:
+                for step in steps:
+                    args = [latest_image(a[0]) if isinstance(a, tuple) else a for a in step]
+                    sys.argv = [f"{tool}.py", *args]
+
+                    def run():
+                        try:
+                            dogtool.main(tool)
+                        except SystemExit:
+                            pass
+
+                    self.measure(f"{scenario}/dogd" if daemon else scenario, step[0], run)
+            finally:
+                dogtool.DOGD_SOCKET, dogtool.USE_DOGD, sys.argv = saved
+                if server:
+                    server.shutdown()
+                    dogd.close_server(server)
+
+    def run_startup(self, entry, command, device_type, runs, bundle=None, cache=True):
+        #
+        # Wall time from starting `python3 <entry> <command>` until its
+        # first HID report, and the part of it spent after the
+        # emulator was ready, i.e. importing and running the tool.
+        #
+        # With `bundle`, the entry's tool is run from that zipapp
+        # instead. Without `cache`, the loose modules are compiled
+        # afresh on every run, as on a read-only rootfs.
+        #
+        tool = os.path.splitext(entry)[0]
+        args = [*command.split(), *STARTUP_ARGS.get(command, lambda: [])()]
+        env  = dict(os.environ)
+        if not cache:
+            env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+        totals, tools = [], []
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as scratch:
+                directory = FIRMWARE_DIR
+                if not cache:
+                    #
+                    # A copy of the sources without __pycache__; stdlib
+                    # and site-packages keep their cached bytecode, as
+                    # they would on the image
+                    #
+                    directory = scratch
+                    for name in glob.glob(os.path.join(FIRMWARE_DIR, '*.py')):
+                        shutil.copy(name, directory)
+
+                if bundle:
+                    argv  = [os.path.abspath(bundle), *([] if tool == 'dogtool' else [tool]),
+                             *args]
+                    label = f"{os.path.basename(bundle)}:{tool}"
+                else:
+                    argv  = [os.path.join(directory, entry), *args]
+                    label = entry
+
+                harness = STARTUP_HARNESS.format(directory=directory,
+                                                 device_type=int(device_type), argv=argv)
+                start = time.monotonic()
+                proc  = subprocess.run([sys.executable, '-c', harness],
+                                       capture_output=True, text=True, env=env)
+
+            m = re.search(r'^DOGBENCH (\S+) (\S+)$', proc.stderr, re.M)
+            if not m:
+                break
+
+            ready, first = float(m.group(1)), float(m.group(2))
+            totals.append(first - start)
+            tools.append(first - ready)
+
+        self.results.append({
+            'entry'    : label,
+            'command'  : command,
+            'total_ms' : statistics.median(totals) * 1e3 if totals else None,
+            'tool_ms'  : statistics.median(tools) * 1e3 if tools else None,
+        })
+
+    def run_devices(self, controllers, threads, runs):
+        #
+        # Wall time of dogenum.get_devices() with `controllers` Decks
+        # in app mode, queried `threads` at a time
+        #
+        emulator = dogemu.DogEmulator(clock=dogemu.RealClock(), images={})
+        for _ in range(controllers):
+            emulator.add_controller(dogemu.DeviceType.D2x_D21)
+
+        saved = dogenum.MAX_QUERY_THREADS
+        dogemu.install(emulator)
+        try:
+            dogenum.MAX_QUERY_THREADS = threads
+            times = []
+            for _ in range(runs):
+                emulator.stats.reset()
+                start = time.perf_counter()
+                dogenum.get_devices()
+                times.append(time.perf_counter() - start)
+        finally:
+            dogenum.MAX_QUERY_THREADS = saved
+            dogemu.install(self.emulator, d20bootloader, d21bootloader16)
+
+        median = statistics.median(times) * 1e3
+        self.results.append({
+            'controllers' : controllers,
+            'threads'     : threads,
+            'median_ms'   : median,
+            'max_ms'      : max(times) * 1e3,
+            'reports'     : emulator.stats.round_trips,
+            'opens'       : emulator.stats.opens,
+            'target_ms'   : DEVICES_TARGET_MS if controllers == 1 else None,
+        })
+
+    def report_devices(self, as_json=False):
+        if as_json:
+            print(json.dumps(self.results, indent=2))
+            return
+
+        print(f"{'controllers':>11}{'threads':>9}{'median_ms':>11}{'max_ms':>9}"
+              f"{'reports':>9}{'opens':>7}{'target_ms':>11}")
+        for r in self.results:
+            target = '-' if r['target_ms'] is None else r['target_ms']
+            over   = '' if r['target_ms'] is None or r['median_ms'] <= r['target_ms'] else '  OVER'
+            print(f"{r['controllers']:>11}{r['threads']:>9}{r['median_ms']:>11.1f}"
+                  f"{r['max_ms']:>9.1f}{r['reports']:>9}{r['opens']:>7}"
+                  f"{target:>11}{over}")
+
+    def run_parallel(self, scenario, controllers, scale):
+        #
+        # program-all with `controllers` units of `scenario`, all of
+        # them starting in the app
+        #
+        device_type, hw_id, mcu, family = scenario_of(scenario)
+        emulator = dogemu.DogEmulator(clock=dogemu.RealClock(scale=scale),
+                                      images=self.emulator.images)
+        for _ in range(controllers):
+            emulator.add_controller(device_type, hw_id=hw_id)
+
+        image = latest_image(family)
+        dogemu.install(emulator, d20bootloader, d21bootloader16)
+        try:
+            out = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(out), \
+                 contextlib.redirect_stderr(io.StringIO()):
+                try:
+                    if mcu is None:
+                        d21bootloader16.program_all.callback(image, verify=False, delta=False,
+                                                             verify_crc=False)
+                    else:
+                        d20bootloader.program_all.callback(
+                            image, mcu == d20bootloader.DogBootloaderMCU.PRIMARY, delta=False,
+                            verify_crc=False)
+                except SystemExit:
+                    pass
+            wall_s = time.perf_counter() - start
+        finally:
+            dogemu.install(self.emulator, d20bootloader, d21bootloader16)
+
+        programmed = len(re.findall(r'^\S+: SUCCESS', out.getvalue(), re.M))
+        self.results.append({
+            'scenario'    : scenario,
+            'controllers' : controllers,
+            'programmed'  : programmed,
+            'wall_s'      : wall_s,
+            'device_s'    : wall_s / scale,
+            'units_per_h' : programmed * 3600 * scale / wall_s,
+        })
+
+    def report_parallel(self, as_json=False):
+        single = {r['scenario']: r['units_per_h'] for r in self.results
+                  if r['controllers'] == 1 and r['units_per_h']}
+        for r in self.results:
+            base = single.get(r['scenario'])
+            r['speedup'] = r['units_per_h'] / base if base else None
+
+        if as_json:
+            print(json.dumps(self.results, indent=2))
+            return
+
+        print(f"{'scenario':<9}{'controllers':>12}{'programmed':>11}{'wall_s':>9}"
+              f"{'device_s':>10}{'units/h':>9}{'speedup':>9}")
+        for r in self.results:
+            speedup = 'n/a' if r['speedup'] is None else f"{r['speedup']:.2f}"
+            print(f"{r['scenario']:<9}{r['controllers']:>12}{r['programmed']:>11}"
+                  f"{r['wall_s']:>9.2f}{r['device_s']:>10.1f}{r['units_per_h']:>9.0f}"
+                  f"{speedup:>9}")
+
+    def run_dual(self, mode, scale):
+        #
+        # Updates both MCUs of a hybrid unit that starts in the app,
+        # `mode` being 'sequential' or 'dual'
+        #
+        emulator = dogemu.DogEmulator(clock=dogemu.RealClock(scale=scale),
+                                      images=self.emulator.images)
+        emulator.add_controller(dogemu.DeviceType.D2x_D21, hw_id=30)
+
+        primary, secondary = latest_image('D21'), latest_image('D20')
+        dogemu.install(emulator, d20bootloader, d21bootloader16)
+        try:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), \
+                 contextlib.redirect_stderr(io.StringIO()):
+                if mode == 'dual':
+                    d20bootloader.program_dual_device(primary)
+                else:
+                    d20bootloader.program_device(secondary, False)
+                    d20bootloader.program_device(primary, True)
+            wall_s = time.perf_counter() - start
+        finally:
+            dogemu.install(self.emulator, d20bootloader, d21bootloader16)
+
+        self.results.append({
+            'mode'         : mode,
+            'wall_s'       : wall_s,
+            'device_s'     : wall_s / scale,
+            'reports'      : emulator.stats.round_trips,
+            'resets'       : emulator.stats.commands.get(dogemu.ID_REBOOT_INTO_ISP, 0),
+            'reboots'      : emulator.stats.commands.get(dogemu.ID_FIRMWARE_UPDATE_REBOOT, 0),
+        })
+
+    def report_dual(self, as_json=False):
+        base = next((r['device_s'] for r in self.results if r['mode'] == 'sequential'), None)
+        for r in self.results:
+            r['speedup'] = base / r['device_s'] if base else None
+
+        if as_json:
+            print(json.dumps(self.results, indent=2))
+            return
+
+        print(f"{'mode':<12}{'wall_s':>9}{'device_s':>10}{'reports':>9}"
+              f"{'resets':>8}{'reboots':>9}{'speedup':>9}")
+        for r in self.results:
+            speedup = 'n/a' if r['speedup'] is None else f"{r['speedup']:.2f}"
+            print(f"{r['mode']:<12}{r['wall_s']:>9.2f}{r['device_s']:>10.1f}{r['reports']:>9}"
+                  f"{r['resets']:>8}{r['reboots']:>9}{speedup:>9}")
+
+    def run_transport(self, backend, path, runs):
+        harness = TRANSPORT_HARNESS.format(directory=FIRMWARE_DIR, path=path,
+                                           backend=backend, runs=runs)
+        proc = subprocess.run([sys.executable, '-c', harness],
+                              capture_output=True, text=True)
+
+        m = re.search(r'^DOGBENCH (\S+) (\S+) (\S+)$', proc.stdout, re.M)
+        if not m:
+            error = proc.stderr.strip().splitlines()
+            self.results.append({
+                'backend' : backend,
+                'device'  : path or 'emulated',
+                'used'    : None,
+                'error'   : error[-1] if error else f"exit {proc.returncode}",
+            })
+            return
+
+        median = float(m.group(2))
+        self.results.append({
+            'backend'       : backend,
+            'device'        : path or 'emulated',
+            'used'          : m.group(1),
+            'median_us'     : median * 1e6,
+            'max_us'        : float(m.group(3)) * 1e6,
+            'round_trips_s' : 1 / median if median else 0.0,
+        })
+
+    def report_transport(self, as_json=False):
+        if as_json:
+            print(json.dumps(self.results, indent=2))
+            return
+
+        print(f"{'backend':<9}{'device':<16}{'used':<8}{'median_us':>11}{'max_us':>10}"
+              f"{'round_trips/s':>15}")
+        for r in self.results:
+            if r['used'] is None:
+                print(f"{r['backend']:<9}{r['device']:<16}{'-':<8}  {r['error']}")
+                continue
+            print(f"{r['backend']:<9}{r['device']:<16}{r['used']:<8}{r['median_us']:>11.1f}"
+                  f"{r['max_us']:>10.1f}{r['round_trips_s']:>15.0f}")
+
+    def report_startup(self, as_json=False):
+        if as_json:
+            print(json.dumps(self.results, indent=2))
+            return
+
+        print(f"{'entry':<42}{'command':<22}{'total_ms':>10}{'tool_ms':>10}")
+        for r in self.results:
+            total = 'n/a' if r['total_ms'] is None else f"{r['total_ms']:.1f}"
+            tool  = 'n/a' if r['tool_ms'] is None else f"{r['tool_ms']:.1f}"
+            print(f"{r['entry']:<42}{r['command']:<22}{total:>10}{tool:>10}")
+
+    def report_chunks(self, as_json=False):
+        if as_json:
+            print(json.dumps(self.results, indent=2))
+            return
+
+        print(f"{'scenario':<9}{'op':<10}{'chunks':>12}{'us/chunk':>10}")
+        for r in self.results:
+            print(f"{r['scenario']:<9}{r['op']:<10}{r['chunks']:>12}{r['us']:>10.1f}")
+
+    def report(self, as_json=False):
+        if as_json:
+            print(json.dumps(self.results, indent=2))
+            return
+
+        print(f"{'scenario':<9}{'phase':<16}{'device_s':>10}{'host_s':>10}"
+              f"{'reports':>9}{'reports/s':>11}{'bytes/s':>11}{'saved':>7}{'polls':>7}")
+        for r in self.results:
+            print(f"{r['scenario']:<9}{r['phase']:<16}{r['device_s']:>10.3f}"
+                  f"{r['host_s']:>10.3f}{r['reports']:>9}"
+                  f"{r['reports_per_s']:>11.0f}{r['bytes_per_s']:>11.0f}{r['saved']:>7}"
+                  f"{r['polls']:>7}")
+
+
+def quiet():
+    for module in (d20bootloader, d21bootloader16):
+        module.LOG.setLevel(logging.WARNING)
+
+
+@click.group()
+def cli():
+    install()
+
+@cli.command()
+@click.option('--device', type=click.Choice(['all', *SCENARIOS]), default='all')
+@click.option('--image', type=click.Path(exists=True, dir_okay=False),
+              help='Firmware image to use instead of the latest shipped one')
+@click.option('--sparse/--no-sparse', default=True,
+              help='Skip blank chunks when uploading with d20bootloader')
+@click.option('--erase-plan/--full-erase', default=False,
+              help='Only erase rows used by the installed or the new image')
+@click.option('--delta/--no-delta', default=False,
+              help='Only rewrite what differs from the installed image')
+@click.option('--installed', type=lambda v: int(v, 16),
+              help='Build timestamp (hex) of the image the emulated device starts with')
+@click.option('--max-stream-chunks', type=click.IntRange(1), default=None,
+              help='32 byte chunks the emulated type 1 bootloader streams per read request')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def flash(device, image, sparse, erase_plan, delta, installed, max_stream_chunks, as_json):
+    quiet()
+    EMULATOR.max_stream_chunks = max_stream_chunks
+    bench = DogBench(sparse=sparse, erase_plan=erase_plan, delta=delta,
+                     installed=installed)
+    for scenario in (SCENARIOS if device == 'all' else [device]):
+        bench.run(scenario, image)
+    bench.report(as_json)
+
+@cli.command()
+@click.option('--device', type=click.Choice(['all', 'd21', 'd2x', 'ra4']), default='all')
+@click.option('--image', type=click.Path(exists=True, dir_okay=False),
+              help='Firmware image to use instead of the latest shipped one')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def verify(device, image, as_json):
+    quiet()
+    bench = DogBench()
+    for scenario in (['d21', 'd2x', 'ra4'] if device == 'all' else [device]):
+        for phase in DogBench.VERIFY_MODES:
+            bench.run_verify(scenario, phase, image)
+    bench.report(as_json)
+
+@cli.command()
+@click.option('--device', type=click.Choice(['all', 'd2x', 'd20', 'ra4']), default='all')
+@click.option('--op', type=click.Choice(['download', 'write']), default='download',
+              help='Full app download, or writing the largest row')
+@click.option('--buckets', type=int, default=8)
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def chunks(device, op, buckets, as_json):
+    quiet()
+    bench = DogBench()
+    for scenario in (['d2x', 'd20', 'ra4'] if device == 'all' else [device]):
+        bench.run_chunks(scenario, op, buckets)
+    bench.report_chunks(as_json)
+
+@cli.command()
+@click.option('--device', type=click.Choice(['all', *UPDATE_STEPS]), default='all')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def daemon(device, as_json):
+    quiet()
+    bench = DogBench()
+    for scenario in (UPDATE_STEPS if device == 'all' else [device]):
+        bench.run_daemon(scenario, daemon=False)
+        bench.run_daemon(scenario, daemon=True)
+    bench.report(as_json)
+
+@cli.command()
+@click.option('--device', type=click.Choice(['all', 'd21', 'd2x', 'ra4']), default='all')
+@click.option('--controllers', type=click.IntRange(2, 16), default=4,
+              help='Controllers to program at once, after one on its own')
+@click.option('--scale', type=float, default=0.2,
+              help='Real seconds per emulated second')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def parallel(device, controllers, scale, as_json):
+    quiet()
+    bench = DogBench()
+    for scenario in (['d21', 'd2x', 'ra4'] if device == 'all' else [device]):
+        bench.run_parallel(scenario, 1, scale)
+        bench.run_parallel(scenario, controllers, scale)
+    bench.report_parallel(as_json)
+
+@cli.command()
+@click.option('--scale', type=float, default=0.2,
+              help='Real seconds per emulated second')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def dual(scale, as_json):
+    quiet()
+    bench = DogBench()
+    bench.run_dual('sequential', scale)
+    bench.run_dual('dual', scale)
+    bench.report_dual(as_json)
+
+@cli.command()
+@click.option('--path', help='hidraw node of a real controller, the emulator by default')
+@click.option('--backend', type=click.Choice(['all', 'hidraw', 'hidapi']), default='all')
+@click.option('--runs', type=int, default=1000, help='Round trips, the median is reported')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def transport(path, backend, runs, as_json):
+    backends = ['hidraw', 'hidapi'] if backend == 'all' else [backend]
+    bench = DogBench()
+    for b in backends:
+        bench.run_transport(b, path, runs)
+    bench.report_transport(as_json)
+
+@cli.command()
+@click.option('--controllers', type=click.IntRange(1, 16), default=1)
+@click.option('--threads', type=click.IntRange(1, 16), default=None,
+              help='Devices queried at a time, dogenum.MAX_QUERY_THREADS by default')
+@click.option('--runs', type=int, default=20, help='Runs, the median is reported')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def devices(controllers, threads, runs, as_json):
+    bench = DogBench()
+    bench.run_devices(controllers, threads or dogenum.MAX_QUERY_THREADS, runs)
+    bench.report_devices(as_json)
+
+@cli.command()
+@click.option('--entry', type=click.Choice(['all', 'd21bootloader16.py', 'd20bootloader.py',
+                                            'dogtool.py']), default='all')
+@click.option('--device', type=click.Choice(['d21', 'd2x', 'ra4']), default='d2x',
+              help='Emulated device, in app mode')
+@click.option('--command', 'commands', multiple=True,
+              help='Subcommand to time, all of them by default')
+@click.option('--runs', type=int, default=5, help='Runs per command, the median is reported')
+@click.option('--bundle', type=click.Path(exists=True, dir_okay=False),
+              help='Also time each entry run from this bundle (see dogbundle.py)')
+@click.option('--cache/--no-cache', default=True,
+              help='Let loose modules use cached bytecode, or compile them every run')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def startup(entry, device, commands, runs, bundle, cache, as_json):
+    device_type = SCENARIOS[device][0]
+    entries     = ['d21bootloader16.py', 'd20bootloader.py', 'dogtool.py'] \
+                  if entry == 'all' else [entry]
+    bench = DogBench()
+    for e in entries:
+        tool = d21bootloader16 if e == 'd21bootloader16.py' else d20bootloader
+        for command in (commands or tool.cli.commands):
+            bench.run_startup(e, command, device_type, runs, cache=cache)
+            if bundle:
+                bench.run_startup(e, command, device_type, runs, bundle=bundle)
+    bench.report_startup(as_json)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Packs the updater tools into a single zipapp of precompiled
+# bytecode.
+#
+# The rootfs is read-only, so Python can't cache bytecode for the
+# loose scripts and recompiles them on every run. The bundle carries
+# the bytecode instead, and has to be built by the Python that will
+# run it (the bytecode format changes between Python versions).
+#
+# The bytecode is compiled at optimization level 0: -O would strip
+# the asserts the tools use to reject bad images and replies.
+#
+# The bundle is run with the name of a tool, followed by that tool's
+# usual command line. Without one it behaves as dogtool.py:
+#
+#   ./dogbundle.py build
+#   ./jupiter-controller-fw.pyz d21bootloader16 getdevicesjson
+#   ./jupiter-controller-fw.pyz getdevicesjson
+#
+import click
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipapp
+
+FIRMWARE_DIR = os.path.dirname(os.path.abspath(__file__))
+BUNDLE       = 'jupiter-controller-fw.pyz'
+
+MODULES = (
+    'd20bootloader',
+    'd21bootloader16',
+    'dogcatalog',
+    'dogcrc',
+    'dogd',
+    'dogenum',
+    'doghwid',
+    'dogsysfs',
+    'dogtool',
+    'dogtransport',
+    'dogwait',
+)
+
+MAIN = '''\
+import importlib
+import sys
+
+import dogtool
+
+TOOLS = {modules!r}
+
+name = sys.argv.pop(1) if len(sys.argv) > 1 and sys.argv[1] in TOOLS else 'dogtool'
+if name == 'dogtool':
+    dogtool.main()
+elif name in ('dogcatalog', 'dogd'):
+    importlib.import_module(name).cli()
+else:
+    dogtool.main(name)
+'''
+
+
+def build_bundle(output, directory=FIRMWARE_DIR):
+    with tempfile.TemporaryDirectory() as staging:
+        for name in MODULES:
+            py_compile.compile(os.path.join(directory, f"{name}.py"),
+                               cfile=os.path.join(staging, f"{name}.pyc"),
+                               dfile=f"{name}.py",
+                               doraise=True,
+                               optimize=0,
+                               invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+        with open(os.path.join(staging, '__main__.py'), 'w') as f:
+            f.write(MAIN.format(modules=('d20bootloader', 'd21bootloader16',
+                                         'dogcatalog', 'dogd', 'dogtool')))
+
+        zipapp.create_archive(staging, output + '.tmp',
+                              interpreter='/usr/bin/env python3')
+
+    os.replace(output + '.tmp', output)
+    return output
+
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option('--output', type=click.Path(dir_okay=False),
+              default=os.path.join(FIRMWARE_DIR, BUNDLE), help='Bundle to write')
+def build(output):
+    print(build_bundle(output))
+    print(f"Built for Python {sys.version_info.major}.{sys.version_info.minor}")
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+#
+# Catalog of the app images shipped in this directory.
+#
+# Everything the tools need to know about an image (family, build
+# timestamp, size, CRC of the padded image, SHA-256 and per-row
+# digests) is computed once by `dogcatalog.py build` and stored in a
+# binary manifest next to the images. Lookups memory-map the manifest,
+# so picking and validating an image doesn't hash any files.
+#
+# If the manifest is missing or doesn't match the images on disk (an
+# image was added, removed or replaced by one of a different size) the
+# catalog is rebuilt in memory instead, which is correct but slow.
+#
+# Example:
+#
+#   ./dogcatalog.py build
+#   ./dogcatalog.py latest D21 D20 RA4
+#   ./dogcatalog.py latest-for 2 --hwid 30 --secondary
+#
+import click
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+
+sys.path.append(os.path.dirname(__file__))
+
+import dogcrc
+import doghwid
+
+LOG = logging.getLogger(__name__)
+
+FIRMWARE_DIR = os.path.dirname(os.path.abspath(__file__))
+if not os.path.isdir(FIRMWARE_DIR):
+    #
+    # Imported from a bundle (see dogbundle.py), which sits next to
+    # the images
+    #
+    FIRMWARE_DIR = os.path.dirname(FIRMWARE_DIR)
+MANIFEST     = 'firmware.manifest'
+
+#
+# family: (file name prefix, app length, row digest unit)
+#
+# The app length matches APP_FW_LENGTH of the family's MCU. Rows are
+# digested in units of the smallest erase row of the app region, so a
+# larger row is covered by several consecutive units.
+#
+FAMILIES = {
+    'D20' : ('D20_APP_REL_', 0x3F000 - 4 - 0x4000, 256),
+    'D21' : ('D21_APP_REL_', 0x3F000 - 4 - 0x4000, 256),
+    'RA4' : ('RA_APP_REL_',  0x40000 - 4 - 0x8000, 8 * 1024),
+}
+
+#
+# Device types as reported in the USB release number. The family of
+# the secondary MCU of D2x_D21 units goes by their primary HW ID, see
+# doghwid.py.
+#
+DEVICE_TYPE_D21_D21 = 0x100
+DEVICE_TYPE_D2x_D21 = 0x200
+DEVICE_TYPE_RA4     = 0x300
+
+DIGEST_LEN = 8
+
+HEADER = struct.Struct('<4sHHI')
+ENTRY  = struct.Struct('<4sIIII32sIII48s')
+
+MAGIC   = b'DOGM'
+VERSION = 1
+
+
+class DogCatalogError(Exception):
+    pass
+
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_LEN).digest()
+
+
+def family_for(device_type, hw_id=None, secondary=False):
+    #
+    # The image family each MCU of a device runs
+    #
+    if device_type == DEVICE_TYPE_RA4:
+        if secondary:
+            raise DogCatalogError("RA4 units don't have a secondary MCU")
+        return 'RA4'
+
+    if device_type == DEVICE_TYPE_D2x_D21 and secondary:
+        family = doghwid.secondary_family(hw_id)
+        if family is not None:
+            return family
+        raise DogCatalogError(f"Unknown primary HW ID {hw_id}, the secondary MCU's "
+                              "family isn't known")
+
+    if device_type in (DEVICE_TYPE_D21_D21, DEVICE_TYPE_D2x_D21):
+        return 'D21'
+
+    raise DogCatalogError(f"Unknown device type 0x{device_type:x}")
+
+
+def parse_name(name):
+    for family, (prefix, _, _) in FAMILIES.items():
+        m = re.match(rf'{prefix}([0-9A-F]{{8}})\.bin$', name)
+        if m:
+            return family, int(m.group(1), 16)
+
+    return None
+
+
+class DogCatalogEntry:
+    def __init__(self, catalog, index):
+        self.catalog = catalog
+        self.index   = index
+
+        (family, self.timestamp, self.size, self.crc, self.length, self.sha256,
+         self.unit, self.units, self.digests_offset, name) = \
+            ENTRY.unpack_from(catalog.buf, HEADER.size + index * ENTRY.size)
+
+        self.family = family.rstrip(b'\x00').decode('ascii')
+        self.name   = name.rstrip(b'\x00').decode('ascii')
+
+    def __repr__(self):
+        return f"DogCatalogEntry({self.name})"
+
+    @property
+    def path(self):
+        return os.path.join(self.catalog.directory, self.name)
+
+    @property
+    def digests(self):
+        start = self.digests_offset
+        return memoryview(self.catalog.buf)[start : start + self.units * DIGEST_LEN]
+
+    def row_digest(self, offset):
+        #
+        # Digest of the unit at `offset` bytes into the app region
+        #
+        i = offset // self.unit * DIGEST_LEN
+        return self.digests[i : i + DIGEST_LEN]
+
+    def changed(self, other):
+        #
+        # App region offsets of the units that differ between two
+        # images of the same family
+        #
+        assert self.family == other.family, \
+            f"Can't compare {self.family} and {other.family} images"
+
+        ours, theirs = self.digests, other.digests
+        return [i * self.unit for i in range(self.units)
+                if ours[i * DIGEST_LEN : (i + 1) * DIGEST_LEN] !=
+                   theirs[i * DIGEST_LEN : (i + 1) * DIGEST_LEN]]
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def check(self, deep=False):
+        #
+        # Cheap check against the manifest: the file has the
+        # recorded size. With `deep`, the contents are hashed too.
+        #
+        try:
+            if os.stat(self.path).st_size != self.size:
+                return False
+        except OSError:
+            return False
+
+        if deep:
+            return hashlib.sha256(self.read()).digest() == self.sha256
+
+        return True
+
+    def as_dict(self):
+        return {
+            'name'      : self.name,
+            'family'    : self.family,
+            'timestamp' : self.timestamp,
+            'size'      : self.size,
+            'crc'       : self.crc,
+            'sha256'    : self.sha256.hex(),
+            'row_unit'  : self.unit,
+            'rows'      : self.units,
+        }
+
+
+class DogCatalog:
+    def __init__(self, directory, buf):
+        self.directory = directory
+        self.buf       = buf
+
+        magic, version, count, _ = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise DogCatalogError("Unsupported manifest format")
+
+        self.entries = [DogCatalogEntry(self, i) for i in range(count)]
+        self.by_name = {e.name: e for e in self.entries}
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, family, timestamp):
+        for e in self.entries:
+            if e.family == family and e.timestamp == timestamp:
+                return e
+
+        return None
+
+    def lookup(self, path):
+        #
+        # Entry for an image file, if it's the one in the catalog
+        #
+        e = self.by_name.get(os.path.basename(path))
+        if e is None or \
+           os.path.realpath(os.path.dirname(path) or '.') != os.path.realpath(self.directory):
+            return None
+
+        return e
+
+    def latest(self, family):
+        entries = [e for e in self.entries if e.family == family]
+        if not entries:
+            return None
+
+        return max(entries, key=lambda e: e.timestamp)
+
+    def latest_for(self, device_type, hw_id=None, secondary=False):
+        return self.latest(family_for(device_type, hw_id, secondary))
+
+    def stale(self):
+        #
+        # True if the images on disk don't match the manifest. Only
+        # names and sizes are compared, contents are left to `verify`
+        #
+        on_disk = {}
+        with os.scandir(self.directory) as it:
+            for f in it:
+                if parse_name(f.name):
+                    on_disk[f.name] = f.stat().st_size
+
+        return on_disk != {e.name: e.size for e in self.entries}
+
+
+def build_manifest(directory):
+    images = []
+    for name in sorted(os.listdir(directory)):
+        parsed = parse_name(name)
+        if parsed:
+            images.append((name, *parsed))
+
+    entries = []
+    digests = bytearray()
+    offset  = HEADER.size + len(images) * ENTRY.size
+    for name, family, timestamp in images:
+        _, length, unit = FAMILIES[family]
+        with open(os.path.join(directory, name), 'rb') as f:
+            image = f.read()
+
+        if len(image) > length:
+            raise DogCatalogError(f"{name} is larger than the {family} app region")
+
+        crc   = dogcrc.compute_crc(image, length)
+        units = (length + unit - 1) // unit
+        blank = digest(b'\xff' * unit)
+        start = offset + len(digests)
+        for i in range(units):
+            row = image[i * unit : (i + 1) * unit]
+            if not row:
+                digests += blank
+            else:
+                digests += digest(row + b'\xff' * (unit - len(row)))
+
+        entries.append(ENTRY.pack(family.encode('ascii'), timestamp, len(image), crc,
+                                  length, hashlib.sha256(image).digest(),
+                                  unit, units, start, name.encode('ascii')))
+
+    return HEADER.pack(MAGIC, VERSION, len(entries), ENTRY.size) + \
+           b''.join(entries) + bytes(digests)
+
+
+def write_manifest(directory=FIRMWARE_DIR):
+    path = os.path.join(directory, MANIFEST)
+    blob = build_manifest(directory)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(blob)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def open_manifest(directory=FIRMWARE_DIR):
+    directory = os.path.abspath(directory)
+    with open(os.path.join(directory, MANIFEST), 'rb') as f:
+        return DogCatalog(directory, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def load(directory=FIRMWARE_DIR):
+    directory = os.path.abspath(directory)
+    path      = os.path.join(directory, MANIFEST)
+    try:
+        catalog = open_manifest(directory)
+        if not catalog.stale():
+            return catalog
+
+        LOG.warning(f"{path} is out of date, indexing images")
+    except (OSError, ValueError, struct.error, DogCatalogError):
+        LOG.warning(f"Can't use {path}, indexing images")
+
+    return DogCatalog(directory, build_manifest(directory))
+
+
+def installed(name, timestamp):
+    #
+    # Entry for the image of the same family as `name` that was built
+    # at `timestamp`, i.e. the one running on a device that reports
+    # that build timestamp
+    #
+    if not timestamp:
+        return None
+
+    catalog = load(os.path.dirname(os.path.abspath(name)))
+    image   = catalog.lookup(name)
+    if image is None:
+        return None
+
+    e = catalog.find(image.family, timestamp)
+    if e is None or not e.check():
+        return None
+
+    return e
+
+
+@click.group()
+@click.option('--dir', 'directory', type=click.Path(exists=True, file_okay=False),
+              default=FIRMWARE_DIR, help='Firmware directory')
+@click.pass_context
+def cli(ctx, directory):
+    ctx.obj = directory
+
+@cli.command()
+@click.pass_obj
+def build(directory):
+    print(write_manifest(directory))
+
+@cli.command(name='list')
+@click.option('--json', 'as_json', is_flag=True, help='Print entries as JSON')
+@click.pass_obj
+def list_images(directory, as_json):
+    catalog = load(directory)
+    if as_json:
+        print(json.dumps([e.as_dict() for e in catalog], indent=2))
+        return
+
+    for e in catalog:
+        print(f"{e.family:<4} {e.timestamp:08X} {e.size:>7} {e.crc:08x} {e.name}")
+
+@cli.command()
+@click.argument('families', nargs=-1, required=True,
+                type=click.Choice(list(FAMILIES)))
+@click.option('--path', is_flag=True, help='Print paths instead of timestamps')
+@click.pass_obj
+def latest(directory, families, path):
+    catalog = load(directory)
+    found   = []
+    for family in families:
+        e = catalog.latest(family)
+        if e is None:
+            raise click.ClickException(f"No {family} image in {directory}")
+        found.append(e.path if path else f"{e.timestamp:08X}")
+
+    print(' '.join(found))
+
+@cli.command(name='latest-for')
+@click.argument('bootloader_type', type=click.IntRange(1, 3))
+@click.option('--hwid', type=int, help='Primary HW ID')
+@click.option('--primary/--secondary', default=True)
+@click.pass_obj
+def latest_for(directory, bootloader_type, hwid, primary):
+    try:
+        e = load(directory).latest_for(bootloader_type << 8, hwid, not primary)
+    except DogCatalogError as err:
+        raise click.ClickException(str(err))
+
+    if e is None:
+        raise click.ClickException(f"No matching image in {directory}")
+
+    print(e.path)
+
+@cli.command()
+@click.pass_obj
+def verify(directory):
+    try:
+        catalog = open_manifest(directory)
+    except (OSError, ValueError, struct.error, DogCatalogError) as err:
+        raise click.ClickException(f"Can't read the manifest: {err}")
+
+    bad     = [e.name for e in catalog if not e.check(deep=True)]
+    for name in bad:
+        print(f"{name}: doesn't match the manifest")
+
+    if catalog.stale():
+        print("Images were added or removed since the manifest was built")
+        sys.exit(1)
+
+    if bad:
+        sys.exit(1)
+
+    print(f"{len(catalog)} images OK")
+
+if __name__ == '__main__':
+    cli()
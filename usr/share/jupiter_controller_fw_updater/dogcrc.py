@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#
+# CRC shared by both bootloader tools: CRC-32 with polynomial
+# 0x04C11DB7, reflected, starting from 0 with no final XOR. It covers
+# app images (padded with 0xFF up to the app length) as well as data
+# flash partitions.
+#
+# The table is built once, at import. DogCrc can be fed incrementally
+# while chunks are streamed to a device, and accounts for 0xFF padding
+# by running a constant blank block through the CRC instead of
+# building the padded image.
+#
+# Both tools also use is_blank() and first_difference() to compare
+# images with what they read back from flash.
+#
+import crcmod
+
+CRC_POLY  = 0x104C11DB7
+CRCFUN    = crcmod.mkCrcFun(CRC_POLY)
+
+BLANK     = b'\xff' * 4096
+BLANKVIEW = memoryview(BLANK)
+
+
+class DogCrc:
+    def __init__(self, crc=0, length=0):
+        self.crc    = crc
+        self.length = length
+
+    def __repr__(self):
+        return f"DogCrc(crc=0x{self.crc:08x}, length={self.length})"
+
+    @property
+    def value(self):
+        return self.crc
+
+    def copy(self):
+        return DogCrc(self.crc, self.length)
+
+    def update(self, data):
+        self.crc     = CRCFUN(data, self.crc)
+        self.length += len(data)
+        return self
+
+    def pad(self, size):
+        #
+        # Extend the CRC with 0xFF bytes until it covers `size` bytes
+        #
+        assert size >= self.length, \
+            f"Can't pad to {size} bytes, already covering {self.length}"
+
+        remaining = size - self.length
+        while remaining:
+            n = min(remaining, len(BLANK))
+            self.update(BLANKVIEW[:n])
+            remaining -= n
+
+        return self
+
+    def update_to(self, data, size):
+        #
+        # Advance the CRC to cover the first `size` bytes of `data`
+        # padded with 0xFF, picking up where the last call left off
+        #
+        if self.length < len(data):
+            self.update(memoryview(data)[self.length : min(size, len(data))])
+
+        return self.pad(size)
+
+
+def compute_crc(data, size=None):
+    crc = DogCrc().update(data)
+    if size is not None:
+        crc.pad(size)
+    return crc.value
+
+
+def is_blank(data):
+    return data.count(0xFF) == len(data)
+
+def first_difference(a, b):
+    #
+    # Offset of the first byte where `a` and `b` differ, or the length
+    # of the shorter one if it is a prefix of the other
+    #
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            return i
+
+    return min(len(a), len(b))
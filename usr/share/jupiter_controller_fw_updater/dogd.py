@@ -0,0 +1,787 @@
+#!/usr/bin/env python3
+#
+# Controller firmware daemon.
+#
+# Steam, jupiter-controller-update and jupiter-initial-firmware-update
+# run the tools several times in a row, and every run pays for starting
+# Python, enumerating and opening the device and, for anything past the
+# app attributes, resetting it into the bootloader. dogd stays up
+# instead: it keeps the bootloader open between requests, remembers
+# what it read until something is written or the device goes away, and
+# runs one request at a time, so that concurrent clients can't
+# interleave reports.
+#
+# Requests are JSON objects, one per line, on a Unix socket. Each gets
+# one line back:
+#
+#   {"command": "gethwid", "primary": false}
+#   {"ok": true, "tool": "d20bootloader", "result": 30}
+#   {"ok": false, "tool": "d20bootloader", "error": "TIMEOUT", "message": "...",
+#    "output": ["TIMEOUT"], "exit": 3}
+#
+# Errors come with what the tool prints for them and its exit code,
+# taken from the tool's FAILURES.
+#
+# With JUPITER_CONTROLLER_FW_DAEMON=1 in its environment, dogtool.py,
+# and with it either tool, forwards the command lines the daemon can
+# serve to it and prints the reply the way the tool would have, see
+# client(). Anything else, including command lines with options the
+# tool would take but the daemon can't honour, runs as before, with
+# the device leased from the daemon: it lets go of the device and
+# serves no one else until the tool is done.
+#
+# Example:
+#
+#   ./dogd.py serve &
+#   ./d20bootloader.py gethwid --clean
+#   ./dogd.py request '{"command": "getdevicesjson"}'
+#
+import click
+import contextlib
+import copy
+import importlib
+import inspect
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+sys.path.append(os.path.dirname(__file__))
+
+import dogenum
+import doghwid
+import dogtool
+
+LOG = logging.getLogger(__name__)
+
+#
+# How long app attributes read for getdevicesjson and
+# getappbuildtimestamp are reused. Anything the daemon does to the
+# device drops them right away.
+#
+ATTRIBUTES_TTL_S = 1.0
+
+MAX_HW_ID         = 0x100000000 - 1
+MAX_SERIAL_LENGTH = 30
+
+#
+# Exceptions of either tool, by class name, to the error reported for
+# them
+#
+ERRORS = {
+    'HIDException'               : 'HID',
+    'DogBootloaderNotSupported'  : 'NOT SUPPORTED',
+    'DogBootloaderTimeout'       : 'TIMEOUT',
+    'DogBootloaderNoDeviceFound' : 'NO DEVICE FOUND',
+    'DogBootloaderVerifyError'   : 'VERIFY',
+    'DogBootloaderBootError'     : 'BOOT',
+}
+
+
+class DogdError(Exception):
+    #
+    # A request the tool would have refused with ERROR
+    #
+    pass
+
+class DogdNotServed(Exception):
+    #
+    # A request the daemon can't serve the way the tool would, which
+    # the client then leaves to the tool
+    #
+    pass
+
+
+def bootloader_paths():
+    return frozenset(d['path'] for d in dogenum.enumerate(dogenum.JUPITER_BOOTLOADER_USB_VID,
+                                                          dogenum.JUPITER_BOOTLOADER_USB_PID))
+
+
+def probe():
+    #
+    # The tool that drives the connected device, picked the same way
+    # as when the tools are run, see dogtool.py
+    #
+    import d20bootloader
+
+    with d20bootloader.DogBootloader(reset=False) as d:
+        tool = dogtool.DEVICE_TYPES[d.device_type]
+
+    if tool == 'd21bootloader16':
+        import d21bootloader16
+
+        with d21bootloader16.DogBootloader(reset=False) as d:
+            tool = doghwid.tool_for(d.hardware_id[0]) or tool
+
+    return tool
+
+
+def clamp_serial(serial):
+    if len(serial) >= MAX_SERIAL_LENGTH:
+        serial = serial[:MAX_SERIAL_LENGTH - 1]
+        LOG.warning(f"Clamping serial to {serial} to fit maximum length")
+
+    return serial
+
+
+class DogDriver:
+    #
+    # Bootloader handles open on one device, and what was read through
+    # them. Everything read is kept until the next write.
+    #
+    def __init__(self, name):
+        self.name  = name
+        self.tool  = importlib.import_module(name)
+        self.cache = {}
+        self.paths = None
+
+    def check(self, function, *args, **options):
+        #
+        # Refuses options `function` of the tool doesn't take
+        #
+        try:
+            inspect.signature(function).bind(*args, **options)
+        except TypeError as e:
+            raise DogdNotServed(str(e))
+
+    def cached(self, key, read):
+        if key not in self.cache:
+            self.cache[key] = read()
+
+        return self.cache[key]
+
+    def opened(self):
+        #
+        # The bootloader interfaces once a handle is open. If they
+        # change, the device was reset behind our back.
+        #
+        self.paths = bootloader_paths()
+
+    def wait_for_app(self):
+        import dogwait
+
+        try:
+            _, dev = dogwait.wait_for_device(lambda: next(iter(dogenum.dog_enumerate()), None),
+                                             timeout=dogwait.USB_ENUMERATION_TIMEOUT_S)
+        except dogwait.DogWaitTimeout:
+            return False
+
+        dev.close()
+        return True
+
+
+class D20Driver(DogDriver):
+    def __init__(self, name):
+        super().__init__(name)
+        self.dogs = {}
+        self.app  = None
+
+    def close(self):
+        for d in self.dogs.values():
+            d.close()
+        self.dogs.clear()
+
+    def dog(self, primary):
+        d = self.dogs.get(primary)
+        if d is None:
+            #
+            # Only the first handle finds the app, which resets both
+            # MCUs into the bootloader, so the later ones don't need
+            # to reset theirs again
+            #
+            d = self.tool.dog(primary, reset=self.app is None)
+            if self.app is None:
+                self.app = getattr(d, 'app', None)
+            if self.app is not None:
+                d.app = self.app
+
+            self.dogs[primary] = d
+            self.opened()
+
+        return d
+
+    def bl_build_timestamp(self, primary):
+        return self.cached(('bl_build_timestamp', primary),
+                           lambda: self.dog(primary).bl_firmware_build_time)
+
+    def hardware_id(self, primary):
+        return self.cached(('hardware_id', primary), lambda: self.dog(primary).hardware_id)
+
+    def set_hardware_id(self, primary, value):
+        if value > MAX_HW_ID:
+            raise DogdError('Hardware ID out of range.')
+
+        self.cache.clear()
+        self.dog(primary).hardware_id = value
+
+    def board_serial(self, primary):
+        return self.cached(('board_serial', primary), lambda: self.dog(primary).board_serial)
+
+    def set_board_serial(self, primary, value):
+        value = clamp_serial(value)
+        self.cache.clear()
+        self.dog(primary).board_serial = value
+
+    def unit_serial(self):
+        return self.cached('unit_serial', lambda: self.dog(True).unit_serial)
+
+    def set_unit_serial(self, value):
+        value = clamp_serial(value)
+        self.cache.clear()
+        self.dog(True).unit_serial = value
+
+    def program(self, firmware, primary=True, **options):
+        self.check(self.tool.program_bootloader, None, firmware, primary, **options)
+
+        d = self.dog(primary)
+        self.cache.clear()
+        self.tool.program_bootloader(d, firmware, primary, **options)
+        if primary:
+            return True
+
+        #
+        # What the app reported for this MCU no longer holds
+        #
+        if self.app is not None:
+            self.app = copy.copy(self.app)
+            self.app.secondary_build_timestamp = 0
+            for d in self.dogs.values():
+                d.app = self.app
+        return True
+
+    def reset(self, primary):
+        self.dog(primary).reboot(wait_for_app=primary)
+
+
+class D21Driver(DogDriver):
+    def __init__(self, name):
+        super().__init__(name)
+        self.d = None
+
+    def close(self):
+        if self.d is not None:
+            self.d.close()
+            self.d = None
+
+    def dog(self, primary=True):
+        if not primary:
+            raise DogdNotServed('d21bootloader16 only drives the primary MCU')
+
+        if self.d is None:
+            self.d = self.tool.DogBootloader()
+            self.opened()
+
+        return self.d
+
+    def side(self, key, primary):
+        return self.cached((key, primary),
+                           lambda: getattr(self.dog(), f'read_{key}')(primary))
+
+    def bl_build_timestamp(self, primary):
+        return self.cached('bl_build_timestamp', lambda: self.dog(primary).firmware_build_time)
+
+    def hardware_id(self, primary):
+        return self.side('hardware_id', primary)
+
+    def set_hardware_id(self, primary, value):
+        self.cache.clear()
+        self.dog().write_hardware_id(primary, value)
+
+    def board_serial(self, primary):
+        return self.side('board_serial', primary)
+
+    def set_board_serial(self, primary, value):
+        self.cache.clear()
+        self.dog().write_board_serial(primary, value)
+
+    def unit_serial(self):
+        return self.cached('unit_serial', lambda: self.dog().unit_serial)
+
+    def set_unit_serial(self, value):
+        self.cache.clear()
+        self.dog().unit_serial = value
+
+    def program(self, firmware, **options):
+        self.check(self.tool.program_bootloader, None, firmware, **options)
+
+        d = self.dog()
+        self.cache.clear()
+        self.tool.program_bootloader(d, firmware, **options)
+        serial = d.serial
+        self.close()
+        if options.get('verify_crc'):
+            return self.tool.wait_for_boot(firmware, serial, verbose=False)
+
+        return self.wait_for_app()
+
+    def reset(self, primary):
+        self.dog().reboot()
+
+
+DRIVERS = {
+    'd20bootloader'   : D20Driver,
+    'd21bootloader16' : D21Driver,
+}
+
+
+class DogSession:
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.driver     = None
+        self.attributes = {}
+
+    def release(self):
+        #
+        # Closes all handles and forgets everything read through them
+        #
+        if self.driver is not None:
+            try:
+                self.driver.close()
+            except Exception as e:
+                LOG.debug(f"Closing {self.driver.name}: {e}")
+            self.driver = None
+
+        self.attributes.clear()
+
+    @contextlib.contextmanager
+    def leased(self):
+        #
+        # Hands the device over to a tool running on its own. No
+        # request is served meanwhile, and nothing read before is
+        # trusted after.
+        #
+        with self.lock:
+            self.release()
+            try:
+                yield
+            finally:
+                self.release()
+
+    def device(self):
+        if self.driver is not None and self.driver.paths is not None and \
+           self.driver.paths != bootloader_paths():
+            LOG.info('Device was reset, reopening it')
+            self.release()
+
+        if self.driver is None:
+            #
+            # What a tool prints when there's no device to probe
+            # depends on which tool is run, so that's left to it
+            #
+            try:
+                name = probe()
+            except Exception as e:
+                raise DogdNotServed(f"Probing failed: {e}")
+
+            self.driver = DRIVERS[name](name)
+
+        return self.driver
+
+    def timestamps(self, dev):
+        now = time.monotonic()
+        hit = self.attributes.get(dev['path'])
+        if hit is not None and now - hit[0] < ATTRIBUTES_TTL_S:
+            return hit[1]
+
+        value = dogenum.get_dev_build_timestamp(dev)
+        self.attributes[dev['path']] = now, value
+        return value
+
+    def handle(self, request):
+        command = request.pop('command', None)
+        handler = COMMANDS.get(command)
+
+        with self.lock:
+            try:
+                if handler is None:
+                    raise DogdError(f"Unknown command {command}")
+
+                try:
+                    inspect.signature(handler).bind(self, **request)
+                except TypeError as e:
+                    raise DogdError(f"Bad arguments for {command}: {e}")
+
+                result = handler(self, **request)
+                tool   = self.driver.name if self.driver else None
+                return {'ok': True, 'tool': tool, 'result': result}
+            except DogdNotServed as e:
+                tool = self.driver.name if self.driver else None
+                return {'ok': False, 'tool': tool, 'error': 'NOT SERVED', 'message': str(e)}
+            except Exception as e:
+                tool = self.driver.name if self.driver else None
+                if isinstance(e, DogdError):
+                    error, message = 'ERROR', str(e)
+                    output, code   = [message, 'ERROR'], 0
+                else:
+                    error, message = ERRORS.get(type(e).__name__, 'EXCEPTION'), str(e)
+                    handled = importlib.import_module(tool).failure(e) if tool else None
+                    if handled is None:
+                        error, message = 'EXCEPTION', traceback.format_exc()
+                        output, code   = None, 1
+                        LOG.error(message)
+                    else:
+                        output, code = handled
+                    #
+                    # The device may be gone, or in any state
+                    #
+                    self.release()
+
+                return {'ok': False, 'tool': tool, 'error': error, 'message': message,
+                        'output': output, 'exit': code}
+
+
+#
+# Requests, with their arguments as keyword arguments
+#
+def getdevicesjson(session):
+    return dogenum.get_devices(timestamps=session.timestamps)
+
+def getappbuildtimestamp(session, primary=True):
+    #
+    # The tools probe the device first too
+    #
+    session.device()
+    dev, error = dogenum.get_app()
+    if error:
+        raise DogdError(error)
+
+    return session.timestamps(dev)[0 if primary else 1]
+
+def getblbuildtimestamp(session, primary=True):
+    return session.device().bl_build_timestamp(primary)
+
+def gethwid(session, primary=True):
+    return session.device().hardware_id(primary)
+
+def sethwid(session, hardware_id, primary=True):
+    session.device().set_hardware_id(primary, int(hardware_id))
+
+def getserial(session, primary=True):
+    return session.device().board_serial(primary)
+
+def setserial(session, serial, primary=True):
+    session.device().set_board_serial(primary, str(serial))
+
+def getunitserial(session):
+    return session.device().unit_serial()
+
+def setunitserial(session, serial):
+    session.device().set_unit_serial(str(serial))
+
+def program(session, firmware, **options):
+    #
+    # Programming ends with the app running on the new image, unless
+    # it's only the secondary MCU. The options are those of the tool's
+    # program_bootloader().
+    #
+    primary = options.get('primary', True)
+    driver  = session.device()
+    session.attributes.clear()
+    try:
+        ready = driver.program(firmware, **options)
+    finally:
+        if primary:
+            session.release()
+
+    return {'timeout': not ready}
+
+def reset(session, primary=True):
+    try:
+        session.device().reset(primary)
+    finally:
+        session.release()
+
+def release(session):
+    session.release()
+
+COMMANDS = {
+    'getdevicesjson'       : getdevicesjson,
+    'getappbuildtimestamp' : getappbuildtimestamp,
+    'getblbuildtimestamp'  : getblbuildtimestamp,
+    'gethwid'              : gethwid,
+    'sethwid'              : sethwid,
+    'getserial'            : getserial,
+    'setserial'            : setserial,
+    'getunitserial'        : getunitserial,
+    'setunitserial'        : setunitserial,
+    'program'              : program,
+    'reset'                : reset,
+    'release'              : release,
+}
+
+
+def make_server(path=dogtool.DOGD_SOCKET, mode=0o600, session=None):
+    import socketserver
+
+    session = session or DogSession()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('not an object')
+                except ValueError as e:
+                    reply = {'ok': False, 'tool': None, 'error': 'ERROR',
+                             'message': f"Bad request: {e}"}
+                else:
+                    if request.get('command') == 'lease':
+                        #
+                        # Until the client closes the connection
+                        #
+                        with session.leased():
+                            self.wfile.write(json.dumps(LEASED).encode() + b'\n')
+                            self.rfile.read()
+                        return
+
+                    reply = session.handle(request)
+
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            if s.connect_ex(path) == 0:
+                raise DogdError(f"A daemon is already listening on {path}")
+        os.unlink(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    server.daemon_threads = True
+    server.session        = session
+    os.chmod(path, mode)
+
+    return server
+
+
+def close_server(server):
+    server.server_close()
+    os.unlink(server.server_address)
+    server.session.release()
+
+
+def serve(path=dogtool.DOGD_SOCKET, mode=0o600):
+    server = make_server(path, mode)
+
+    LOG.info(f"Listening on {path}")
+    try:
+        server.serve_forever()
+    finally:
+        close_server(server)
+
+
+LEASED = {'ok': True, 'tool': None, 'result': None}
+
+
+def lease(path=None):
+    #
+    # Takes the device from the daemon for as long as the returned
+    # socket stays open. Waits for the request being served, if any.
+    #
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path or dogtool.DOGD_SOCKET)
+        s.sendall(json.dumps({'command': 'lease'}).encode() + b'\n')
+        with s.makefile('rb') as f:
+            line = f.readline()
+    except OSError:
+        s.close()
+        raise
+
+    if not line:
+        s.close()
+        raise ConnectionError('dogd closed the connection')
+
+    return s
+
+
+def call(request, path=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path or dogtool.DOGD_SOCKET)
+        s.sendall(json.dumps(request).encode() + b'\n')
+        with s.makefile('rb') as f:
+            line = f.readline()
+
+    if not line:
+        raise ConnectionError('dogd closed the connection')
+
+    return json.loads(line)
+
+
+#
+# Command line options the client understands: the request field each
+# sets, and its value
+#
+FLAGS = {
+    '--primary'            : ('primary', True),
+    '--secondary'          : ('primary', False),
+    '--clean'              : ('clean', True),
+    '--delta'              : ('delta', True),
+    '--no-delta'           : ('delta', False),
+    '--sparse'             : ('sparse', True),
+    '--no-sparse'          : ('sparse', False),
+    '--erase-plan'         : ('erase_plan', True),
+    '--full-erase'         : ('erase_plan', False),
+    '--verify'             : ('verify', True),
+    '--no-verify'          : ('verify', False),
+    '--verify-crc'         : ('verify_crc', True),
+    '--singleton-mode'     : ('singleton_mode', True),
+    '--no-singleton-mode'  : ('singleton_mode', False),
+}
+
+PROGRAM_OPTIONS = ('primary', 'delta', 'sparse', 'erase_plan', 'verify', 'verify_crc',
+                   'singleton_mode')
+
+#
+# command: (request fields taken as arguments, fields set by options)
+#
+CLIENT_COMMANDS = {
+    'getdevicesjson'       : ((), ()),
+    'getappbuildtimestamp' : ((), ('primary',)),
+    'getblbuildtimestamp'  : ((), ('primary',)),
+    'gethwid'              : ((), ('primary', 'clean')),
+    'sethwid'              : (('hardware_id',), ('primary',)),
+    'getserial'            : ((), ('primary',)),
+    'setserial'            : (('serial',), ('primary',)),
+    'getunitserial'        : ((), ()),
+    'setunitserial'        : (('serial',), ()),
+    'program'              : (('firmware',), PROGRAM_OPTIONS),
+    'reset'                : ((), ('primary',)),
+}
+
+#
+# What the tools print for a result
+#
+OUTPUT = {
+    'getdevicesjson'       : lambda r, clean: [json.dumps(r)],
+    'getappbuildtimestamp' : lambda r, clean: [r, 'SUCCESS'],
+    'getblbuildtimestamp'  : lambda r, clean: [r, 'SUCCESS'],
+    'gethwid'              : lambda r, clean: [r] if clean else [f'HW ID: {r}', 'SUCCESS'],
+    'getserial'            : lambda r, clean: [f'Serial: {r}', 'SUCCESS'],
+    'getunitserial'        : lambda r, clean: [f'Unit Serial: {r}', 'SUCCESS'],
+    'program'              : lambda r, clean: ['TIMEOUT' if r['timeout'] else 'SUCCESS'],
+}
+
+def parse(argv):
+    #
+    # The request for a tool command line, or None if the daemon
+    # can't serve it
+    #
+    if not argv or argv[0] not in CLIENT_COMMANDS:
+        return None
+
+    names, options = CLIENT_COMMANDS[argv[0]]
+    request = {'command': argv[0]}
+    values  = []
+    for arg in argv[1:]:
+        if arg in FLAGS:
+            field, value = FLAGS[arg]
+            if field not in options:
+                return None
+            request[field] = value
+        elif arg.startswith('-'):
+            return None
+        else:
+            values.append(arg)
+
+    if len(values) != len(names):
+        return None
+
+    request.update(zip(names, values))
+
+    #
+    # Leave bad arguments to the tool to complain about
+    #
+    if 'hardware_id' in request:
+        try:
+            request['hardware_id'] = int(request['hardware_id'])
+        except ValueError:
+            return None
+
+    if 'firmware' in request:
+        if not os.path.isfile(request['firmware']):
+            return None
+        request['firmware'] = os.path.abspath(request['firmware'])
+
+    return request
+
+
+def render(command, clean, reply):
+    #
+    # Prints a reply the way the tool would have printed the result,
+    # and returns the exit code
+    #
+    if reply['ok']:
+        for line in OUTPUT.get(command, lambda r, clean: ['SUCCESS'])(reply['result'], clean):
+            print(line)
+        return 0
+
+    if reply.get('output') is None:
+        print(reply['message'], file=sys.stderr)
+        return 1
+
+    for line in reply['output']:
+        print(line)
+    return reply['exit']
+
+
+def client(argv, forward=True):
+    #
+    # Serves a tool command line through a running daemon and exits.
+    # Returns None if there's no daemon. Unless asked to `forward` it,
+    # or if the daemon can't serve this command line, returns a lease
+    # on the device (see lease()) for the tool to run under; closing it
+    # hands the device back.
+    #
+    request = parse(argv) if forward else None
+    try:
+        if request is None:
+            return lease()
+
+        clean = request.pop('clean', False)
+        reply = call(request)
+        if not reply['ok'] and reply['error'] == 'NOT SERVED':
+            return lease()
+    except OSError:
+        return
+
+    sys.exit(render(request['command'], clean, reply))
+
+
+@click.group()
+def cli():
+    pass
+
+@cli.command(name='serve')
+@click.option('--socket', 'path', default=dogtool.DOGD_SOCKET, show_default=True,
+              help='Socket to listen on')
+@click.option('--mode', default='600', show_default=True,
+              help='Permissions of the socket, in octal')
+def cmd_serve(path, mode):
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    #
+    # Clean up the socket when systemd stops us
+    #
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(path, int(mode, 8))
+    except DogdError as e:
+        raise click.ClickException(str(e))
+
+@cli.command(name='request')
+@click.argument('request')
+@click.option('--socket', 'path', default=dogtool.DOGD_SOCKET, show_default=True,
+              help='Socket of the daemon')
+def cmd_request(request, path):
+    try:
+        print(json.dumps(call(json.loads(request), path)))
+    except OSError as e:
+        raise click.ClickException(f"Can't reach the daemon on {path}: {e}")
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,1112 @@
+#!/usr/bin/env python3
+#
+# In-process stand-in for the `hid` module that emulates Steam Deck
+# controllers well enough to run d20bootloader.py and
+# d21bootloader16.py without hardware on the bench.
+#
+# The emulator models:
+#
+#  - App firmware (three HID interfaces, attribute reports,
+#    ID_REBOOT_INTO_ISP)
+#
+#  - Type 2/3 bootloaders speaking the ERASE_ROW / WRITE_32B /
+#    READ_32B / GET_PARAM protocol, one HID interface per MCU
+#
+#  - Type 1 bootloader speaking the UPDATE_START / DATA / COMPLETE /
+#    ACK protocol with DEBUG_READ_* relayed to the OTHER MCU
+#
+#  - Flash contents with NOR semantics (writes can only clear bits),
+#    D2x 256 byte rows and RA4 8K/32K code flash rows
+#
+#  - Erase/ACK latency, USB re-enumeration after a reset and the
+#    window during which a device enumerates but can't be opened yet
+#
+# All latencies are charged against an injectable clock. With the
+# default VirtualClock nothing actually sleeps, so waiting for a
+# device to re-enumerate costs no real time.
+#
+# Typical use:
+#
+#   import dogemu
+#   emu = dogemu.DogEmulator()
+#   emu.add_controller(dogemu.DeviceType.D2x_D21)
+#   dogemu.install(emu)           # before importing the tools
+#
+#   import d20bootloader, d21bootloader16
+#   dogemu.install(emu, d20bootloader, d21bootloader16)
+#
+# Devices are reached through hidapi, or with install(..., hidraw=True)
+# through dogtransport's hidraw backend, whose ioctls on /dev/hidrawN
+# are then answered by the emulated device.
+#
+import errno
+import glob
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+import crcmod
+
+import doghwid
+
+from enum import IntEnum
+
+VALVE_USB_VID               = 0x28de
+JUPITER_BOOTLOADER_USB_PID  = 0x1004
+JUPITER_USB_PID             = 0x1205
+JUPITER_CONTROL_INTERFACE   = 2
+
+HID_EP_SIZE                 = 64
+
+ID_GET_ATTRIBUTES_VALUES    = 0x83
+ID_REBOOT_INTO_ISP          = 0x90
+ID_FIRMWARE_UPDATE_START    = 0x91
+ID_FIRMWARE_UPDATE_DATA     = 0x92
+ID_FIRMWARE_UPDATE_COMPLETE = 0x93
+ID_FIRMWARE_UPDATE_ACK      = 0x94
+ID_FIRMWARE_UPDATE_REBOOT   = 0x95
+ID_FIRMWARE_ERASE_ROW       = 0xB1
+ID_FIRMWARE_WRITE_32B       = 0xB2
+ID_FIRMWARE_READ_32B        = 0xB3
+ID_SET_PARAM                = 0xB4
+ID_GET_PARAM                = 0xB5
+ID_GET_UNIQUE_ID            = 0xB6
+
+HID_ATTRIB_PRODUCT_ID          = 1
+HID_ATTRIB_FIRMWARE_BUILD_TIME = 4
+HID_ATTRIB_BOARD_REVISION      = 9
+HID_ATTRIB_SECONDARY_FIRMWARE_BUILD_TIME = 12
+
+BLOB_ID_FIRMWARE            = 0
+BLOB_ID_DEVICE_INFO_THIS    = 1
+BLOB_ID_DEVICE_BLOB_THIS    = 2
+BLOB_ID_FIRMWARE_CRC_THIS   = 3
+BLOB_ID_OTHER               = 0x8
+
+UPDATE_STATUS_OK            = 0
+UPDATE_STATUS_ERROR         = 1
+UPDATE_STATUS_BUSY          = 2
+
+DEBUG_SET_SINGLETON_MODE    = 0x8004
+DEBUG_READ_HID_THIS         = 0x8009
+DEBUG_READ_HID_OTHER        = 0x800A
+DEBUG_READ_32B_THIS         = 0x800D
+DEBUG_READ_32B_OTHER        = 0x800E
+DEBUG_SET_FORCE_CRC_CHECK   = 0x800F
+DEBUG_BOOTLOADER_REASON     = 0x8010
+
+BOOTLOADER_REASON_APP       = 0x02
+BOOTLOADER_REASON_BAD_CRC   = 0x0D
+
+NVMCTRL_AUX0_ADDRESS        = 0x00804000
+RA4_DATA_FLASH_START        = 0x0800_0000
+
+MAX_SERIAL_LENGTH           = 30
+DEVICE_INFO_MAGIC           = 0xBEEFFACE
+DEVICE_HEADER_VERSION       = 1
+FLASH_PARTITION_SIZE        = 256
+
+APP_PRODUCT_STRING          = "Steam Deck Controller"
+BOOTLOADER_PRODUCT_STRING   = "Steam Deck Bootloader"
+
+#
+# linux/hidraw.h for 65 byte reports, spelled out here rather than
+# taken from dogtransport, so that a wrong request number there fails
+# on the emulated hidraw node
+#
+HIDIOCSFEATURE_65           = 0xC0414806
+HIDIOCGFEATURE_65           = 0xC0414807
+
+CRCFUN = crcmod.mkCrcFun(0x104C11DB7)
+
+FIRMWARE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class DeviceType(IntEnum):
+    D21_D21 = 0x100
+    D2x_D21 = 0x200
+    RA4     = 0x300
+
+#
+# HW IDs used when the caller doesn't specify one. RA4 units don't
+# have a documented value, so this is a placeholder.
+#
+DEFAULT_HW_ID = {
+    DeviceType.D21_D21 : 27,
+    DeviceType.D2x_D21 : doghwid.HW_ID_D21_HYBRID,
+    DeviceType.RA4     : 40,
+}
+
+
+class HIDException(Exception):
+    pass
+
+
+class VirtualClock:
+    #
+    # Stands in for the `time` module inside the tools. sleep() only
+    # advances a counter, so a full update cycle runs in milliseconds
+    # while still accounting for how long it would take on hardware.
+    #
+    def __init__(self, start=1_700_000_000.0):
+        self._now  = float(start)
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds):
+        with self._lock:
+            self._now += max(0.0, seconds)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def patch(self, *modules):
+        for module in modules:
+            module.time = self
+            if getattr(module, 'sleep', None) is not None:
+                module.sleep = self.sleep
+
+
+class RealClock(VirtualClock):
+    #
+    # Latencies really elapse, scaled by `scale`. Needed when several
+    # threads drive separate devices and their waits have to overlap.
+    # monotonic() runs at the same scale, so deadlines on either side
+    # agree with what sleep() makes elapse.
+    #
+    def __init__(self, scale=1.0):
+        self.scale = scale
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic() / self.scale
+
+    perf_counter = monotonic
+
+    def sleep(self, seconds):
+        time.sleep(max(0.0, seconds) * self.scale)
+
+
+class DogTiming:
+    #
+    # Rough figures for a full speed device behind the Deck's internal
+    # hub. Any of them can be overridden through the constructor.
+    #
+    transfer_s     = 0.001    # One feature report on the control endpoint
+    enumerate_s    = 0.004    # One walk of the HID tree
+    write_32b_s    = 0.0002   # Programming 32 bytes
+    relay_s        = 0.001    # Extra cost of reaching the OTHER MCU
+    enumeration_s  = 1.0      # Reset until the new PID shows up
+    open_delay_s   = 0.5      # Shows up but can't be opened yet
+    isp_reset_s    = 0.01     # ID_REBOOT_INTO_ISP while in the bootloader
+    boot_crc_s     = 0.05     # App CRC check during boot
+    erase_s        = {
+        64        : 0.004,    # RA4 data flash
+        256       : 0.004,    # D2x row
+        8 * 1024  : 0.08,     # RA4 code flash, below 64K
+        32 * 1024 : 0.3,      # RA4 code flash, above 64K
+    }
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            if not hasattr(DogTiming, name):
+                raise TypeError(f"Unknown timing parameter {name}")
+            setattr(self, name, value)
+
+
+class DogEmulatorStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sends        = 0
+        self.gets         = 0
+        self.bytes_out    = 0
+        self.bytes_in     = 0
+        self.enumerations = 0
+        self.opens        = 0
+        self.erases       = 0
+        self.erase_s      = 0.0
+        self.flash_writes = 0
+        self.commands     = {}
+
+    @property
+    def round_trips(self):
+        return self.sends + self.gets
+
+    def as_dict(self):
+        return {
+            'sends'        : self.sends,
+            'gets'         : self.gets,
+            'round_trips'  : self.round_trips,
+            'bytes_out'    : self.bytes_out,
+            'bytes_in'     : self.bytes_in,
+            'enumerations' : self.enumerations,
+            'opens'        : self.opens,
+            'erases'       : self.erases,
+            'erase_s'      : self.erase_s,
+            'flash_writes' : self.flash_writes,
+            'commands'     : {f"0x{k:02X}": v for k, v in sorted(self.commands.items())},
+        }
+
+
+def load_images(directory=FIRMWARE_DIR):
+    #
+    # Returns {family: {timestamp: image}} for every
+    # <family>_APP_REL_<timestamp>.bin in `directory`
+    #
+    images = {}
+    for name in glob.glob(os.path.join(directory, '*_APP_REL_*.bin')):
+        m = re.match(r'(D20|D21|RA)_APP_REL_([0-9A-Fa-f]{8})\.bin$',
+                     os.path.basename(name))
+        if not m:
+            continue
+
+        family = 'RA4' if m.group(1) == 'RA' else m.group(1)
+        with open(name, 'rb') as f:
+            images.setdefault(family, {})[int(m.group(2), 16)] = f.read()
+
+    return images
+
+
+class EmulatedMCU:
+    def __init__(self, family, hw_id, board_serial, unit_serial, unique_id,
+                 bl_build_timestamp):
+        self.family             = family
+        self.unique_id          = unique_id
+        self.bl_build_timestamp = bl_build_timestamp
+
+        self.flash = bytearray(b'\xff' * (256 * 1024))
+        if family == 'RA4':
+            self.app_fw_start = 0x8000
+            self.app_fw_end   = len(self.flash)
+            self.info_offset  = RA4_DATA_FLASH_START
+            self.aux          = bytearray(b'\xff' * (4 * 1024))
+            self.aux_offset   = RA4_DATA_FLASH_START
+        else:
+            self.app_fw_start = 0x4000
+            self.app_fw_end   = len(self.flash) - 4 * 1024
+            self.info_offset  = self.app_fw_end
+            self.aux          = bytearray(b'\x3f\xfe\x55\xd8\xff\xff\x8f\xf8'
+                                          + b'\xff' * 24)
+            self.aux_offset   = NVMCTRL_AUX0_ADDRESS
+
+        self.app_fw_info   = self.app_fw_end - 4
+        self.app_fw_length = self.app_fw_info - self.app_fw_start
+        #
+        # Something that isn't blank where the bootloader lives
+        #
+        self.flash[:self.app_fw_start] = bytes(self.app_fw_start)
+
+        self.reason          = BOOTLOADER_REASON_APP
+        self.state           = 0
+        self.force_crc_check = False
+        self.dirty           = False
+        self.app_timestamp   = 0
+        #
+        # Held while the MCU is busy with a report, including the
+        # flash work that follows it, see Device.send_feature_report()
+        #
+        self.lock            = threading.Lock()
+
+        self.write_info(hw_id, board_serial, unit_serial)
+
+    def _region(self, offset, size):
+        for base, buf in ((0, self.flash), (self.aux_offset, self.aux)):
+            if base <= offset and offset + size <= base + len(buf):
+                return buf, offset - base
+
+        raise HIDException(f"Bad flash address 0x{offset:08x}")
+
+    def row_size(self, offset):
+        if self.family != 'RA4':
+            return FLASH_PARTITION_SIZE
+
+        if self.aux_offset <= offset < self.aux_offset + len(self.aux):
+            return 64
+
+        return 8 * 1024 if offset < 64 * 1024 else 32 * 1024
+
+    def read(self, offset, size):
+        buf, i = self._region(offset, size)
+        return bytes(buf[i : i + size])
+
+    def program(self, offset, data):
+        buf, i = self._region(offset, len(data))
+        n   = len(data)
+        old = int.from_bytes(buf[i : i + n], 'little')
+        new = int.from_bytes(bytes(data), 'little')
+        buf[i : i + n] = (old & new).to_bytes(n, 'little')
+
+        if buf is self.flash and i + n > self.app_fw_start:
+            self.dirty = True
+
+    def erase_row(self, offset):
+        size = self.row_size(offset)
+        base = offset - offset % size
+        if base == NVMCTRL_AUX0_ADDRESS:
+            raise HIDException("User row is read-only")
+
+        buf, i = self._region(base, size)
+        buf[i : i + size] = b'\xff' * size
+
+        if buf is self.flash:
+            self.dirty = True
+
+        return size
+
+    def write_info(self, hw_id, board_serial, unit_serial):
+        layout = struct.Struct(f"<IIII{MAX_SERIAL_LENGTH}s{MAX_SERIAL_LENGTH}s")
+        row = bytearray(layout.pack(0, DEVICE_INFO_MAGIC, DEVICE_HEADER_VERSION,
+                                    hw_id, board_serial.encode('ascii'),
+                                    unit_serial.encode('ascii')))
+        row += b'\xff' * (FLASH_PARTITION_SIZE - len(row))
+        struct.pack_into('<I', row, 0, CRCFUN(bytes(row[4:]), 0))
+
+        buf, i = self._region(self.info_offset, FLASH_PARTITION_SIZE)
+        buf[i : i + FLASH_PARTITION_SIZE] = row
+
+    @property
+    def hw_id(self):
+        crc, magic, ver, hw_id = struct.unpack('<IIII', self.read(self.info_offset, 16))
+        if magic != DEVICE_INFO_MAGIC or ver != DEVICE_HEADER_VERSION:
+            return 0
+
+        return hw_id
+
+    def hid_blob(self):
+        return struct.pack('<BBIIIIIB', 0, self.state, self.app_crc(),
+                           *self.unique_id, self.reason) + bytes(self.aux[:8])
+
+    def app_crc(self):
+        return CRCFUN(bytes(self.flash[self.app_fw_start : self.app_fw_info]), 0)
+
+    def stored_crc(self):
+        return struct.unpack_from('<I', self.flash, self.app_fw_info)[0]
+
+    def load_app(self, image, timestamp):
+        end = self.app_fw_start + len(image)
+        self.flash[self.app_fw_start : self.app_fw_end] = b'\xff' * (self.app_fw_end -
+                                                                   self.app_fw_start)
+        self.flash[self.app_fw_start : end] = image
+        struct.pack_into('<I', self.flash, self.app_fw_info, self.app_crc())
+        self.app_timestamp = timestamp
+        self.dirty         = False
+
+    def boot(self, images):
+        #
+        # Returns True if the app starts. The bootloader only re-checks
+        # the CRC when asked to, or when flash changed since the last
+        # boot.
+        #
+        if self.force_crc_check or self.dirty:
+            if self.app_crc() != self.stored_crc():
+                self.reason        = BOOTLOADER_REASON_BAD_CRC
+                self.app_timestamp = 0
+                return False
+
+            self.app_timestamp = 0
+            app = self.flash[self.app_fw_start : self.app_fw_info]
+            for timestamp, image in images.get(self.family, {}).items():
+                if app.startswith(image) and \
+                   app.count(0xFF, len(image)) == len(app) - len(image):
+                    self.app_timestamp = timestamp
+                    break
+
+        self.dirty           = False
+        self.force_crc_check = False
+        self.state           = 0
+        self.reason          = BOOTLOADER_REASON_APP
+        return True
+
+
+class EmulatedController:
+    def __init__(self, emulator, device_type, mcus, serial):
+        self.emulator    = emulator
+        self.device_type = device_type
+        self.mcus        = mcus
+        self.serial      = serial
+        self.lock        = threading.RLock()
+
+        self.mode        = 'app'
+        self.generation  = 0
+        self.visible_at  = 0.0
+        self.openable_at = 0.0
+        self.paths       = []
+        self.singleton   = False
+
+        self._allocate_paths()
+
+    @property
+    def primary(self):
+        return self.mcus[0]
+
+    @property
+    def secondary(self):
+        return self.mcus[1] if len(self.mcus) > 1 else None
+
+    def _allocate_paths(self):
+        count = 3 if self.mode == 'app' else \
+                2 if self.device_type == DeviceType.D2x_D21 else 1
+        self.paths = [self.emulator.allocate_path() for _ in range(count)]
+
+    def reenumerate(self, mode):
+        timing           = self.emulator.timing
+        now              = self.emulator.clock.monotonic()
+        self.mode        = mode
+        self.generation += 1
+        self.visible_at  = now + timing.enumeration_s
+        self.openable_at = self.visible_at + timing.open_delay_s
+        self._allocate_paths()
+
+    def visible(self):
+        return self.emulator.clock.monotonic() >= self.visible_at
+
+    def openable(self):
+        return self.emulator.clock.monotonic() >= self.openable_at
+
+    def interfaces(self):
+        if not self.visible():
+            return []
+
+        app = self.mode == 'app'
+        pid = JUPITER_USB_PID if app else JUPITER_BOOTLOADER_USB_PID
+        product = APP_PRODUCT_STRING if app else BOOTLOADER_PRODUCT_STRING
+
+        ifaces = []
+        for number in range(len(self.paths)):
+            path   = self.paths[number]
+            vendor = not app or number == JUPITER_CONTROL_INTERFACE
+            ifaces.append({
+                'path'                : path,
+                'vendor_id'           : VALVE_USB_VID,
+                'product_id'          : pid,
+                'serial_number'       : self.serial,
+                'release_number'      : int(self.device_type),
+                'manufacturer_string' : 'Valve Software',
+                'product_string'      : product,
+                'usage_page'          : 0xFFFF if vendor else 0x0001,
+                'usage'               : 0x0001,
+                'interface_number'    : number,
+            })
+
+        return ifaces
+
+    def reboot(self):
+        images  = self.emulator.images
+        timing  = self.emulator.timing
+        booted  = True
+        for mcu in self.mcus:
+            if mcu.force_crc_check or mcu.dirty:
+                self.emulator.clock.sleep(timing.boot_crc_s)
+            if not mcu.boot(images) and mcu is self.primary:
+                booted = False
+
+        self.reenumerate('app' if booted else 'bootloader')
+
+    def attributes(self):
+        if self.mode == 'app':
+            attrs = [(HID_ATTRIB_PRODUCT_ID, JUPITER_USB_PID),
+                     (HID_ATTRIB_FIRMWARE_BUILD_TIME, self.primary.app_timestamp),
+                     (HID_ATTRIB_BOARD_REVISION, self.primary.hw_id)]
+            if self.secondary:
+                attrs += [(HID_ATTRIB_SECONDARY_FIRMWARE_BUILD_TIME,
+                           self.secondary.app_timestamp)]
+        else:
+            attrs = [(HID_ATTRIB_PRODUCT_ID, JUPITER_BOOTLOADER_USB_PID),
+                     (HID_ATTRIB_FIRMWARE_BUILD_TIME, self.primary.bl_build_timestamp),
+                     (HID_ATTRIB_BOARD_REVISION, self.primary.hw_id)]
+
+        payload = b''.join(struct.pack('<BI', t, v) for t, v in attrs)
+        return bytes([ID_GET_ATTRIBUTES_VALUES, len(payload)]) + payload
+
+
+class DogEmulator:
+    def __init__(self, clock=None, timing=None, images=None):
+        self.clock       = clock if clock is not None else VirtualClock()
+        self.timing      = timing if timing is not None else DogTiming()
+        self.images      = images if images is not None else load_images()
+        self.stats       = DogEmulatorStats()
+        self.controllers = []
+        #
+        # Number of 32 byte chunks the type 1 bootloader streams for a
+        # single DEBUG_READ_32B request before ending the transfer.
+        # None means until the end of flash.
+        #
+        self.max_stream_chunks = None
+
+        self._lock      = threading.RLock()
+        self._next_path = 0
+
+    def allocate_path(self):
+        with self._lock:
+            path = f"/dev/hidraw{self._next_path}".encode()
+            self._next_path += 1
+            return path
+
+    def add_controller(self, device_type, hw_id=None, mode='app', timestamps=None,
+                       serial=None):
+        #
+        # `timestamps` selects which shipped image each MCU starts out
+        # running, primary first. By default (or for a None entry) an
+        # MCU runs the oldest image of its family, so there is
+        # something to update.
+        #
+        device_type = DeviceType(device_type)
+        hw_id       = DEFAULT_HW_ID[device_type] if hw_id is None else hw_id
+        index       = len(self.controllers)
+        serial      = serial or f"FVAA2{index:07d}"
+
+        if device_type == DeviceType.RA4:
+            families = ['RA4']
+        elif device_type == DeviceType.D2x_D21:
+            #
+            # Only the units dogcatalog knows the secondary of
+            #
+            import dogcatalog
+
+            families = ['D21', dogcatalog.family_for(device_type, hw_id, secondary=True)]
+        else:
+            families = ['D21', 'D21']
+
+        mcus = []
+        for side in range(len(families)):
+            family = families[side]
+            mcu = EmulatedMCU(family, hw_id,
+                              board_serial=f"{serial}{'LR'[side]}",
+                              unit_serial=serial,
+                              unique_id=(0x5A000000 + index, 0x11 * (side + 1),
+                                         0x22 * (side + 1), 0x33 * (side + 1)),
+                              bl_build_timestamp=0x6123_4567)
+
+            known     = self.images.get(family, {})
+            timestamp = timestamps[side] if timestamps is not None else None
+            if timestamp is None and known:
+                timestamp = min(known)
+
+            if timestamp is not None:
+                mcu.load_app(known[timestamp], timestamp)
+
+            mcus.append(mcu)
+
+        controller = EmulatedController(self, device_type, mcus, serial)
+        if mode != 'app':
+            controller.mode = mode
+            controller._allocate_paths()
+
+        self.controllers.append(controller)
+        return controller
+
+    def enumerate(self, vid=0, pid=0):
+        self.stats.enumerations += 1
+        self.clock.sleep(self.timing.enumerate_s)
+
+        with self._lock:
+            ifaces = []
+            for controller in self.controllers:
+                for iface in controller.interfaces():
+                    if vid and iface['vendor_id'] != vid:
+                        continue
+                    if pid and iface['product_id'] != pid:
+                        continue
+                    ifaces.append(iface)
+
+            return ifaces
+
+    def lookup(self, vid=None, pid=None, serial=None, path=None):
+        if isinstance(path, str):
+            path = path.encode()
+
+        for controller in self.controllers:
+            for iface in controller.interfaces():
+                if path is not None:
+                    if iface['path'] == path:
+                        return controller, iface
+                    continue
+
+                if vid and iface['vendor_id'] != vid:
+                    continue
+                if pid and iface['product_id'] != pid:
+                    continue
+                if serial and iface['serial_number'] != serial:
+                    continue
+
+                return controller, iface
+
+        return None, None
+
+
+class Device:
+    #
+    # Mirrors hid.Device from the `hid` package
+    #
+    def __init__(self, vid=None, pid=None, serial=None, path=None):
+        emulator = _emulator()
+        emulator.stats.opens += 1
+
+        controller, iface = emulator.lookup(vid, pid, serial, path)
+        if controller is None or not controller.openable():
+            raise HIDException("unable to open device")
+
+        self._emulator   = emulator
+        self._controller = controller
+        self._iface      = iface
+        self._generation = controller.generation
+        self._closed     = False
+        self._reply      = None
+        self._stream     = None
+        self._update     = None
+        self._error      = False
+        self._busy_until = 0.0
+        self._flash_s    = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        self._closed = True
+
+    @property
+    def manufacturer(self):
+        return self._iface['manufacturer_string']
+
+    @property
+    def product(self):
+        return self._iface['product_string']
+
+    @property
+    def serial(self):
+        return self._iface['serial_number']
+
+    def _check(self):
+        if self._closed:
+            raise HIDException("device closed")
+        if self._controller.generation != self._generation:
+            raise HIDException("device disconnected")
+
+    @property
+    def _mcu(self):
+        number = self._iface['interface_number']
+        mcus   = self._controller.mcus
+        return mcus[number] if number < len(mcus) else mcus[0]
+
+    def send_feature_report(self, data):
+        data = bytes(data)
+        emulator = self._emulator
+        mcu      = self._mcu
+        with mcu.lock:
+            with self._controller.lock:
+                self._check()
+                emulator.clock.sleep(emulator.timing.transfer_s)
+                emulator.stats.sends     += 1
+                emulator.stats.bytes_out += len(data)
+
+                if len(data) != HID_EP_SIZE + 1 or data[0] != 0x00:
+                    raise HIDException("bad feature report")
+
+                msg = data[1:]
+                emulator.stats.commands[msg[0]] = emulator.stats.commands.get(msg[0], 0) + 1
+
+                if self._controller.mode == 'app':
+                    self._app_command(msg)
+                elif self._controller.device_type == DeviceType.D21_D21:
+                    self._d21_command(msg)
+                else:
+                    self._d20_command(msg)
+
+            #
+            # The bus is shared by all interfaces of the controller,
+            # but each MCU erases and programs its own flash, so the
+            # other MCU's reports go through meanwhile
+            #
+            flash_s, self._flash_s = self._flash_s, 0.0
+            emulator.clock.sleep(flash_s)
+
+        return len(data)
+
+    def get_feature_report(self, report_id, size):
+        emulator = self._emulator
+        with self._mcu.lock, self._controller.lock:
+            self._check()
+            emulator.clock.sleep(emulator.timing.transfer_s)
+            emulator.stats.gets += 1
+
+            if self._stream is not None:
+                report = next(self._stream, None)
+                if report is None:
+                    self._stream = None
+                    report = self._ack(UPDATE_STATUS_OK)
+            elif self._reply is not None:
+                report = self._reply
+                if self._controller.device_type == DeviceType.D21_D21:
+                    self._reply = None
+            else:
+                report = self._ack(self._status())
+
+            report = bytes([report_id]) + bytes(report)
+            report = report + bytes(max(0, size - len(report)))
+            emulator.stats.bytes_in += len(report[:size])
+            return report[:size]
+
+    #
+    # App firmware
+    #
+    def _app_command(self, msg):
+        if self._iface['interface_number'] != JUPITER_CONTROL_INTERFACE:
+            raise HIDException("feature report not supported on this interface")
+
+        if msg[0] == ID_GET_ATTRIBUTES_VALUES:
+            self._reply = self._controller.attributes()
+        elif msg[0] == ID_REBOOT_INTO_ISP:
+            for mcu in self._controller.mcus:
+                mcu.reason = BOOTLOADER_REASON_APP
+            self._controller.reenumerate('bootloader')
+        else:
+            raise HIDException(f"unsupported app command 0x{msg[0]:02x}")
+
+    #
+    # Type 2/3 bootloader: ERASE_ROW / WRITE_32B / READ_32B, one
+    # interface per MCU
+    #
+    def _d20_command(self, msg):
+        emulator = self._emulator
+        timing   = emulator.timing
+        mcu      = self._mcu
+        cmd      = msg[0]
+
+        if cmd == ID_GET_ATTRIBUTES_VALUES:
+            self._reply = self._controller.attributes()
+
+        elif cmd == ID_REBOOT_INTO_ISP:
+            emulator.clock.sleep(timing.isp_reset_s)
+            mcu.state = 0
+
+        elif cmd == ID_FIRMWARE_UPDATE_REBOOT:
+            if mcu is self._controller.primary:
+                self._controller.reboot()
+            else:
+                mcu.boot(emulator.images)
+
+        elif cmd == ID_FIRMWARE_ERASE_ROW:
+            offset, = struct.unpack_from('<I', msg, 2)
+            size = mcu.erase_row(offset)
+            latency = timing.erase_s.get(size, timing.erase_s[256])
+            emulator.stats.erases  += 1
+            emulator.stats.erase_s += latency
+            self._flash_s          += latency
+
+        elif cmd == ID_FIRMWARE_WRITE_32B:
+            offset, = struct.unpack_from('<I', msg, 2)
+            mcu.program(offset, msg[6:38])
+            emulator.stats.flash_writes += 1
+            self._flash_s               += timing.write_32b_s
+
+        elif cmd == ID_FIRMWARE_READ_32B:
+            offset, = struct.unpack_from('<I', msg, 2)
+            self._reply = struct.pack('<BBI', ID_FIRMWARE_READ_32B, 4 + 32, offset) + \
+                          mcu.read(offset, 32)
+
+        elif cmd == ID_SET_PARAM:
+            param, value = struct.unpack_from('<HL', msg, 2)
+            if param == DEBUG_SET_FORCE_CRC_CHECK:
+                mcu.force_crc_check = bool(value)
+            else:
+                raise HIDException(f"unsupported param 0x{param:04x}")
+
+        elif cmd == ID_GET_PARAM:
+            param, _ = struct.unpack_from('<HL', msg, 2)
+            if param != DEBUG_BOOTLOADER_REASON:
+                raise HIDException(f"unsupported param 0x{param:04x}")
+            self._reply = struct.pack('<BBHL', ID_GET_PARAM, 6, param, mcu.reason)
+
+        elif cmd == ID_GET_UNIQUE_ID:
+            self._reply = struct.pack('<BBIIII', ID_GET_UNIQUE_ID, 16, *mcu.unique_id)
+
+        else:
+            raise HIDException(f"unsupported bootloader command 0x{cmd:02x}")
+
+    #
+    # Type 1 bootloader: UPDATE_START / DATA / COMPLETE / ACK, with
+    # the OTHER MCU reached through the primary
+    #
+    def _d21_command(self, msg):
+        emulator   = self._emulator
+        timing     = emulator.timing
+        controller = self._controller
+        cmd        = msg[0]
+        #
+        # A new request ends whatever reply was still pending
+        #
+        self._reply  = None
+        self._stream = None
+
+        if cmd == ID_GET_ATTRIBUTES_VALUES:
+            self._reply = controller.attributes()
+
+        elif cmd == ID_REBOOT_INTO_ISP:
+            emulator.clock.sleep(timing.isp_reset_s)
+            self._update = None
+            self._stream = None
+            controller.singleton = False
+
+        elif cmd == ID_FIRMWARE_UPDATE_START:
+            blob_id = msg[2] if msg[1] else BLOB_ID_FIRMWARE
+            self._start_update(blob_id)
+
+        elif cmd == ID_FIRMWARE_UPDATE_DATA:
+            update = self._update
+            if update is None or emulator.clock.monotonic() < self._busy_until:
+                self._error = True
+                return
+
+            data = msg[2 : 2 + msg[1]]
+            for mcu in update['mcus']:
+                mcu.program(update['cursor'], data)
+            emulator.stats.flash_writes += 1
+            update['cursor'] += len(data)
+
+        elif cmd == ID_FIRMWARE_UPDATE_COMPLETE:
+            update = self._update
+            if update is None:
+                self._error = True
+                return
+
+            crc, = struct.unpack_from('<I', msg, 2)
+            for mcu in update['mcus']:
+                if update['blob_id'] == BLOB_ID_FIRMWARE:
+                    mcu.program(mcu.app_fw_info, struct.pack('<I', crc))
+                elif update['blob_id'] == BLOB_ID_FIRMWARE_CRC_THIS:
+                    mcu.program(mcu.app_fw_info,
+                                struct.pack('<I', mcu.app_crc() if crc == 0 else crc))
+                else:
+                    mcu.program(update['row'], struct.pack('<I', crc))
+                mcu.state = 0
+            self._update = None
+
+        elif cmd == ID_FIRMWARE_UPDATE_ACK:
+            _, _, offset, code = struct.unpack_from('<BBIH', msg)
+            self._debug_command(code, offset)
+
+        elif cmd == ID_FIRMWARE_UPDATE_REBOOT:
+            controller.reboot()
+
+        else:
+            raise HIDException(f"unsupported bootloader command 0x{cmd:02x}")
+
+    def _side(self, other):
+        controller = self._controller
+        if other:
+            if controller.secondary is None or controller.singleton:
+                raise HIDException("OTHER MCU not available")
+            return controller.secondary
+
+        return controller.primary
+
+    def _start_update(self, blob_id):
+        emulator = self._emulator
+        timing   = emulator.timing
+        other    = bool(blob_id & BLOB_ID_OTHER)
+        kind     = blob_id & ~BLOB_ID_OTHER
+
+        if kind == BLOB_ID_FIRMWARE:
+            mcus = [m for m in self._controller.mcus
+                    if m is self._controller.primary or not self._controller.singleton]
+        else:
+            mcus = [self._side(other)]
+
+        primary = mcus[0]
+        if kind == BLOB_ID_FIRMWARE:
+            rows = range(primary.app_fw_start, primary.app_fw_end, FLASH_PARTITION_SIZE)
+        elif kind == BLOB_ID_FIRMWARE_CRC_THIS:
+            rows = [primary.app_fw_end - FLASH_PARTITION_SIZE]
+        elif kind == BLOB_ID_DEVICE_INFO_THIS:
+            rows = [primary.info_offset]
+        elif kind == BLOB_ID_DEVICE_BLOB_THIS:
+            rows = [primary.info_offset + FLASH_PARTITION_SIZE]
+        else:
+            raise HIDException(f"unsupported blob 0x{blob_id:02x}")
+
+        for mcu in mcus:
+            for row in rows:
+                mcu.erase_row(row)
+            mcu.state = 1
+
+        latency = len(rows) * timing.erase_s[FLASH_PARTITION_SIZE]
+        emulator.stats.erases  += len(rows) * len(mcus)
+        emulator.stats.erase_s += latency
+
+        self._busy_until = emulator.clock.monotonic() + latency
+        self._error      = False
+        self._update     = {
+            'blob_id' : kind,
+            'mcus'    : mcus,
+            'row'     : rows[0],
+            'cursor'  : rows[0],
+        }
+
+    def _debug_command(self, code, offset):
+        emulator   = self._emulator
+        controller = self._controller
+
+        if code == DEBUG_SET_SINGLETON_MODE:
+            controller.singleton = True
+
+        elif code in (DEBUG_READ_HID_THIS, DEBUG_READ_HID_OTHER):
+            mcu = self._side(code == DEBUG_READ_HID_OTHER)
+            self._stream = self._debug_stream(code, offset, [mcu.hid_blob()],
+                                              code == DEBUG_READ_HID_OTHER)
+
+        elif code in (DEBUG_READ_32B_THIS, DEBUG_READ_32B_OTHER):
+            mcu = self._side(code == DEBUG_READ_32B_OTHER)
+            self._stream = self._debug_stream(code, offset,
+                                              self._flash_chunks(mcu, offset),
+                                              code == DEBUG_READ_32B_OTHER)
+
+        elif code == DEBUG_SET_FORCE_CRC_CHECK:
+            for mcu in controller.mcus:
+                mcu.force_crc_check = bool(offset)
+
+        else:
+            raise HIDException(f"unsupported debug code 0x{code:04x}")
+
+    def _flash_chunks(self, mcu, offset):
+        limit = self._emulator.max_stream_chunks
+        count = 0
+        while limit is None or count < limit:
+            try:
+                yield mcu.read(offset, 32)
+            except HIDException:
+                return
+            offset += 32
+            count  += 1
+
+    def _debug_stream(self, code, offset, chunks, relayed):
+        emulator = self._emulator
+        for chunk in chunks:
+            if relayed:
+                emulator.clock.sleep(emulator.timing.relay_s)
+            yield struct.pack('<BBIH', ID_FIRMWARE_UPDATE_ACK, 6 + len(chunk),
+                              offset, code) + chunk
+            offset += len(chunk)
+
+    def _status(self):
+        if self._error:
+            return UPDATE_STATUS_ERROR
+        if self._emulator.clock.monotonic() < self._busy_until:
+            return UPDATE_STATUS_BUSY
+        for mcu in self._controller.mcus:
+            if mcu.state == 1:
+                mcu.state = 2
+        return UPDATE_STATUS_OK
+
+    def _ack(self, code):
+        return struct.pack('<BBIH', ID_FIRMWARE_UPDATE_ACK, 6, 0, code)
+
+
+_EMULATOR = None
+
+def _emulator():
+    if _EMULATOR is None:
+        raise HIDException("no emulator installed")
+    return _EMULATOR
+
+def enumerate(vid=0, pid=0):
+    return _emulator().enumerate(vid, pid)
+
+def _find_hidraw(vid, pid, serial, path):
+    _, iface = _emulator().lookup(vid, pid, serial, path)
+    if iface is None:
+        raise HIDException("unable to open device")
+
+    return iface
+
+
+def _hidraw_device(dogtransport):
+    #
+    # dogtransport.DogHidrawDevice on an emulated /dev/hidrawN: the
+    # feature report ioctls it issues go to the emulated device, and
+    # its errors come back as OSError, as the kernel reports them
+    #
+    class EmulatedHidrawDevice(dogtransport.DogHidrawDevice):
+        emulated = True
+
+        def __init__(self, iface):
+            super().__init__(iface)
+            self.ioctl = self._ioctl
+
+        def open(self, path):
+            self.device = Device(path=path)
+            return os.open(os.devnull, os.O_RDWR | os.O_CLOEXEC)
+
+        def close(self):
+            super().close()
+            self.device.close()
+
+        def _ioctl(self, fd, request, buf, mutate=True):
+            try:
+                if request == HIDIOCSFEATURE_65:
+                    return self.device.send_feature_report(buf)
+                if request == HIDIOCGFEATURE_65:
+                    report = self.device.get_feature_report(buf[0], len(buf))
+                    buf[:len(report)] = report
+                    return len(report)
+            except HIDException as e:
+                raise OSError(errno.EIO, str(e)) from e
+
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+
+    return EmulatedHidrawDevice
+
+
+def install(emulator, *modules, hidraw=False):
+    #
+    # Makes `import hid` resolve to this module and points the given,
+    # already imported, tool modules at the emulator and its clock.
+    # With `hidraw`, dogtransport opens the emulated devices as hidraw
+    # nodes instead of through hidapi.
+    #
+    global _EMULATOR
+    _EMULATOR = emulator
+
+    this = sys.modules[__name__]
+    sys.modules['hid'] = this
+    #
+    # The tools wait for devices through dogwait, which has to follow
+    # the same clock, and can't watch /dev for emulated devices. Nor
+    # can dogenum list them from sysfs, and dogtransport only opens
+    # them as hidraw nodes with `hidraw`.
+    #
+    import dogenum
+    import dogtransport
+    import dogwait
+    dogwait.USE_INOTIFY    = False
+    dogenum.USE_SYSFS      = False
+    dogtransport.BACKEND   = 'hidapi'
+    modules = [*modules, dogwait, dogenum, dogtransport]
+
+    if hidraw:
+        dogtransport.BACKEND = 'hidraw'
+        dogtransport.find    = _find_hidraw
+        if not getattr(dogtransport.DogHidrawDevice, 'emulated', False):
+            dogtransport.DogHidrawDevice = _hidraw_device(dogtransport)
+
+    for module in modules:
+        module.hid = this
+
+    emulator.clock.patch(*modules)
+    return emulator
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+#
+# Device discovery shared by both tools. It needs nothing but hid, so
+# the commands that only enumerate devices and read their app
+# attributes (getdevicesjson and getappbuildtimestamp) can run
+# without importing the rest of the tools, see dogtool.py.
+#
+# On Linux, devices are listed from sysfs by dogsysfs, which only
+# describes a hidraw node again after a hotplug event. Elsewhere, or if
+# sysfs can't be read, hid.enumerate() is used.
+#
+import hid
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+import dogsysfs
+import dogtransport
+
+ID_GET_ATTRIBUTES_VALUES    = 0x83
+
+HID_ATTRIB_FIRMWARE_BUILD_TIME = 4
+HID_ATTRIB_SECONDARY_FIRMWARE_BUILD_TIME = 12
+
+HID_EP_SIZE                 = 64
+
+#
+# The PIDs can be overridden from the environment to work with EV1
+# units, see d21bootloader16.py
+#
+JUPITER_BOOTLOADER_USB_VID  = 0x28de
+JUPITER_BOOTLOADER_USB_PID  = int(os.getenv('JUPITER_BOOTLOADER_USB_PID', '0x1004'), 16)
+JUPITER_USB_PID             = int(os.getenv('JUPITER_USB_PID', '0x1205'), 16)
+JUPITER_USB_INTERFACE       = 2
+
+#
+# Devices get_devices() queries at the same time. Each query is a
+# couple of feature reports, so waiting on the bus dominates.
+#
+MAX_QUERY_THREADS           = 4
+
+USE_SYSFS                   = sys.platform.startswith('linux')
+
+#
+# hidapi's enumeration isn't safe to run from several threads at once
+#
+_enumerate_lock = threading.Lock()
+
+
+def enumerate(vid=0, pid=0, serial=None):
+    #
+    # Like hid.enumerate(). With `serial`, only the interfaces of the
+    # controller with that USB serial number are listed.
+    #
+    devs = None
+    if USE_SYSFS:
+        try:
+            devs = dogsysfs.enumerate(vid, pid)
+        except OSError:
+            pass
+
+    if devs is None:
+        with _enumerate_lock:
+            devs = hid.enumerate(vid, pid)
+
+    if serial is not None:
+        devs = [d for d in devs if d['serial_number'] == serial]
+
+    return devs
+
+
+if sys.platform == 'win32':
+    def dog_enumerate(pid=JUPITER_USB_PID, serial=None):
+        return [d for d in enumerate(JUPITER_BOOTLOADER_USB_VID, pid, serial)
+                if d['usage_page'] >= 0xFF00]
+else:
+    def dog_enumerate(pid=JUPITER_USB_PID, serial=None):
+        devs = enumerate(JUPITER_BOOTLOADER_USB_VID, pid, serial)
+
+        iface_number = JUPITER_USB_INTERFACE if pid == JUPITER_USB_PID else 0
+
+        if len(devs) > 1:
+            devs = [d for d in devs if
+                    d['interface_number'] == iface_number]
+
+        return devs
+
+def get_attributes(hiddev):
+    hiddev.send_report(bytes([ID_GET_ATTRIBUTES_VALUES, 0]))
+
+    reply = hiddev.get_report()
+    _, length = struct.unpack_from('<BB', reply)
+
+    attrib_len = struct.calcsize('<BI')
+    return [struct.unpack_from('<BI', reply, 2 + off)
+            for off in range(0, length, attrib_len)]
+
+def get_dev_build_timestamp(dev):
+    with dogtransport.open_device(path=dev['path']) as hiddev:
+        attributes = get_attributes(hiddev)
+
+    primary_timestamp = 0
+    secondary_timestamp = 0
+    for tag, value in attributes:
+        if tag == HID_ATTRIB_FIRMWARE_BUILD_TIME:
+            primary_timestamp = value
+        elif tag == HID_ATTRIB_SECONDARY_FIRMWARE_BUILD_TIME:
+            secondary_timestamp = value
+    return primary_timestamp, secondary_timestamp
+
+def get_devices(app_pid=JUPITER_USB_PID, bootloader_pid=JUPITER_BOOTLOADER_USB_PID,
+                timestamps=get_dev_build_timestamp):
+    #
+    # Each device is queried once, up to MAX_QUERY_THREADS of them at
+    # a time. `timestamps` reads the build timestamps of one device,
+    # dogd.py passes one that answers from its cache.
+    #
+    rawdevs = [ *dog_enumerate(app_pid), *dog_enumerate(bootloader_pid) ]
+    if len(rawdevs) > 1 and MAX_QUERY_THREADS > 1:
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(
+                min(len(rawdevs), MAX_QUERY_THREADS)) as pool:
+            queried = list(pool.map(timestamps, rawdevs))
+    else:
+        queried = [ timestamps(item) for item in rawdevs ]
+
+    return [ { **item,
+               'build_timestamp': primary,
+               'secondary_build_timestamp': secondary,
+               'is_bootloader': item['product_id'] == bootloader_pid,
+               'path': item['path'].decode('utf-8') }
+             for item, (primary, secondary) in zip(rawdevs, queried) ]
+
+def getdevicesjson(app_pid=JUPITER_USB_PID, bootloader_pid=JUPITER_BOOTLOADER_USB_PID):
+    print(json.dumps(get_devices(app_pid, bootloader_pid)))
+
+def get_app(vid=JUPITER_BOOTLOADER_USB_VID, pid=JUPITER_USB_PID, serial=None):
+    #
+    # The one controller running the app, or why there isn't exactly
+    # one. With `serial`, only that controller is looked for.
+    #
+    if sys.platform == 'win32':
+        devs =  [d for d in enumerate(vid, pid, serial)
+            if d['usage_page'] >= 0xFF00]
+    else:
+        devs = enumerate(vid, pid, serial)
+
+    if len(devs) > 1:
+        devs = [d for d in devs if
+                d['interface_number'] == JUPITER_USB_INTERFACE]
+
+    # Disallow report when multiple controllers are connected
+    if len(devs) > 1:
+        return None, 'Multiple controllers detected.'
+
+    if len(devs) == 0:
+        return None, 'No Controller found at VID: {} PID: {}'.format(hex(vid), hex(pid))
+
+    return devs[0], None
+
+def getappbuildtimestamp(vid=JUPITER_BOOTLOADER_USB_VID, pid=JUPITER_USB_PID, primary=True,
+                         serial=None):
+    dev, error = get_app(vid, pid, serial)
+    if error:
+        print(error)
+        print('ERROR')
+        return
+
+    if primary:
+        print(get_dev_build_timestamp(dev)[0])
+    else:
+        print(get_dev_build_timestamp(dev)[1])
+
+    print('SUCCESS')
+
+def check_app_builds(firmware, secondary_firmware=None, serial=None,
+                     vid=JUPITER_BOOTLOADER_USB_VID, pid=JUPITER_USB_PID):
+    #
+    # Why the app doesn't report the builds of the images just
+    # programmed, or None if it does. Builds are known from the catalog
+    # names of the images, see dogcatalog.py; images named otherwise
+    # aren't checked.
+    #
+    import dogcatalog
+
+    dev, error = get_app(vid, pid, serial)
+    if error:
+        return error
+
+    reported = get_dev_build_timestamp(dev)
+    for side, image, timestamp in zip(('primary', 'secondary'),
+                                      (firmware, secondary_firmware), reported):
+        named = dogcatalog.parse_name(os.path.basename(image)) if image else None
+        if named and named[1] != timestamp:
+            return (f"The {side} app reports build 0x{timestamp:08X}, "
+                    f"{os.path.basename(image)} is 0x{named[1]:08X}")
+
+    return None
+
+def serial_for(serial=None, path=None):
+    #
+    # Serial number of the controller picked on a command line, by
+    # serial number or by the HID path of any of its interfaces.
+    # Paths change whenever a controller resets, so the tools follow
+    # it by serial number.
+    #
+    if path is None:
+        return serial
+
+    for d in enumerate(JUPITER_BOOTLOADER_USB_VID):
+        if os.fsdecode(d['path']) == path:
+            if not d['serial_number']:
+                raise hid.HIDException(f"{path} has no serial number to follow it by")
+            if serial is not None and serial != d['serial_number']:
+                raise hid.HIDException(f"{path} isn't controller {serial}")
+            return d['serial_number']
+
+    raise hid.HIDException(f"No controller at {path}")
+
+def get_controllers(app_pid=JUPITER_USB_PID, bootloader_pid=JUPITER_BOOTLOADER_USB_PID):
+    #
+    # Serial number: device type (USB release number) of every
+    # attached controller, in the app or in the bootloader
+    #
+    found = {}
+    for pid in (app_pid, bootloader_pid):
+        for d in enumerate(JUPITER_BOOTLOADER_USB_VID, pid):
+            if not d['serial_number']:
+                raise hid.HIDException(f"{os.fsdecode(d['path'])} has no serial number, "
+                                       "controllers can't be told apart")
+            found.setdefault(d['serial_number'], d['release_number'])
+
+    return found
+
+def run_per_controller(fn, serials):
+    #
+    # Runs fn(serial) for all controllers at once, on a thread each.
+    # Returns serial: (error message or None, seconds taken), in the
+    # order given.
+    #
+    import concurrent.futures
+
+    def timed(serial):
+        start = time.monotonic()
+        try:
+            fn(serial)
+            error = None
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        return error, time.monotonic() - start
+
+    if not serials:
+        return {}
+
+    with concurrent.futures.ThreadPoolExecutor(len(serials)) as pool:
+        return dict(zip(serials, pool.map(timed, serials)))
+
+def print_results(results):
+    #
+    # One line per controller, then the overall result. Returns True
+    # if all of them succeeded.
+    #
+    for serial, (error, seconds) in results.items():
+        print(f"{serial}: {'ERROR ' + error if error else 'SUCCESS'} ({seconds:.1f} s)")
+
+    ok = bool(results) and not any(error for error, _ in results.values())
+    print('SUCCESS' if ok else 'ERROR')
+    return ok
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+#
+# HW IDs of the units with a type 2 bootloader (D2x_D21), as stored in
+# the device info of the primary MCU. They decide which tool drives a
+# unit, even one that enumerates as another type, and which image
+# family its secondary MCU runs. dogtool, dogcatalog, the tools,
+# dogemu.py and jupiter-controller-update all go by this table. Any
+# other HW ID is refused where the secondary's family matters.
+#
+# Run directly, it prints the secondary family of a HW ID, or exits
+# with 1 if it isn't known:
+#
+#   ./doghwid.py 30
+#
+import sys
+
+HW_ID_D20_HYBRID        = 29
+HW_ID_D21_HYBRID        = 30
+HW_ID_D21_HOMOG         = 31
+HW_ID_D21_HOMOG_GALILEO = 32
+
+#
+# HW ID: (tool, secondary MCU family). The family of the secondary of
+# HW ID 29 units isn't known.
+#
+HW_IDS = {
+    HW_ID_D20_HYBRID        : ('d20bootloader', None),
+    HW_ID_D21_HYBRID        : ('d20bootloader', 'D20'),
+    HW_ID_D21_HOMOG         : ('d20bootloader', 'D21'),
+    HW_ID_D21_HOMOG_GALILEO : ('d20bootloader', 'D21'),
+}
+
+
+def tool_for(hw_id):
+    #
+    # The tool that drives units with `hw_id`, or None if that's up to
+    # the device type
+    #
+    tool, _ = HW_IDS.get(hw_id, (None, None))
+    return tool
+
+def secondary_family(hw_id):
+    _, family = HW_IDS.get(hw_id, (None, None))
+    return family
+
+
+if __name__ == '__main__':
+    try:
+        family = secondary_family(int(sys.argv[1]))
+    except (IndexError, ValueError):
+        sys.exit(f"Usage: {sys.argv[0]} HWID")
+
+    if family is None:
+        sys.exit(1)
+
+    print(family)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#
+# Lists hidraw devices from sysfs, in the shape of hid.enumerate().
+#
+# hidapi walks the whole USB/HID tree through udev on every call,
+# which adds up in the wait loops that enumerate every few tens of
+# milliseconds. Here each /sys/class/hidraw/hidrawN is described once,
+# from its uevent, report descriptor and USB parents, and kept until
+# the node goes away or comes back as a different device. Telling the
+# two apart only takes one readlink() per node: the link points into
+# the HID device, whose name has a counter that the kernel bumps for
+# every new device, so a node number reused after a hotplug event
+# never matches a cached entry.
+#
+# Example:
+#
+#   ./dogsysfs.py 0x28de 0x1205
+#
+import json
+import os
+import sys
+import threading
+
+SYSFS_ROOT = '/sys'
+
+#
+# Report descriptor short items, see the HID spec 6.2.2.7
+#
+ITEM_USAGE_PAGE = 0x04
+ITEM_USAGE      = 0x08
+ITEM_COLLECTION = 0xA0
+ITEM_LONG       = 0xFE
+
+BUS_USB         = 0x03
+
+_lock  = threading.Lock()
+_cache = {}
+
+
+def read(directory, name, default=None):
+    try:
+        with open(os.path.join(directory, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def parse_uevent(text):
+    return dict(line.split('=', 1) for line in text.splitlines() if '=' in line)
+
+
+def parse_usage(descriptor):
+    #
+    # Usage page and usage of the first top level collection
+    #
+    usage_page, usage = 0, 0
+
+    i = 0
+    while i < len(descriptor):
+        prefix = descriptor[i]
+        if prefix == ITEM_LONG:
+            i += 3 + (descriptor[i + 1] if i + 1 < len(descriptor) else 0)
+            continue
+
+        size  = (0, 1, 2, 4)[prefix & 0x3]
+        value = int.from_bytes(descriptor[i + 1 : i + 1 + size], 'little')
+        tag   = prefix & 0xFC
+
+        if tag == ITEM_USAGE_PAGE:
+            usage_page = value
+        elif tag == ITEM_USAGE:
+            if size == 4:
+                usage_page, value = value >> 16, value & 0xFFFF
+            usage = value
+        elif tag == ITEM_COLLECTION:
+            break
+
+        i += 1 + size
+
+    return usage_page, usage
+
+
+def describe(node, hid_dir):
+    #
+    # The hid.enumerate() entry for hidraw `node`, whose HID device is
+    # `hid_dir`, or None if it can't be read (e.g. it went away)
+    #
+    uevent = read(hid_dir, 'uevent')
+    if uevent is None:
+        return None
+
+    uevent = parse_uevent(uevent)
+    try:
+        bus, vid, pid = (int(v, 16) for v in uevent['HID_ID'].split(':'))
+    except (KeyError, ValueError):
+        return None
+
+    try:
+        with open(os.path.join(hid_dir, 'report_descriptor'), 'rb') as f:
+            usage_page, usage = parse_usage(f.read())
+    except OSError:
+        usage_page, usage = 0, 0
+
+    iface = {
+        'path'                : f"/dev/{node}".encode(),
+        'vendor_id'           : vid,
+        'product_id'          : pid,
+        'serial_number'       : uevent.get('HID_UNIQ', ''),
+        'release_number'      : 0,
+        'manufacturer_string' : '',
+        'product_string'      : uevent.get('HID_NAME', ''),
+        'usage_page'          : usage_page,
+        'usage'               : usage,
+        'interface_number'    : -1,
+    }
+
+    if bus == BUS_USB:
+        #
+        # HID device -> USB interface -> USB device
+        #
+        usb_iface  = os.path.dirname(hid_dir)
+        usb_device = os.path.dirname(usb_iface)
+
+        number  = read(usb_iface, 'bInterfaceNumber')
+        release = read(usb_device, 'bcdDevice')
+        if number is not None:
+            iface['interface_number'] = int(number, 16)
+        if release is not None:
+            iface['release_number'] = int(release, 16)
+
+        iface['manufacturer_string'] = read(usb_device, 'manufacturer', '')
+        iface['product_string']      = read(usb_device, 'product', iface['product_string'])
+        iface['serial_number']       = read(usb_device, 'serial', iface['serial_number'])
+
+    return iface
+
+
+def node_number(node):
+    return int(node[len('hidraw'):]) if node[len('hidraw'):].isdigit() else sys.maxsize
+
+
+def enumerate(vid=0, pid=0):
+    #
+    # Like hid.enumerate(): a zero `vid` or `pid` matches any. Raises
+    # OSError if sysfs has no hidraw class.
+    #
+    classdir = os.path.join(SYSFS_ROOT, 'class', 'hidraw')
+    nodes    = sorted(os.listdir(classdir), key=node_number)
+
+    with _lock:
+        seen = {}
+        for node in nodes:
+            try:
+                link = os.readlink(os.path.join(classdir, node))
+            except OSError:
+                continue
+
+            hit = _cache.get(node)
+            if hit is None or hit[0] != link:
+                hid_dir = os.path.realpath(os.path.join(classdir, node, 'device'))
+                hit     = link, describe(node, hid_dir)
+
+            seen[node] = hit
+
+        _cache.clear()
+        _cache.update(seen)
+
+        return [dict(iface) for _, iface in seen.values()
+                if iface is not None and
+                   (not vid or iface['vendor_id'] == vid) and
+                   (not pid or iface['product_id'] == pid)]
+
+
+if __name__ == '__main__':
+    vid, pid = (int(v, 16) for v in (sys.argv[1:] + ['0', '0'])[:2])
+    print(json.dumps([{**i, 'path': i['path'].decode()} for i in enumerate(vid, pid)],
+                     indent=2))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+#
+# Checks the tools against the emulated controllers of dogemu.py.
+# Nothing touches real hardware, and the emulator's virtual clock means
+# waiting for devices costs no real time.
+#
+# Example:
+#
+#   ./dogtest.py -v
+#   python3 -m unittest dogtest.DogHidrawTest
+#
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(__file__))
+
+import dogcatalog
+import dogcrc
+import dogemu
+
+FIRMWARE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#
+# As in dogbench.py, the tools import hid when they load, so they are
+# only imported once the emulator stands in for it
+#
+d20bootloader   = None
+d21bootloader16 = None
+dogenum         = None
+dogtransport    = None
+
+
+def setUpModule():
+    global d20bootloader, d21bootloader16, dogenum, dogtransport
+
+    dogemu.install(dogemu.DogEmulator())
+
+    import d20bootloader
+    import d21bootloader16
+    import dogenum
+    import dogtransport
+
+
+def latest(family):
+    return dogcatalog.load(FIRMWARE_DIR).latest(family)
+
+
+class DogEmulatorTest(unittest.TestCase):
+    #
+    # Each test gets a fresh emulator with a single controller
+    #
+    DEVICE_TYPE = dogemu.DeviceType.D2x_D21
+    HIDRAW      = False
+
+    def setUp(self):
+        self.emulator   = dogemu.DogEmulator()
+        self.controller = self.emulator.add_controller(self.DEVICE_TYPE)
+        dogemu.install(self.emulator, d20bootloader, d21bootloader16, hidraw=self.HIDRAW)
+
+    def control_path(self):
+        iface = self.controller.interfaces()[dogenum.JUPITER_USB_INTERFACE]
+        return iface['path']
+
+
+class DogHidrawTest(DogEmulatorTest):
+    #
+    # dogtransport's hidraw backend, with its ioctls answered by the
+    # emulated device
+    #
+    HIDRAW = True
+
+    def test_ioctl_requests(self):
+        self.assertEqual(dogtransport.HIDIOCSFEATURE, dogemu.HIDIOCSFEATURE_65)
+        self.assertEqual(dogtransport.HIDIOCGFEATURE, dogemu.HIDIOCGFEATURE_65)
+
+    def test_opens_hidraw(self):
+        with dogtransport.open_device(path=self.control_path()) as dev:
+            self.assertEqual(dev.backend, 'hidraw')
+            self.assertEqual(dev.serial, self.controller.serial)
+
+    def test_attributes(self):
+        primary, secondary = self.controller.mcus
+        device, = dogenum.get_devices()
+        self.assertEqual(device['build_timestamp'], primary.app_timestamp)
+        self.assertEqual(device['secondary_build_timestamp'], secondary.app_timestamp)
+
+    def test_program(self):
+        entry = latest('D21')
+        d20bootloader.program_device(entry.path, True)
+        self.assertEqual(self.controller.primary.app_timestamp, entry.timestamp)
+
+    def test_disconnect(self):
+        dev = dogtransport.open_device(path=self.control_path())
+        self.controller.reenumerate('app')
+        with self.assertRaises(dogemu.HIDException):
+            dogenum.get_attributes(dev)
+        dev.close()
+
+    def test_bad_report_id(self):
+        with dogtransport.open_device(path=self.control_path()) as dev:
+            with self.assertRaises(dogemu.HIDException):
+                dev.get_feature_report(0x01, dogtransport.REPORT_SIZE)
+
+
+class DogHidapiTest(DogEmulatorTest):
+    def test_attributes(self):
+        with dogtransport.open_device(path=self.control_path()) as dev:
+            self.assertEqual(dev.backend, 'hidapi')
+            #
+            # The report goes out from the device's own buffer
+            #
+            dev.send_report(bytes([dogenum.ID_GET_ATTRIBUTES_VALUES, 0]))
+            self.assertEqual(bytes(dev.frame), bytes(dev.out))
+            self.assertEqual(len(dev.get_report()), dogtransport.HID_EP_SIZE)
+
+
+class DogCrcTest(unittest.TestCase):
+    DATA = bytes(range(256)) * 40 + b'\x01\x02\x03'
+
+    def test_streaming(self):
+        crc = dogcrc.DogCrc()
+        for pos in range(0, len(self.DATA), 77):
+            crc.update(self.DATA[pos : pos + 77])
+
+        self.assertEqual(crc.length, len(self.DATA))
+        self.assertEqual(crc.value, dogcrc.CRCFUN(self.DATA, 0))
+
+    def test_pad(self):
+        #
+        # Longer than the blank block, so it's run more than once
+        #
+        size   = len(self.DATA) + 3 * len(dogcrc.BLANK) + 5
+        padded = self.DATA + b'\xff' * (size - len(self.DATA))
+        self.assertEqual(dogcrc.compute_crc(self.DATA, size), dogcrc.CRCFUN(padded, 0))
+        with self.assertRaises(AssertionError):
+            dogcrc.DogCrc().update(self.DATA).pad(len(self.DATA) - 1)
+
+    def test_update_to(self):
+        size = len(self.DATA) + 100
+        crc  = dogcrc.DogCrc()
+        for end in range(32, size, 32):
+            crc.update_to(self.DATA, end)
+            self.assertEqual(crc.value, dogcrc.compute_crc(self.DATA[:end], end))
+
+        self.assertEqual(crc.update_to(self.DATA, size).value,
+                         dogcrc.compute_crc(self.DATA, size))
+
+    def test_first_difference(self):
+        self.assertEqual(dogcrc.first_difference(b'abcd', b'abxd'), 2)
+        self.assertEqual(dogcrc.first_difference(b'ab', b'abcd'), 2)
+        self.assertTrue(dogcrc.is_blank(b'\xff' * 32))
+        self.assertFalse(dogcrc.is_blank(b'\xff' * 31 + b'\xfe'))
+
+
+class DogPlanTest(DogEmulatorTest):
+    #
+    # Which rows d20bootloader erases and rewrites
+    #
+    def setUp(self):
+        super().setUp()
+        self.erased = []
+        mcu         = self.controller.primary
+        erase_row   = mcu.erase_row
+
+        def record(offset):
+            self.erased.append(offset)
+            return erase_row(offset)
+
+        mcu.erase_row = record
+
+    def blob(self, image, bootloader):
+        return bytearray(image) + b'\xff' * (bootloader.APP_FW_LENGTH + d20bootloader.CRCLEN
+                                             - len(image))
+
+    def app_rows(self, bootloader):
+        return [offset for offset, _ in bootloader.rows()]
+
+    def test_full_erase(self):
+        entry = latest('D21')
+        with d20bootloader.DogBootloader() as bootloader:
+            rows = self.app_rows(bootloader)
+
+        d20bootloader.program_device(entry.path, True)
+        self.assertEqual(self.erased, rows)
+        self.assertEqual(self.controller.primary.app_timestamp, entry.timestamp)
+
+    def test_erase_plan(self):
+        image = latest('D21').read()
+        with d20bootloader.DogBootloader() as bootloader:
+            blob    = self.blob(image, bootloader)
+            crc_row = self.app_rows(bootloader)[-1]
+            self.assertEqual(bootloader.erase_plan(blob), self.app_rows(bootloader))
+            #
+            # Rows blank in both images are skipped, the CRC row never is
+            #
+            rows = bootloader.erase_plan(blob, installed=image)
+            self.assertIn(crc_row, rows)
+            for offset, size in bootloader.rows():
+                start = offset - bootloader.APP_FW_START
+                if offset != crc_row:
+                    self.assertEqual(offset in rows,
+                                     not dogcrc.is_blank(blob[start : start + size]))
+
+    def test_delta_plan(self):
+        image = latest('D21').read()
+        with d20bootloader.DogBootloader() as bootloader:
+            blob      = self.blob(image, bootloader)
+            crc_row   = self.app_rows(bootloader)[-1]
+            installed = bytearray(image)
+            installed[0x1234] ^= 0xFF
+            changed = bootloader.row_of(bootloader.APP_FW_START + 0x1234)
+            self.assertEqual(bootloader.delta_plan(blob, bytes(installed)), [changed, crc_row])
+            self.assertEqual(bootloader.delta_plan(blob, image), [crc_row])
+
+    def test_delta(self):
+        entry = latest('D21')
+        d20bootloader.program_device(entry.path, True)
+        del self.erased[:]
+
+        d20bootloader.program_device(entry.path, True, delta=True)
+        self.assertEqual(len(self.erased), 1)
+        primary = self.controller.primary
+        self.assertEqual(primary.app_timestamp, entry.timestamp)
+        self.assertEqual(primary.app_crc(), primary.stored_crc())
+
+
+class DogVerifyTests:
+    #
+    # Reading back and CRC checks, with one byte the primary MCU
+    # programs coming out wrong. Mixed into a test case for each tool
+    # and device type.
+    #
+    FAMILY = None
+    TOOL   = None
+
+    def setUp(self):
+        super().setUp()
+        self.tool  = globals()[self.TOOL]
+        self.entry = latest(self.FAMILY)
+        self.bad   = None
+
+    def corrupt(self, pos=0x1234):
+        #
+        # Corrupts the first byte at or after `pos` in the image that
+        # isn't 0xFF, so it isn't skipped as padding
+        #
+        image    = self.entry.read()
+        pos      = next(i for i in range(pos, len(image)) if image[i] != 0xFF)
+        mcu      = self.controller.primary
+        self.bad = mcu.app_fw_start + pos
+        program  = mcu.program
+
+        def corrupted(offset, data):
+            data = bytearray(data)
+            if offset <= self.bad < offset + len(data):
+                data[self.bad - offset] ^= 0x01
+            return program(offset, bytes(data))
+
+        mcu.program = corrupted
+
+    def program(self, **options):
+        if self.tool is d21bootloader16:
+            return self.tool.program_device(self.entry.path, verbose=False, **options)
+
+        return self.tool.program_device(self.entry.path, True, **options)
+
+    def test_verify(self):
+        self.program(verify=True)
+        self.assertEqual(self.controller.primary.app_timestamp, self.entry.timestamp)
+
+    def test_verify_mismatch(self):
+        self.corrupt()
+        with self.assertRaises(self.tool.DogBootloaderVerifyError) as raised:
+            self.program(verify=True)
+
+        row_size = self.controller.primary.row_size(self.bad)
+        self.assertEqual(raised.exception.offset, self.bad)
+        self.assertEqual(raised.exception.row, self.bad - self.bad % row_size)
+
+    def test_verify_crc(self):
+        self.program(verify_crc=True)
+        self.assertEqual(self.controller.primary.app_timestamp, self.entry.timestamp)
+
+    def test_verify_crc_mismatch(self):
+        self.corrupt()
+        with self.assertRaises(self.tool.DogBootloaderBootError):
+            self.program(verify_crc=True)
+
+        self.assertEqual(self.controller.primary.reason, dogemu.BOOTLOADER_REASON_BAD_CRC)
+
+
+class DogD21VerifyTest(DogVerifyTests, DogEmulatorTest):
+    DEVICE_TYPE = dogemu.DeviceType.D21_D21
+    FAMILY      = 'D21'
+    TOOL        = 'd21bootloader16'
+
+
+class DogD2xVerifyTest(DogVerifyTests, DogEmulatorTest):
+    FAMILY = 'D21'
+    TOOL   = 'd20bootloader'
+
+
+class DogRA4VerifyTest(DogVerifyTests, DogEmulatorTest):
+    DEVICE_TYPE = dogemu.DeviceType.RA4
+    FAMILY      = 'RA4'
+    TOOL        = 'd20bootloader'
+
+
+class DogFailureTest(unittest.TestCase):
+    #
+    # What the tools print and exit with, which dogd.py replies with too
+    #
+    def test_d20bootloader(self):
+        self.assertEqual(d20bootloader.failure(d20bootloader.DogBootloaderTimeout()),
+                         (['TIMEOUT'], 3))
+        self.assertEqual(d20bootloader.failure(d20bootloader.DogBootloaderVerifyError(16, 0)),
+                         (['Programmed data mismatch',
+                           'First mismatch at 0x00000010, row 0x00000000', 'ERROR'], 5))
+        self.assertIsNone(d20bootloader.failure(ValueError()))
+
+    def test_d21bootloader16(self):
+        self.assertEqual(d21bootloader16.failure(d21bootloader16.DogBootloaderTimeout()),
+                         (['Timeout waiting for Flash erase', 'ERROR'], 0))
+        self.assertIsNone(d21bootloader16.failure(ValueError()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# Single entry point for d20bootloader.py and d21bootloader16.py.
+#
+# Whichever tool is started probes the connected device and, if the
+# device belongs to the other tool, hands the command line over to it
+# in the same process instead of starting another interpreter. The
+# tool that ends up running the command doesn't probe again, and exits
+# with the same codes it would when run on its own.
+#
+# Run directly, it starts with d20bootloader, which tells devices
+# apart by their USB release number alone. Commands that only
+# enumerate devices and read their app attributes are answered by
+# dogenum then, without importing either tool or click, and without
+# probing the device first.
+#
+import importlib
+import os
+import sys
+import traceback
+
+#
+# Socket of dogd.py. Command lines the daemon can serve are only
+# forwarded to it with JUPITER_CONTROLLER_FW_DAEMON=1. Otherwise a
+# daemon listening on it only lends the device to the tool. An empty
+# path leaves any daemon alone.
+#
+DOGD_SOCKET = os.getenv('JUPITER_CONTROLLER_FW_SOCKET', '/run/jupiter-controller-fw.sock')
+USE_DOGD    = os.getenv('JUPITER_CONTROLLER_FW_DAEMON') == '1'
+
+#
+# Device type, as reported in the USB release number, to the tool
+# driving it
+#
+DEVICE_TYPES = {
+    0x100 : 'd21bootloader16',
+    0x200 : 'd20bootloader',
+    0x300 : 'd20bootloader',
+}
+
+
+#
+# Command lines served by dogenum alone when run directly
+#
+FAST_COMMANDS = {
+    ('getdevicesjson',)                     : lambda dogenum: dogenum.getdevicesjson(),
+    ('getappbuildtimestamp',)               : lambda dogenum: dogenum.getappbuildtimestamp(),
+    ('getappbuildtimestamp', '--primary')   : lambda dogenum: dogenum.getappbuildtimestamp(),
+    ('getappbuildtimestamp', '--secondary') : lambda dogenum: dogenum.getappbuildtimestamp(primary=False),
+}
+
+
+#
+# Options both tools take before the subcommand to pick one of
+# several controllers
+#
+SELECT_OPTIONS = ('--serial', '--path')
+
+
+def selected(argv=None):
+    #
+    # Serial number of the controller picked on the command line, or
+    # None. The tools probe the device before click parses the command
+    # line, so they look the options up here.
+    #
+    options = {}
+    args    = iter(sys.argv[1:] if argv is None else argv)
+    for arg in args:
+        if not arg.startswith('--'):
+            break
+
+        name, eq, value = arg.partition('=')
+        if name in SELECT_OPTIONS:
+            options[name[2:]] = value if eq else next(args, None)
+
+    if not options:
+        return None
+
+    import dogenum
+    return dogenum.serial_for(**options)
+
+
+def run_fast(command):
+    import dogenum
+
+    try:
+        command(dogenum)
+    except dogenum.hid.HIDException as e:
+        print(e)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+def run(name, probe=False):
+    #
+    # Runs tool `name` with the current command line and exits with
+    # its exit code. Errors the tool doesn't handle exit with 1, as
+    # they would from a separate interpreter.
+    #
+    tool = importlib.import_module(name)
+    try:
+        tool.main(probe=probe)
+    except SystemExit:
+        raise
+    except Exception:
+        traceback.print_exc()
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+def main(name=None):
+    lease = None
+    if DOGD_SOCKET and os.path.exists(DOGD_SOCKET):
+        import dogd
+        lease = dogd.client(sys.argv[1:], forward=USE_DOGD)
+
+    try:
+        #
+        # With no `name`, this is dogtool itself being run
+        #
+        if name is None:
+            command = FAST_COMMANDS.get(tuple(sys.argv[1:]))
+            if command:
+                run_fast(command)
+
+            name = 'd20bootloader'
+
+        run(name, probe=True)
+    finally:
+        if lease is not None:
+            lease.close()
+
+
+if __name__ == '__main__':
+    main()
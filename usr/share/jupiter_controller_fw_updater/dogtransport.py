@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+#
+# Feature report transport shared by both tools.
+#
+# Every report the tools exchange is a 64 byte feature report behind
+# report ID 0. Going through hidapi's ctypes layer is most of the host
+# side cost of a round trip. DogHidapiDevice frames reports in a buffer
+# allocated once per open device and hands hidapi a ctypes view of it,
+# but hid.Device returns a fresh bytes object for every report read,
+# which get_report() copies the payload out of. On Linux,
+# DogHidrawDevice instead issues HIDIOCSFEATURE/HIDIOCGFEATURE on
+# /dev/hidrawN directly, from two buffers allocated once per open
+# device, and only copies out the payload of a report read.
+#
+# The backend is picked per run with JUPITER_CONTROLLER_FW_TRANSPORT:
+#
+#   auto   - hidraw for /dev/hidraw* devices on Linux, hidapi otherwise
+#   hidraw - hidraw, or hidapi where there is no hidraw
+#   hidapi - always hidapi
+#
+# Either way devices are opened with open_device(), which takes the
+# arguments of hid.Device and returns an object with the same
+# interface, plus send_report() and get_report() for the tools'
+# reports. Errors are raised as hid.HIDException, as hidapi raises
+# them.
+#
+# Example:
+#
+#   ./dogtransport.py /dev/hidraw3
+#
+import ctypes
+import hid
+import os
+import sys
+
+import dogsysfs
+
+BACKENDS = ('auto', 'hidraw', 'hidapi')
+BACKEND  = os.getenv('JUPITER_CONTROLLER_FW_TRANSPORT', 'auto')
+
+HID_EP_SIZE = 64
+REPORT_SIZE = HID_EP_SIZE + 1
+
+#
+# linux/hidraw.h
+#
+IOC_WRITE = 1
+IOC_READ  = 2
+
+
+def ioc(direction, nr, size):
+    return (direction << 30) | (size << 16) | (ord('H') << 8) | nr
+
+
+HIDIOCSFEATURE = ioc(IOC_WRITE | IOC_READ, 0x06, REPORT_SIZE)
+HIDIOCGFEATURE = ioc(IOC_WRITE | IOC_READ, 0x07, REPORT_SIZE)
+
+ID_GET_ATTRIBUTES_VALUES = 0x83
+
+ZEROS = memoryview(bytes(REPORT_SIZE))
+
+
+class DogHidapiDevice:
+    #
+    # hid.Device, plus send_report() and get_report()
+    #
+    backend = 'hidapi'
+
+    def __init__(self, vid=None, pid=None, serial=None, path=None):
+        self.dev   = hid.Device(vid, pid, serial, path)
+        self.out   = bytearray(REPORT_SIZE)
+        #
+        # hid.Device passes reports on as c_char_p, which takes a
+        # c_char array sharing `out` as it is, but not a bytearray
+        #
+        self.frame = (ctypes.c_char * REPORT_SIZE).from_buffer(self.out)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.dev, name)
+
+    def close(self):
+        self.dev.close()
+
+    def send_feature_report(self, data):
+        return self.dev.send_feature_report(data)
+
+    def get_feature_report(self, report_id, size):
+        return self.dev.get_feature_report(report_id, size)
+
+    def fill(self, msg):
+        #
+        # `msg` behind report ID 0, padded with zeros
+        #
+        size = len(msg)
+        if size > HID_EP_SIZE:
+            raise hid.HIDException(f"Report of {size} bytes doesn't fit {HID_EP_SIZE}")
+
+        self.out[1 : 1 + size] = msg
+        self.out[1 + size :]   = ZEROS[1 + size :]
+
+    def send_report(self, msg):
+        self.fill(msg)
+        self.dev.send_feature_report(self.frame)
+
+    def get_report(self):
+        #
+        # The report's 64 bytes, without the report ID
+        #
+        return self.dev.get_feature_report(0x00, REPORT_SIZE)[1:]
+
+
+class DogHidrawDevice(DogHidapiDevice):
+    backend = 'hidraw'
+
+    def __init__(self, iface):
+        import fcntl
+
+        self.ioctl = fcntl.ioctl
+        self.iface = iface
+        self.out   = bytearray(REPORT_SIZE)
+        self.into  = bytearray(REPORT_SIZE)
+        self.fd    = self.open(iface['path'])
+
+    def open(self, path):
+        try:
+            return os.open(path, os.O_RDWR | os.O_CLOEXEC)
+        except OSError as e:
+            raise hid.HIDException(f"unable to open device: {e}") from e
+
+    def __getattr__(self, name):
+        raise AttributeError(name)
+
+    @property
+    def manufacturer(self):
+        return self.iface['manufacturer_string']
+
+    @property
+    def product(self):
+        return self.iface['product_string']
+
+    @property
+    def serial(self):
+        return self.iface['serial_number']
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def set_feature(self):
+        try:
+            return self.ioctl(self.fd, HIDIOCSFEATURE, self.out, True)
+        except OSError as e:
+            raise hid.HIDException(str(e)) from e
+
+    def get_feature(self):
+        self.into[0] = 0x00
+        try:
+            return self.ioctl(self.fd, HIDIOCGFEATURE, self.into, True)
+        except OSError as e:
+            raise hid.HIDException(str(e)) from e
+
+    def send_feature_report(self, data):
+        if len(data) != REPORT_SIZE or data[0] != 0x00:
+            raise hid.HIDException("Only 64 byte reports with report ID 0 are supported")
+
+        self.out[:] = data
+        return self.set_feature()
+
+    def get_feature_report(self, report_id, size):
+        if report_id != 0x00:
+            raise hid.HIDException("Only report ID 0 is supported")
+
+        return bytes(self.into[:min(size, self.get_feature())])
+
+    def send_report(self, msg):
+        self.fill(msg)
+        self.set_feature()
+
+    def get_report(self):
+        return bytes(self.into[1:self.get_feature()])
+
+
+def use_hidraw(path):
+    if BACKEND == 'hidapi' or not sys.platform.startswith('linux'):
+        return False
+    if BACKEND == 'hidraw':
+        return True
+
+    return path is None or os.fsdecode(path).startswith('/dev/hidraw')
+
+
+def find(vid, pid, serial, path):
+    #
+    # The sysfs entry of the device hid.Device would open, or None if
+    # sysfs can't be read
+    #
+    try:
+        ifaces = dogsysfs.enumerate(vid or 0, pid or 0)
+    except OSError:
+        return None
+
+    for iface in ifaces:
+        if path is not None:
+            if os.fsdecode(iface['path']) == os.fsdecode(path):
+                return iface
+        elif serial is None or iface['serial_number'] == serial:
+            return iface
+
+    raise hid.HIDException("unable to open device")
+
+
+def open_device(vid=None, pid=None, serial=None, path=None):
+    if use_hidraw(path):
+        iface = find(vid, pid, serial, path)
+        if iface is not None:
+            return DogHidrawDevice(iface)
+
+    return DogHidapiDevice(vid, pid, serial, path)
+
+
+if __name__ == '__main__':
+    with open_device(path=sys.argv[1].encode()) as dev:
+        dev.send_report(bytes([ID_GET_ATTRIBUTES_VALUES, 0]))
+        print(dev.backend, dev.get_report().hex())
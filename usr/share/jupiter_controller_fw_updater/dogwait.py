@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# Waiting for a controller to come back after it resets into the
+# bootloader or back into the app.
+#
+# A device can enumerate a while before it can actually be opened
+# (udev creates the hidraw node first and fixes up its permissions
+# after), so rather than sleeping for a fixed time, the waiter tries
+# to open the device, and retries with a short backoff until that
+# succeeds or a hard timeout expires. On Linux it also watches /dev
+# with inotify and retries right away when a hidraw node is created or
+# changes. Without inotify it simply polls with the same backoff.
+#
+import ctypes
+import hid
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+import dogtransport
+
+LOG = logging.getLogger(__name__)
+
+USB_ENUMERATION_TIMEOUT_S   = 10.0
+
+BACKOFF_MIN_S               = 0.01
+BACKOFF_MAX_S               = 0.2
+
+USE_INOTIFY                 = sys.platform.startswith('linux')
+
+IN_ATTRIB                   = 0x00000004
+IN_MOVED_TO                 = 0x00000080
+IN_CREATE                   = 0x00000100
+
+INOTIFY_EVENT               = struct.Struct('iIII')
+
+
+class DogWaitTimeout(Exception):
+    pass
+
+
+class DogPollWatcher:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+
+class DogInotifyWatcher(DogPollWatcher):
+    def __init__(self, directory='/dev'):
+        libc    = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        if libc.inotify_add_watch(self.fd, directory.encode(),
+                                  IN_CREATE | IN_ATTRIB | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"Can't watch {directory}")
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout):
+        #
+        # Returns True if a hidraw node showed up or changed within
+        # `timeout` seconds
+        #
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+
+        try:
+            events = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+
+        hidraw = False
+        offset = 0
+        while offset < len(events):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(events, offset)
+            offset += INOTIFY_EVENT.size
+            hidraw |= events[offset : offset + length].startswith(b'hidraw')
+            offset += length
+
+        return hidraw
+
+
+def watcher():
+    if USE_INOTIFY:
+        try:
+            return DogInotifyWatcher()
+        except (OSError, AttributeError):
+            #
+            # AttributeError: libc without inotify
+            #
+            pass
+
+    return DogPollWatcher()
+
+
+def wait_for_device(find, timeout=USB_ENUMERATION_TIMEOUT_S, tick=None):
+    #
+    # Waits until `find()` returns an interface that can be opened.
+    # Returns the interface and the opened device, see dogtransport.py.
+    #
+    deadline = time.monotonic() + timeout
+    backoff  = BACKOFF_MIN_S
+    attempt  = 0
+
+    with watcher() as w:
+        while True:
+            iface = find()
+            if iface:
+                try:
+                    return iface, dogtransport.open_device(path=iface['path'])
+                except (hid.HIDException, OSError) as e:
+                    LOG.debug(f"{iface['path']} isn't ready yet: {e}")
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DogWaitTimeout(f"Device not ready after {timeout} seconds")
+
+            attempt += 1
+            if tick:
+                tick(attempt)
+
+            if w.wait(min(backoff, remaining)):
+                backoff = BACKOFF_MIN_S
+            else:
+                backoff = min(backoff * 2, BACKOFF_MAX_S)
+
+
+def once_gone(find):
+    #
+    # `find`, but only returning what it finds once it has found
+    # nothing at least once. Right after a reset command the device
+    # can still be listed as it was, until it drops off the bus.
+    #
+    gone = False
+
+    def found():
+        nonlocal gone
+        iface = find()
+        gone |= not iface
+        return iface if gone else None
+
+    return found